@@ -51,7 +51,7 @@ class BaseNovelAgent:
         
         # Herramientas comunes disponibles para todos los agentes
         self.common_tools = [
-            RAGTool(),
+            RAGTool(llm=llm),
             WritingAnalyzer(),
             StyleAnalyzer(),
             CharacterAnalyzer(),
@@ -23,7 +23,7 @@ class BaseNovelAgent:
         
         # Herramientas comunes disponibles para todos los agentes
         self.common_tools = [
-            RAGTool(),
+            RAGTool(llm=llm),
             WritingAnalyzer(),
             StyleAnalyzer(),
             CharacterAnalyzer(),
@@ -41,7 +41,11 @@ class BaseNovelAgent:
         all_tools = self.common_tools.copy()
         if specific_tools:
             all_tools.extend(specific_tools)
-        
+
+        # Con el LLM local, el texto fijo del agente se evalua una sola vez
+        if hasattr(self.llm, 'register_agent'):
+            self.llm.register_agent(role, goal, backstory)
+
         return Agent(
             role=role,
             goal=goal,
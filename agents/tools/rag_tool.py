@@ -17,6 +17,7 @@ class RAGToolInput(BaseModel):
     query: str = Field(..., description="La consulta a realizar en la base de conocimiento")
     doc_type: Optional[str] = Field(None, description="Tipo de documento específico a buscar")
     k: int = Field(5, description="Número máximo de documentos relevantes a retornar")
+    project: Optional[str] = Field(None, description="Proyecto (libro o serie) en el que buscar")
 
 class RAGTool(BaseTool):
     name: str = "Consultar Base de Conocimiento"
@@ -30,6 +31,10 @@ class RAGTool(BaseTool):
     # Define as class attributes for Pydantic v2 compatibility
     rag_manager: Any = None
     logger: Any = None
+    # Proyecto por defecto de la herramienta (None = coleccion general)
+    project: Optional[str] = None
+    # LLM del agente: su tokenizer mide el presupuesto del contexto RAG
+    llm: Any = None
     
     def __init__(self, **data):
         super().__init__(**data)
@@ -40,14 +45,27 @@ class RAGTool(BaseTool):
     def _initialize_rag(self):
         """Initialize RAG manager after object creation"""
         try:
-            self.rag_manager = RAGManager()
+            self.rag_manager = RAGManager(project=self.project)
             self.logger = logging.getLogger(__name__)
         except Exception as e:
             self.logger = logging.getLogger(__name__)
             self.logger.error(f"Failed to initialize RAG manager: {e}")
             self.rag_manager = None
     
-    def _run(self, query: str, doc_type: Optional[str] = None, k: int = 5) -> str:
+    @staticmethod
+    def _context_token_budget() -> Optional[int]:
+        """Presupuesto de tokens del contexto RAG segun la configuracion"""
+        try:
+            from config.settings import settings
+        except ImportError as e:
+            logging.getLogger(__name__).warning(
+                f"Configuración no disponible ({e}), presupuesto de contexto de 1500 tokens"
+            )
+            return 1500
+        return getattr(settings, "rag_context_token_budget", 1500) or None
+    
+    def _run(self, query: str, doc_type: Optional[str] = None, k: int = 5,
+             project: Optional[str] = None) -> str:
         """Ejecuta una consulta en el sistema RAG"""
         try:
             # Ensure RAG manager is initialized
@@ -60,7 +78,14 @@ class RAGTool(BaseTool):
             if self.logger:
                 self.logger.info(f"Consultando RAG: {query}")
             
-            result = self.rag_manager.query(query, k=k, doc_type=doc_type)
+            # Contexto acotado en tokens para no desbordar el prompt del agente,
+            # medido con el tokenizer del LLM local si esta disponible
+            rag_manager = self.rag_manager.for_project(project or self.project)
+            result = rag_manager.query(
+                query, k=k, doc_type=doc_type,
+                token_budget=self._context_token_budget(),
+                token_counter=getattr(self.llm, 'count_tokens', None)
+            )
             
             if not result['context']:
                 return f"No se encontró información relevante para: {query}"
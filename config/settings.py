@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import os
 from pathlib import Path
+from typing import Optional
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
@@ -16,6 +17,62 @@ class Settings(BaseSettings):
     chroma_persist_directory: str = "./rag/vectorstore"
     embedding_model: str = "all-MiniLM-L6-v2"
     
+    # Backend vectorial: "chroma" o "numpy" (indice local plano/IVF sobre memmap)
+    vector_backend: str = "chroma"
+    max_open_projects: int = 8  # proyectos con el VectorStore abierto a la vez (LRU)
+    # Snapshot que se importa al arrancar si la coleccion por defecto esta vacia
+    rag_snapshot_path: str = ""
+    numpy_index_dtype: str = "float16"  # float32, float16 o int8 (escala por vector)
+    numpy_ivf_threshold: int = 50000
+    numpy_ivf_nprobe: int = 8
+    # Re-puntuacion de la lista corta con vectores float32 (None = solo con int8)
+    numpy_exact_rerank: Optional[bool] = None
+    numpy_rerank_factor: int = 4
+    
+    # Codificacion de embeddings (lotes por longitud)
+    embedding_preload: bool = True  # precarga en segundo plano al crear el VectorStore
+    embedding_batch_size: int = 64
+    embedding_num_threads: int = 0  # 0 = valor por defecto de torch
+    query_embedding_cache_size: int = 1024
+    result_cache_size: int = 512  # resultados de busqueda (se invalidan al escribir)
+    
+    # Recuperacion: "vector" o "hybrid" (BM25 + vectores con RRF)
+    retrieval_mode: str = "hybrid"
+    rrf_k: int = 60
+    rag_context_token_budget: int = 1500  # 0 = sin empaquetar
+    
+    # Post-recuperacion: "none", "mmr" o "cross_encoder" (MMR + reranking en CPU)
+    rerank_mode: str = "none"
+    rerank_fetch_factor: int = 4  # candidatos recuperados por cada resultado pedido
+    mmr_lambda: float = 0.5  # 1 = solo relevancia, 0 = solo diversidad
+    cross_encoder_model: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    rerank_budget_ms: int = 300  # si se excede, se usa el orden de MMR
+    
+    # Cache persistente de embeddings (matriz mapeada en memoria)
+    embedding_cache_enabled: bool = True
+    embedding_cache_max_mb: int = 512
+    embedding_cache_dtype: str = "float16"
+    
+    # Chunking: "structured" (capitulos/escenas/secciones, en tokens del modelo) o "recursive"
+    chunking_strategy: str = "structured"
+    chunk_max_tokens: int = 240  # all-MiniLM-L6-v2 trunca a 256 tokens
+    chunk_overlap_tokens: int = 32
+    
+    # Recuperacion jerarquica: se embeben hijos pequeños y se devuelven sus ventanas padre
+    hierarchical_retrieval: bool = False
+    parent_chunk_tokens: int = 768
+    child_chunk_tokens: int = 64
+    child_fanout: int = 3  # hijos buscados por cada padre pedido
+    
+    # Deduplicacion en la ingesta: chunks casi identicos (MinHash/LSH) se guardan una vez
+    dedup_enabled: bool = True
+    dedup_threshold: float = 0.85  # similitud de Jaccard estimada
+    
+    # Ingesta incremental: chunks por lote al sincronizar un documento
+    ingest_stream_batch_size: int = 256
+    # JSON sin ijson: se cargan completos, y por encima de este tamaño se rechazan
+    json_max_load_mb: int = 64
+    
     # Logging
     log_level: str = "INFO"
     
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Hilo unico de inferencia con cola de prioridades.
+
+El objeto Llama de llama.cpp no es seguro entre hilos: todas las
+generaciones pasan por este worker, que es el unico que llama al modelo.
+Las peticiones se ordenan por prioridad (las interactivas antes que los
+analisis por lotes) y, dentro de cada prioridad, por turnos entre sesiones
+para que un agente con muchas peticiones encoladas no acapare el modelo.
+Una peticion con plazo que no ha podido empezar a tiempo se descarta sin
+ejecutarse.
+"""
+import time
+import logging
+import threading
+import concurrent.futures
+from enum import IntEnum
+from collections import OrderedDict, deque
+from typing import Dict, Any, Optional, Callable, Deque
+
+class RequestPriority(IntEnum):
+    """Prioridad de una peticion (menor valor = antes)"""
+    INTERACTIVE = 0
+    BATCH = 1
+
+class DeadlineExceeded(TimeoutError):
+    """La peticion no pudo empezar antes de su plazo"""
+
+class _Job:
+    __slots__ = ("fn", "args", "future", "deadline", "enqueued_at")
+
+    def __init__(self, fn: Callable, args: tuple, deadline: Optional[float]):
+        self.fn = fn
+        self.args = args
+        self.future = concurrent.futures.Future()
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+
+class InferenceWorker:
+    """Ejecuta trabajos de inferencia de uno en uno en un hilo dedicado"""
+
+    def __init__(self, name: str = "llm-inference"):
+        self.logger = logging.getLogger(__name__)
+        self._cond = threading.Condition()
+        # prioridad -> sesion -> trabajos; el orden de las sesiones es el turno
+        self._queues: Dict[RequestPriority, "OrderedDict[str, Deque[_Job]]"] = {
+            priority: OrderedDict() for priority in RequestPriority
+        }
+        self._pending = 0
+        self._running = False
+        self._stopped = False
+
+        self.stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'expired': 0,
+            'cancelled': 0,
+            'total_wait_time': 0.0,
+            'max_wait_time': 0.0,
+            'max_queue_depth': 0
+        }
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: Callable, *args,
+               priority: RequestPriority = RequestPriority.INTERACTIVE,
+               session: Optional[str] = None,
+               deadline: Optional[float] = None) -> concurrent.futures.Future:
+        """Encola fn(*args); deadline son los segundos maximos de espera en cola"""
+        job = _Job(fn, args, time.monotonic() + deadline if deadline is not None else None)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("El worker de inferencia esta detenido")
+            sessions = self._queues[RequestPriority(priority)]
+            sessions.setdefault(session or "", deque()).append(job)
+            self._pending += 1
+            self.stats['submitted'] += 1
+            self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self._pending)
+            self._cond.notify()
+        return job.future
+
+    def _next_job(self) -> Optional[_Job]:
+        """Siguiente trabajo: mayor prioridad y turno rotatorio entre sesiones"""
+        for priority in RequestPriority:
+            sessions = self._queues[priority]
+            if not sessions:
+                continue
+            session, jobs = sessions.popitem(last=False)
+            job = jobs.popleft()
+            if jobs:
+                # La sesion vuelve al final de la rueda
+                sessions[session] = jobs
+            self._pending -= 1
+            return job
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped and not self._pending:
+                    return
+                job = self._next_job()
+                self._running = True
+
+            try:
+                self._execute(job)
+            finally:
+                with self._cond:
+                    self._running = False
+                    self._cond.notify_all()
+
+    def _execute(self, job: _Job):
+        if not job.future.set_running_or_notify_cancel():
+            self.stats['cancelled'] += 1
+            return
+
+        started = time.monotonic()
+        if job.deadline is not None and started > job.deadline:
+            self.stats['expired'] += 1
+            job.future.set_exception(DeadlineExceeded(
+                f"Plazo vencido tras {started - job.enqueued_at:.2f}s en cola"
+            ))
+            return
+
+        wait_time = started - job.enqueued_at
+        self.stats['total_wait_time'] += wait_time
+        self.stats['max_wait_time'] = max(self.stats['max_wait_time'], wait_time)
+        try:
+            result = job.fn(*job.args)
+        except BaseException as e:
+            self.stats['failed'] += 1
+            job.future.set_exception(e)
+        else:
+            self.stats['completed'] += 1
+            job.future.set_result(result)
+
+    def stop(self, wait: bool = True, timeout: Optional[float] = None):
+        """Detiene el worker; los trabajos aun en cola se cancelan"""
+        with self._cond:
+            self._stopped = True
+            for sessions in self._queues.values():
+                for jobs in sessions.values():
+                    for job in jobs:
+                        job.future.cancel()
+                sessions.clear()
+            self._pending = 0
+            self._cond.notify_all()
+        if wait and threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
+
+    def is_busy(self) -> bool:
+        with self._cond:
+            return self._running or self._pending > 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Profundidad de la cola y tiempos de espera"""
+        with self._cond:
+            queued = {
+                priority.name.lower(): sum(len(jobs) for jobs in sessions.values())
+                for priority, sessions in self._queues.items()
+            }
+            sessions = len({session for queue in self._queues.values() for session in queue})
+            running = self._running
+        started = self.stats['completed'] + self.stats['failed']
+        return {
+            **self.stats,
+            'queued': queued,
+            'queued_sessions': sessions,
+            'running': running,
+            'avg_wait_time': round(self.stats['total_wait_time'] / started, 4) if started else 0.0,
+            'alive': self._thread.is_alive()
+        }
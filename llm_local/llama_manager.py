@@ -5,21 +5,30 @@ fallbacks y optimizaciones de rendimiento.
 """
 import logging
 import asyncio
+import threading
+import concurrent.futures
 import time
-from typing import Dict, Any, Optional, List, Union
+from typing import Dict, Any, Optional, List, Union, AsyncIterator, Tuple
 import os
 from pathlib import Path
 from dataclasses import dataclass
 from enum import Enum
-import hashlib
 import json
 
 try:
+    import llama_cpp
     from llama_cpp import Llama
     LLAMA_CPP_AVAILABLE = True
 except ImportError:
     LLAMA_CPP_AVAILABLE = False
 
+from .inference_worker import InferenceWorker, RequestPriority
+from .response_cache import ResponseCache, model_fingerprint
+from .prefix_cache import PrefixStateCache
+from .metrics import GenerationMetrics, GenerationUsage
+
+DEFAULT_CACHE_DIR = str(Path(__file__).parent / "cache")
+
 class LLMStatus(Enum):
     """Estados del LLM"""
     NOT_LOADED = "not_loaded"
@@ -28,6 +37,14 @@ class LLMStatus(Enum):
     ERROR = "error"
     BUSY = "busy"
 
+STOP_SEQUENCES = ["</s>", "\n\n", "Human:", "Assistant:", "###"]
+
+# Parte fija del prompt con contexto RAG (va delante para reutilizar su estado KV)
+CONTEXT_PROMPT_PREFIX = """Instrucciones: Responde basándote únicamente en el contexto proporcionado. Si la información no está en el contexto, indica que no tienes suficiente información.
+
+Contexto de referencia:
+"""
+
 @dataclass
 class GenerationResult:
     """Resultado de una generación"""
@@ -37,13 +54,52 @@ class GenerationResult:
     tokens_generated: int
     error: Optional[str] = None
     cached: bool = False
+    prompt_tokens: int = 0
+    prompt_eval_ms: Optional[float] = None
+    generation_ms: Optional[float] = None
+
+def _llama_context(model):
+    return getattr(getattr(model, '_ctx', None), 'ctx', None)
+
+def _reset_llama_timings(model) -> bool:
+    """Reinicia los contadores de rendimiento de llama.cpp (API según versión)"""
+    ctx = _llama_context(model)
+    if ctx is None:
+        return False
+    for name in ('llama_perf_context_reset', 'llama_reset_timings'):
+        reset = getattr(llama_cpp, name, None)
+        if reset is not None:
+            try:
+                reset(ctx)
+                return True
+            except Exception:
+                return False
+    return False
+
+def _read_llama_timings(model) -> Optional[Tuple[float, float, int]]:
+    """(ms de evaluación del prompt, ms de generación, tokens de prompt evaluados)"""
+    ctx = _llama_context(model)
+    for name in ('llama_perf_context', 'llama_get_timings'):
+        read = getattr(llama_cpp, name, None)
+        if read is not None:
+            try:
+                data = read(ctx)
+                return float(data.t_p_eval_ms), float(data.t_eval_ms), int(data.n_p_eval)
+            except Exception:
+                return None
+    return None
 
 class LlamaManager:
     """Gestor mejorado para modelos LLM locales usando llama.cpp"""
     
     def __init__(self, model_path: str = None, context_length: int = 4096,
                  max_tokens: int = 2048, temperature: float = 0.7,
-                 enable_cache: bool = True, max_concurrent: int = 2):
+                 enable_cache: bool = True, max_concurrent: int = 2,
+                 stream_queue_size: int = 32,
+                 cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                 cache_memory_mb: int = 32, cache_disk_mb: int = 512,
+                 cache_ttl_hours: Optional[float] = 24 * 30,
+                 prefix_cache_mb: int = 512, prefix_cache_disk: bool = False):
         
         self.model_path = model_path
         self.context_length = context_length
@@ -51,17 +107,35 @@ class LlamaManager:
         self.temperature = temperature
         self.enable_cache = enable_cache
         self.max_concurrent = max_concurrent
+        self.stream_queue_size = stream_queue_size
         
         self.model = None
         self.status = LLMStatus.NOT_LOADED
         self.logger = logging.getLogger(__name__)
         
-        # Cache para respuestas
-        self.response_cache = {} if enable_cache else None
-        self.max_cache_size = 100
-        
-        # Control de concurrencia
-        self.semaphore = asyncio.Semaphore(max_concurrent)
+        # Cache para respuestas: LRU en memoria + SQLite en cache_dir
+        # (cache_dir=None lo deja solo en memoria)
+        self.response_cache = ResponseCache(
+            cache_dir,
+            max_memory_bytes=cache_memory_mb * 1024 * 1024,
+            max_disk_bytes=cache_disk_mb * 1024 * 1024,
+            ttl_seconds=cache_ttl_hours * 3600 if cache_ttl_hours else None
+        ) if enable_cache else None
+        self.model_hash = ""
+        self.cache_dir = cache_dir
+        
+        # Estados KV de prefijos fijos (prefix_cache_mb=0 lo desactiva);
+        # los textos se tokenizan al cargar el modelo
+        self.prefix_cache_mb = prefix_cache_mb
+        self.prefix_cache_disk = prefix_cache_disk
+        self.prefix_cache: Optional[PrefixStateCache] = None
+        self._prefix_texts = set()
+        self.register_prefix(CONTEXT_PROMPT_PREFIX)
+        
+        # Control de concurrencia: un unico hilo es dueño del modelo y
+        # atiende las peticiones por prioridad (max_concurrent se conserva
+        # por compatibilidad, el modelo no admite llamadas concurrentes)
+        self.worker: Optional[InferenceWorker] = None
         self.active_generations = 0
         
         # Estadísticas
@@ -70,11 +144,18 @@ class LlamaManager:
             'successful_generations': 0,
             'failed_generations': 0,
             'total_tokens_generated': 0,
+            'total_prompt_tokens': 0,
             'total_processing_time': 0,
             'cache_hits': 0,
-            'cache_misses': 0
+            'cache_misses': 0,
+            'streamed_generations': 0,
+            'cancelled_generations': 0,
+            'total_time_to_first_token': 0
         }
         
+        # Tokens, tiempos y latencias por etiqueta de llamador
+        self.metrics = GenerationMetrics()
+        
         # Inicializar modelo si se proporciona ruta
         if model_path:
             self._initialize_model()
@@ -105,6 +186,9 @@ class LlamaManager:
                 use_mlock=False
             )
             
+            self.model_hash = model_fingerprint(self.model_path)
+            self._create_prefix_cache()
+            self.worker = InferenceWorker()
             self.status = LLMStatus.READY
             self.logger.info("Modelo cargado exitosamente")
             return True
@@ -117,44 +201,172 @@ class LlamaManager:
     def is_available(self) -> bool:
         """Verifica si el LLM está disponible para uso"""
         return (LLAMA_CPP_AVAILABLE and 
-                self.status == LLMStatus.READY and 
-                self.model is not None)
+                self.status in (LLMStatus.READY, LLMStatus.BUSY) and 
+                self.model is not None and
+                self.worker is not None)
+    
+    def count_tokens(self, text: str) -> int:
+        """Cuenta tokens con el tokenizer del modelo (estimacion si no esta cargado)"""
+        if self.model is not None:
+            try:
+                return len(self.model.tokenize(text.encode('utf-8'), add_bos=False))
+            except Exception:
+                pass
+        return max(1, len(text) // 4)
+    
+    def context_token_budget(self, question: str = "", max_tokens: Optional[int] = None) -> int:
+        """Tokens disponibles para el contexto RAG dentro de llm_context_length"""
+        max_tokens = max_tokens or self.max_tokens
+        overhead = self.count_tokens(self._build_context_prompt(question, ""))
+        return max(0, self.context_length - max_tokens - overhead)
+    
+    def _truncate_to_tokens(self, text: str, token_limit: int) -> str:
+        """Recorta el texto a token_limit tokens terminando en limite de frase"""
+        if token_limit <= 0:
+            return ""
+        if self.count_tokens(text) <= token_limit:
+            return text
+        
+        if self.model is not None:
+            tokens = self.model.tokenize(text.encode('utf-8'), add_bos=False)[:token_limit]
+            truncated = self.model.detokenize(tokens).decode('utf-8', errors='ignore')
+        else:
+            truncated = text[:token_limit * 4]
+        
+        # Retroceder hasta el ultimo final de frase o parrafo
+        cut = max(truncated.rfind(mark) for mark in ('. ', '.\n', '! ', '? ', '\n\n'))
+        if cut > len(truncated) // 2:
+            truncated = truncated[:cut + 1]
+        return truncated.rstrip()
+    
+    def _create_prefix_cache(self):
+        """Crea el cache de prefijos del modelo cargado y tokeniza los registrados"""
+        self.prefix_cache = None
+        if self.prefix_cache_mb <= 0:
+            return
+        spill_directory = None
+        if self.prefix_cache_disk and self.cache_dir:
+            spill_directory = os.path.join(self.cache_dir, "prefix_states", self.model_hash[:16])
+        self.prefix_cache = PrefixStateCache(
+            max_memory_bytes=self.prefix_cache_mb * 1024 * 1024,
+            spill_directory=spill_directory
+        )
+        for text in self._prefix_texts:
+            self._register_prefix_tokens(text)
+    
+    def _prompt_tokens(self, text: str) -> List[int]:
+        """Tokens del prompt tal como los evalúa llama.cpp (con BOS)"""
+        return self.model.tokenize(text.encode('utf-8'), add_bos=True, special=True)
+    
+    def _register_prefix_tokens(self, text: str) -> bool:
+        try:
+            # Sin el último token, que puede fusionarse con el texto que sigue
+            return self.prefix_cache.register(self._prompt_tokens(text)[:-1])
+        except Exception as e:
+            self.logger.warning(f"No se pudo registrar el prefijo: {str(e)}")
+            return False
+    
+    def register_prefix(self, text: str) -> bool:
+        """Registra un prefijo fijo de prompt cuyo estado KV se reutiliza
+        
+        Los prompts que empiecen por él solo evalúan el resto del texto.
+        """
+        if self.prefix_cache_mb <= 0 or not text:
+            return False
+        if text in self._prefix_texts:
+            return True
+        self._prefix_texts.add(text)
+        if self.prefix_cache is not None:
+            return self._register_prefix_tokens(text)
+        return True
+    
+    def register_agent(self, role: str, goal: str, backstory: str) -> bool:
+        """Registra como prefijo el inicio del mensaje de sistema de un agente
+        
+        CrewAI añade las herramientas y el formato de respuesta tras el rol,
+        así que el prefijo termina en el objetivo, sin el fin de mensaje.
+        """
+        message = self._format_message("system", self.agent_system_prompt(role, goal, backstory))
+        return self.register_prefix(message.rstrip("\n"))
+    
+    @staticmethod
+    def agent_system_prompt(role: str, goal: str, backstory: str) -> str:
+        """Rol del agente tal como abre CrewAI su mensaje de sistema (plantilla role_playing)"""
+        return f"You are {role}. {backstory}\nYour personal goal is: {goal}"
+    
+    def _restore_prefix(self, prompt: str):
+        """Deja el contexto del modelo con el prefijo registrado más largo del prompt
+        
+        Se ejecuta en el worker de inferencia justo antes de generar: si el
+        contexto ya empieza por el prefijo no hace nada; si hay un estado
+        guardado lo restaura y, si no, evalúa el prefijo y guarda su estado.
+        llama.cpp solo evalúa después los tokens que siguen al prefijo.
+        """
+        if self.prefix_cache is None or not self.prefix_cache.prefixes:
+            return
+        try:
+            prefix = self.prefix_cache.longest_match(self._prompt_tokens(prompt))
+            if prefix is None:
+                return
+            size = len(prefix)
+            if self.model.n_tokens >= size and tuple(self.model.input_ids[:size]) == prefix:
+                self.prefix_cache.record_reuse(prefix, live=True)
+                return
+            state = self.prefix_cache.get(prefix)
+            if state is None:
+                self.model.reset()
+                self.model.eval(list(prefix))
+                self.prefix_cache.put(prefix, self.model.save_state())
+            else:
+                self.model.load_state(state)
+                self.prefix_cache.record_reuse(prefix, live=False)
+        except Exception as e:
+            self.logger.warning(f"No se pudo restaurar el estado del prefijo: {str(e)}")
     
     def _get_cache_key(self, prompt: str, max_tokens: int, temperature: float) -> str:
-        """Genera clave de cache para un prompt"""
-        cache_data = f"{prompt}|{max_tokens}|{temperature}"
-        return hashlib.md5(cache_data.encode()).hexdigest()
+        """Genera clave de cache (modelo, prompt y parámetros de muestreo)"""
+        params = {
+            'max_tokens': max_tokens,
+            'temperature': temperature,
+            'stop': STOP_SEQUENCES
+        }
+        return ResponseCache.make_key(self.model_hash, prompt, params)
     
     def _get_from_cache(self, cache_key: str) -> Optional[str]:
         """Obtiene respuesta del cache"""
-        if not self.response_cache or cache_key not in self.response_cache:
+        response = self.response_cache.get(cache_key) if self.response_cache is not None else None
+        if response is None:
             self.stats['cache_misses'] += 1
             return None
         
         self.stats['cache_hits'] += 1
-        return self.response_cache[cache_key]
+        return response
     
     def _add_to_cache(self, cache_key: str, response: str):
         """Añade respuesta al cache"""
-        if not self.response_cache:
+        if self.response_cache is None:
             return
         
-        # Limpiar cache si está lleno
-        if len(self.response_cache) >= self.max_cache_size:
-            # Eliminar el 20% de entradas más antiguas
-            items_to_remove = list(self.response_cache.keys())[:self.max_cache_size // 5]
-            for key in items_to_remove:
-                del self.response_cache[key]
-        
-        self.response_cache[cache_key] = response
+        self.response_cache.put(cache_key, response)
     
     async def generate_async(self, prompt: str, max_tokens: Optional[int] = None,
                            temperature: Optional[float] = None, 
-                           use_cache: bool = True) -> GenerationResult:
-        """Genera texto de forma asíncrona"""
+                           use_cache: bool = True,
+                           priority: RequestPriority = RequestPriority.INTERACTIVE,
+                           session: Optional[str] = None,
+                           deadline: Optional[float] = None,
+                           tag: Optional[str] = None) -> GenerationResult:
+        """Genera texto de forma asíncrona
+        
+        La petición se encola en el worker de inferencia: las interactivas
+        pasan antes que las BATCH y las sesiones se atienden por turnos.
+        deadline son los segundos máximos de espera en cola antes de empezar.
+        tag agrupa las métricas de uso (por defecto, la sesión).
+        """
         
         max_tokens = max_tokens or self.max_tokens
         temperature = temperature or self.temperature
+        tag = tag or session
         start_time = time.time()
         
         # Verificar disponibilidad
@@ -173,91 +385,310 @@ class LlamaManager:
             cache_key = self._get_cache_key(prompt, max_tokens, temperature)
             cached_response = self._get_from_cache(cache_key)
             if cached_response:
+                processing_time = time.time() - start_time
+                tokens_generated = self.count_tokens(cached_response)
+                self.metrics.record(tag, processing_time,
+                                    GenerationUsage(completion_tokens=tokens_generated),
+                                    cached=True)
                 return GenerationResult(
                     text=cached_response,
                     success=True,
-                    processing_time=time.time() - start_time,
-                    tokens_generated=len(cached_response.split()),
+                    processing_time=processing_time,
+                    tokens_generated=tokens_generated,
                     cached=True
                 )
         
-        # Control de concurrencia
-        async with self.semaphore:
-            self.active_generations += 1
-            self.status = LLMStatus.BUSY
+        self._begin_generation()
+        try:
+            # El worker es el único hilo que llama al modelo
+            future = self.worker.submit(
+                self._generate_sync,
+                prompt,
+                max_tokens,
+                temperature,
+                priority=priority,
+                session=session,
+                deadline=deadline
+            )
+            response, usage = await asyncio.wrap_future(future)
             
-            try:
-                # Ejecutar generación en thread pool para no bloquear
-                loop = asyncio.get_event_loop()
-                response = await loop.run_in_executor(
-                    None, 
-                    self._generate_sync, 
-                    prompt, 
-                    max_tokens, 
-                    temperature
-                )
-                
-                processing_time = time.time() - start_time
-                tokens_generated = len(response.split()) if response else 0
-                
-                # Actualizar estadísticas
-                self.stats['total_generations'] += 1
-                self.stats['successful_generations'] += 1
-                self.stats['total_tokens_generated'] += tokens_generated
-                self.stats['total_processing_time'] += processing_time
-                
-                # Guardar en cache
-                if cache_key and response:
-                    self._add_to_cache(cache_key, response)
-                
-                return GenerationResult(
-                    text=response,
-                    success=True,
-                    processing_time=processing_time,
-                    tokens_generated=tokens_generated
-                )
-                
-            except Exception as e:
-                self.stats['total_generations'] += 1
-                self.stats['failed_generations'] += 1
-                
-                return GenerationResult(
-                    text="",
-                    success=False,
-                    processing_time=time.time() - start_time,
-                    tokens_generated=0,
-                    error=str(e)
-                )
+            processing_time = time.time() - start_time
+            tokens_generated = usage.completion_tokens
             
-            finally:
-                self.active_generations -= 1
-                if self.active_generations == 0:
-                    self.status = LLMStatus.READY
+            # Actualizar estadísticas
+            self.stats['total_generations'] += 1
+            self.stats['successful_generations'] += 1
+            self.stats['total_tokens_generated'] += tokens_generated
+            self.stats['total_prompt_tokens'] += usage.prompt_tokens
+            self.stats['total_processing_time'] += processing_time
+            self.metrics.record(tag, processing_time, usage)
+            
+            # Guardar en cache
+            if cache_key and response:
+                self._add_to_cache(cache_key, response)
+            
+            return GenerationResult(
+                text=response,
+                success=True,
+                processing_time=processing_time,
+                tokens_generated=tokens_generated,
+                prompt_tokens=usage.prompt_tokens,
+                prompt_eval_ms=usage.prompt_eval_ms,
+                generation_ms=usage.generation_ms
+            )
+            
+        except Exception as e:
+            processing_time = time.time() - start_time
+            self.stats['total_generations'] += 1
+            self.stats['failed_generations'] += 1
+            self.metrics.record(tag, processing_time, success=False)
+            
+            return GenerationResult(
+                text="",
+                success=False,
+                processing_time=processing_time,
+                tokens_generated=0,
+                error=str(e)
+            )
+        
+        finally:
+            self._end_generation()
+    
+    def _begin_generation(self):
+        self.active_generations += 1
+        self.status = LLMStatus.BUSY
     
-    def _generate_sync(self, prompt: str, max_tokens: int, temperature: float) -> str:
-        """Generación síncrona del modelo"""
+    def _end_generation(self):
+        self.active_generations -= 1
+        if self.active_generations == 0 and self.status == LLMStatus.BUSY:
+            self.status = LLMStatus.READY
+    
+    def _generate_sync(self, prompt: str, max_tokens: int,
+                       temperature: float) -> Tuple[str, GenerationUsage]:
+        """Generación síncrona del modelo (texto y uso de tokens/tiempos)"""
         if not self.model:
             raise RuntimeError("Modelo no está cargado")
         
         try:
+            timed = _reset_llama_timings(self.model)
+            start = time.perf_counter()
+            self._restore_prefix(prompt)
             response = self.model(
                 prompt,
                 max_tokens=max_tokens,
                 temperature=temperature,
-                stop=["</s>", "\n\n", "Human:", "Assistant:", "###"],
+                stop=STOP_SEQUENCES,
                 echo=False,
                 stream=False
             )
             
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            
+            text = ""
             if response and 'choices' in response and len(response['choices']) > 0:
-                return response['choices'][0]['text'].strip()
-            else:
-                return ""
+                text = response['choices'][0]['text'].strip()
+            usage = self._measure_usage(prompt, text, (response or {}).get('usage'),
+                                        timed, elapsed_ms)
+            return text, usage
             
         except Exception as e:
             self.logger.error(f"Error en generación síncrona: {str(e)}")
             raise
     
+    def _measure_usage(self, prompt: str, text: str, reported: Optional[Dict[str, Any]],
+                       timed: bool, elapsed_ms: float,
+                       first_token_ms: Optional[float] = None) -> GenerationUsage:
+        """Tokens con el uso de llama.cpp o el tokenizer y tiempos de sus contadores
+        
+        Sin contadores de llama.cpp, en streaming se separa por el primer
+        token; en una llamada normal los tiempos quedan sin medir.
+        """
+        if reported:
+            usage = GenerationUsage(prompt_tokens=int(reported.get('prompt_tokens', 0)),
+                                    completion_tokens=int(reported.get('completion_tokens', 0)))
+        else:
+            usage = GenerationUsage(prompt_tokens=len(self._prompt_tokens(prompt)),
+                                    completion_tokens=self.count_tokens(text) if text else 0)
+        
+        timings = _read_llama_timings(self.model) if timed else None
+        if timings is not None:
+            usage.prompt_eval_ms, usage.generation_ms, usage.prompt_eval_tokens = timings
+        elif first_token_ms is not None:
+            usage.prompt_eval_ms = first_token_ms
+            usage.generation_ms = elapsed_ms - first_token_ms
+        return usage
+
+    async def generate_stream_async(self, prompt: str, max_tokens: Optional[int] = None,
+                                    temperature: Optional[float] = None,
+                                    use_cache: bool = True,
+                                    priority: RequestPriority = RequestPriority.INTERACTIVE,
+                                    session: Optional[str] = None,
+                                    deadline: Optional[float] = None,
+                                    tag: Optional[str] = None) -> AsyncIterator[str]:
+        """Genera texto token a token (generador asíncrono)
+
+        La generación corre en el worker de inferencia con stream=True y los
+        tokens llegan por una cola acotada: si el consumidor va lento, el
+        hilo espera. Cerrar o cancelar el generador detiene la generación
+        en el siguiente token.
+        """
+
+        max_tokens = max_tokens or self.max_tokens
+        temperature = temperature or self.temperature
+        tag = tag or session
+        start_time = time.time()
+
+        if not self.is_available():
+            raise RuntimeError("LLM no disponible")
+
+        cache_key = None
+        if use_cache and self.enable_cache:
+            cache_key = self._get_cache_key(prompt, max_tokens, temperature)
+            cached_response = self._get_from_cache(cache_key)
+            if cached_response:
+                self.metrics.record(tag, time.time() - start_time,
+                                    GenerationUsage(completion_tokens=self.count_tokens(cached_response)),
+                                    cached=True)
+                yield cached_response
+                return
+
+        self._begin_generation()
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(maxsize=self.stream_queue_size)
+        cancelled = threading.Event()
+        future = self.worker.submit(
+            self._generate_stream_sync,
+            prompt,
+            max_tokens,
+            temperature,
+            queue,
+            loop,
+            cancelled,
+            priority=priority,
+            session=session,
+            deadline=deadline
+        )
+
+        def on_done(done):
+            # Un plazo vencido antes de empezar llega como error por la cola
+            if not done.cancelled() and done.exception() is not None:
+                loop.call_soon_threadsafe(queue.put_nowait, ("error", done.exception()))
+
+        future.add_done_callback(on_done)
+
+        pieces = []
+        time_to_first_token = None
+        finished = False
+        usage = None
+
+        try:
+            while True:
+                kind, value = await queue.get()
+                if kind == "done":
+                    usage = value
+                    break
+                if kind == "error":
+                    finished = True
+                    self.stats['total_generations'] += 1
+                    self.stats['failed_generations'] += 1
+                    self.metrics.record(tag, time.time() - start_time, success=False)
+                    raise value
+
+                if not pieces:
+                    # Igual que _generate_sync, sin espacios iniciales
+                    value = value.lstrip()
+                    if not value:
+                        continue
+                    time_to_first_token = time.time() - start_time
+                pieces.append(value)
+                yield value
+
+            finished = True
+            processing_time = time.time() - start_time
+            self.stats['total_generations'] += 1
+            self.stats['successful_generations'] += 1
+            self.stats['streamed_generations'] += 1
+            self.stats['total_tokens_generated'] += usage.completion_tokens
+            self.stats['total_prompt_tokens'] += usage.prompt_tokens
+            self.stats['total_processing_time'] += processing_time
+            self.metrics.record(tag, processing_time, usage)
+            if time_to_first_token is not None:
+                self.stats['total_time_to_first_token'] += time_to_first_token
+
+            response = "".join(pieces).strip()
+            if cache_key and response:
+                self._add_to_cache(cache_key, response)
+
+        finally:
+            cancelled.set()
+            if not finished:
+                self.stats['cancelled_generations'] += 1
+            # Si ya estaba en marcha, esperar a que el worker suelte el modelo
+            if not future.cancel():
+                try:
+                    await asyncio.wrap_future(future)
+                except Exception:
+                    pass
+            self._end_generation()
+
+    def _generate_stream_sync(self, prompt: str, max_tokens: int, temperature: float,
+                              queue: asyncio.Queue, loop: asyncio.AbstractEventLoop,
+                              cancelled: threading.Event):
+        """Generación en streaming del modelo (se ejecuta en un hilo)"""
+
+        def put(item) -> bool:
+            # Espera a que haya hueco en la cola salvo que el consumidor se haya ido
+            try:
+                future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+            except RuntimeError:
+                return False
+            while True:
+                try:
+                    future.result(timeout=0.1)
+                    return True
+                except concurrent.futures.TimeoutError:
+                    if cancelled.is_set():
+                        future.cancel()
+                        return False
+
+        stream = None
+        try:
+            timed = _reset_llama_timings(self.model)
+            start = time.perf_counter()
+            first_token_ms = None
+            pieces = []
+            self._restore_prefix(prompt)
+            stream = self.model(
+                prompt,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stop=STOP_SEQUENCES,
+                echo=False,
+                stream=True
+            )
+            for chunk in stream:
+                if cancelled.is_set():
+                    break
+                text = chunk['choices'][0]['text'] if chunk.get('choices') else ""
+                if not text:
+                    continue
+                if first_token_ms is None:
+                    first_token_ms = (time.perf_counter() - start) * 1000
+                pieces.append(text)
+                if not put(("token", text)):
+                    break
+            else:
+                usage = self._measure_usage(prompt, "".join(pieces).strip(), None, timed,
+                                            (time.perf_counter() - start) * 1000,
+                                            first_token_ms)
+                put(("done", usage))
+        except Exception as e:
+            self.logger.error(f"Error en generación en streaming: {str(e)}")
+            put(("error", e))
+        finally:
+            if stream is not None and hasattr(stream, 'close'):
+                stream.close()
+
     def generate(self, prompt: str, max_tokens: Optional[int] = None,
                 temperature: Optional[float] = None) -> str:
         """Genera texto de forma síncrona (wrapper para compatibilidad)"""
@@ -283,19 +714,28 @@ class LlamaManager:
             return result.text if result.success else ""
     
     async def generate_with_context_async(self, question: str, context: str,
-                                        max_tokens: Optional[int] = None) -> GenerationResult:
-        """Genera respuesta usando contexto RAG (versión async)"""
+                                        max_tokens: Optional[int] = None,
+                                        tag: Optional[str] = "rag") -> GenerationResult:
+        """Genera respuesta usando contexto RAG (versión async)
         
-        prompt = f"""Contexto de referencia:
-{context[:2000]}  # Limitar contexto para evitar overflow
+        El contexto se ajusta en tokens a lo que cabe en context_length; para
+        aprovecharlo al maximo conviene empaquetarlo antes con
+        RAGManager.query(token_budget=self.context_token_budget(question)).
+        """
+        
+        budget = self.context_token_budget(question, max_tokens)
+        prompt = self._build_context_prompt(question, self._truncate_to_tokens(context, budget))
+        
+        return await self.generate_async(prompt, max_tokens, tag=tag)
+    
+    @staticmethod
+    def _build_context_prompt(question: str, context: str) -> str:
+        """Plantilla del prompt con contexto RAG"""
+        return f"""{CONTEXT_PROMPT_PREFIX}{context}
 
 Pregunta: {question}
 
-Instrucciones: Responde basándote únicamente en el contexto proporcionado. Si la información no está en el contexto, indica que no tienes suficiente información.
-
 Respuesta:"""
-        
-        return await self.generate_async(prompt, max_tokens)
     
     def generate_with_context(self, question: str, context: str,
                             max_tokens: Optional[int] = None) -> str:
@@ -319,25 +759,43 @@ Respuesta:"""
             finally:
                 loop.close()
     
-    async def chat_completion_async(self, messages: List[Dict[str, str]]) -> GenerationResult:
-        """Completado de chat estilo OpenAI (versión async)"""
+    async def chat_completion_async(self, messages: List[Dict[str, str]],
+                                    tag: Optional[str] = "chat") -> GenerationResult:
+        """Completado de chat estilo OpenAI (versión async)
         
-        # Convertir mensajes a prompt único
-        prompt = ""
-        for message in messages:
-            role = message.get("role", "user")
-            content = message.get("content", "")
-            
-            if role == "system":
-                prompt += f"Sistema: {content}\n\n"
-            elif role == "user":
-                prompt += f"Usuario: {content}\n\n"
-            elif role == "assistant":
-                prompt += f"Asistente: {content}\n\n"
+        El estado KV del mensaje de sistema solo se reutiliza si se registró
+        antes (register_prefix o register_agent): registrar cada mensaje de
+        sistema recibido haría crecer los prefijos sin límite.
+        """
         
+        # Convertir mensajes a prompt único
+        prompt = "".join(
+            self._format_message(message.get("role", "user"), message.get("content", ""))
+            for message in messages
+        )
         prompt += "Asistente:"
         
-        return await self.generate_async(prompt)
+        return await self.generate_async(prompt, tag=tag)
+    
+    @staticmethod
+    def _format_message(role: str, content: str) -> str:
+        """Mensaje de chat en el formato del prompt único"""
+        labels = {"system": "Sistema", "user": "Usuario", "assistant": "Asistente"}
+        if role not in labels:
+            return ""
+        return f"{labels[role]}: {content}\n\n"
+    
+    def call(self, messages: Union[str, List[Dict[str, str]]], tools: Optional[List[Any]] = None,
+             callbacks: Optional[List[Any]] = None,
+             available_functions: Optional[Dict[str, Any]] = None, **kwargs) -> str:
+        """Llamada con la interfaz de LLM de CrewAI (texto o mensajes, devuelve texto)
+        
+        Los agentes registrados con register_agent reutilizan el estado KV
+        del inicio de su mensaje de sistema.
+        """
+        if isinstance(messages, str):
+            messages = [{"role": "user", "content": messages}]
+        return self.chat_completion(messages)
     
     def chat_completion(self, messages: List[Dict[str, str]]) -> str:
         """Completado de chat estilo OpenAI (versión sync)"""
@@ -371,6 +829,11 @@ Respuesta:"""
             success_rate = (self.stats['successful_generations'] / total_generations) * 100
             avg_processing_time = self.stats['total_processing_time'] / total_generations
         
+        avg_time_to_first_token = 0
+        if self.stats['streamed_generations'] > 0:
+            avg_time_to_first_token = (self.stats['total_time_to_first_token'] /
+                                       self.stats['streamed_generations'])
+        
         total_cache_requests = self.stats['cache_hits'] + self.stats['cache_misses']
         if total_cache_requests > 0:
             cache_hit_rate = (self.stats['cache_hits'] / total_cache_requests) * 100
@@ -385,18 +848,28 @@ Respuesta:"""
             'failed_generations': self.stats['failed_generations'],
             'success_rate': round(success_rate, 2),
             'total_tokens_generated': self.stats['total_tokens_generated'],
+            'total_prompt_tokens': self.stats['total_prompt_tokens'],
             'avg_processing_time': round(avg_processing_time, 2),
             'active_generations': self.active_generations,
+            'streamed_generations': self.stats['streamed_generations'],
+            'cancelled_generations': self.stats['cancelled_generations'],
+            'avg_time_to_first_token': round(avg_time_to_first_token, 3),
             'cache_enabled': self.enable_cache,
-            'cache_size': len(self.response_cache) if self.response_cache else 0,
+            'cache_size': len(self.response_cache) if self.response_cache is not None else 0,
             'cache_hit_rate': round(cache_hit_rate, 2),
             'cache_hits': self.stats['cache_hits'],
-            'cache_misses': self.stats['cache_misses']
+            'cache_misses': self.stats['cache_misses'],
+            'cache': self.response_cache.get_stats() if self.response_cache is not None else None,
+            'worker': self.worker.get_stats() if self.worker else None,
+            'prefix_cache': self.prefix_cache.get_stats() if self.prefix_cache else None,
+            # Tokens del tokenizer, tiempos de llama.cpp y latencias p50/p95/p99
+            'usage': self.metrics.totals(),
+            'usage_by_tag': self.metrics.get_stats()
         }
     
     def clear_cache(self):
         """Limpia el cache de respuestas"""
-        if self.response_cache:
+        if self.response_cache is not None:
             self.response_cache.clear()
             self.logger.info("Cache de respuestas limpiado")
     
@@ -405,7 +878,10 @@ Respuesta:"""
         if new_model_path:
             self.model_path = new_model_path
         
-        # Limpiar modelo actual
+        # Detener el worker (espera a la generación en curso) y limpiar modelo actual
+        if self.worker:
+            self.worker.stop()
+            self.worker = None
         if self.model:
             del self.model
             self.model = None
@@ -430,5 +906,7 @@ Respuesta:"""
     
     def __del__(self):
         """Cleanup al destruir la instancia"""
+        if getattr(self, 'worker', None):
+            self.worker.stop(wait=False)
         if self.model:
             del self.model
\ No newline at end of file
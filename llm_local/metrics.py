@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Metricas de generacion del LLM por etiqueta de llamador.
+
+Los tokens se cuentan con el tokenizer del modelo (o con el uso que
+devuelve llama.cpp) y los tiempos separan la evaluacion del prompt de la
+generacion, asi que tokens/s y latencias sirven para dimensionar CPU.
+Las latencias se resumen en percentiles sobre una ventana de las ultimas
+peticiones y en un histograma acumulado por cubetas.
+"""
+import math
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Any, Optional, List, Deque
+
+# Limites superiores (ms) de las cubetas del histograma de latencia
+LATENCY_BUCKETS_MS = (100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000)
+
+@dataclass
+class GenerationUsage:
+    """Tokens y tiempos de una generacion"""
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    prompt_eval_ms: Optional[float] = None
+    generation_ms: Optional[float] = None
+    # Tokens del prompt realmente evaluados (sin el prefijo reutilizado)
+    prompt_eval_tokens: Optional[int] = None
+
+def percentile(values: List[float], percent: float) -> float:
+    """Percentil por rango mas cercano"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(percent / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+class _TagMetrics:
+    def __init__(self, window: int):
+        self.requests = 0
+        self.failed = 0
+        self.cached = 0
+        self.prompt_tokens = 0
+        self.prompt_eval_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.prompt_eval_ms = 0.0
+        self.generation_ms = 0.0
+        self.timed_prompt_tokens = 0
+        self.timed_completion_tokens = 0
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe_latency(self, latency_ms: float):
+        self.latencies.append(latency_ms)
+        for index, bound in enumerate(LATENCY_BUCKETS_MS):
+            if latency_ms <= bound:
+                self.histogram[index] += 1
+                return
+        self.histogram[-1] += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        latencies = list(self.latencies)
+        generation_seconds = self.generation_ms / 1000
+        prompt_seconds = self.prompt_eval_ms / 1000
+        labels = [f"<={bound}" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}"]
+        return {
+            'requests': self.requests,
+            'failed': self.failed,
+            'cached': self.cached,
+            'prompt_tokens': self.prompt_tokens,
+            'prompt_eval_tokens': self.prompt_eval_tokens,
+            'completion_tokens': self.completion_tokens,
+            'cached_tokens': self.cached_tokens,
+            'prompt_eval_ms': round(self.prompt_eval_ms, 1),
+            'generation_ms': round(self.generation_ms, 1),
+            'prompt_tokens_per_second': round(self.timed_prompt_tokens / prompt_seconds, 2)
+            if prompt_seconds > 0 else 0.0,
+            'tokens_per_second': round(self.timed_completion_tokens / generation_seconds, 2)
+            if generation_seconds > 0 else 0.0,
+            'latency_ms': {
+                'p50': round(percentile(latencies, 50), 1),
+                'p95': round(percentile(latencies, 95), 1),
+                'p99': round(percentile(latencies, 99), 1),
+                'samples': len(latencies),
+                'histogram': dict(zip(labels, self.histogram))
+            }
+        }
+
+class GenerationMetrics:
+    """Acumula uso y latencias por etiqueta de llamador (thread-safe)"""
+
+    def __init__(self, window: int = 2048):
+        self.window = window
+        self._lock = threading.Lock()
+        self._tags: Dict[str, _TagMetrics] = {}
+
+    def _tag(self, tag: Optional[str]) -> _TagMetrics:
+        tag = tag or "default"
+        if tag not in self._tags:
+            self._tags[tag] = _TagMetrics(self.window)
+        return self._tags[tag]
+
+    def record(self, tag: Optional[str], latency_seconds: float,
+               usage: Optional[GenerationUsage] = None,
+               cached: bool = False, success: bool = True):
+        """Registra una peticion terminada (generada, servida del cache o fallida)"""
+        with self._lock:
+            metrics = self._tag(tag)
+            metrics.requests += 1
+            metrics.observe_latency(latency_seconds * 1000)
+            if not success:
+                metrics.failed += 1
+                return
+            if cached:
+                metrics.cached += 1
+                metrics.cached_tokens += usage.completion_tokens if usage else 0
+                return
+            if usage is None:
+                return
+            metrics.prompt_tokens += usage.prompt_tokens
+            metrics.completion_tokens += usage.completion_tokens
+            evaluated = (usage.prompt_eval_tokens if usage.prompt_eval_tokens is not None
+                         else usage.prompt_tokens)
+            metrics.prompt_eval_tokens += evaluated
+            if usage.prompt_eval_ms is not None:
+                metrics.prompt_eval_ms += usage.prompt_eval_ms
+                metrics.timed_prompt_tokens += evaluated
+            if usage.generation_ms is not None:
+                metrics.generation_ms += usage.generation_ms
+                metrics.timed_completion_tokens += usage.completion_tokens
+
+    def totals(self) -> Dict[str, Any]:
+        """Suma de todas las etiquetas"""
+        with self._lock:
+            total = _TagMetrics(self.window * max(1, len(self._tags)))
+            for metrics in self._tags.values():
+                for name in ('requests', 'failed', 'cached', 'prompt_tokens',
+                             'prompt_eval_tokens', 'completion_tokens', 'cached_tokens',
+                             'prompt_eval_ms', 'generation_ms', 'timed_prompt_tokens',
+                             'timed_completion_tokens'):
+                    setattr(total, name, getattr(total, name) + getattr(metrics, name))
+                total.latencies.extend(metrics.latencies)
+                total.histogram = [a + b for a, b in zip(total.histogram, metrics.histogram)]
+            return total.to_dict()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Metricas por etiqueta"""
+        with self._lock:
+            return {tag: metrics.to_dict() for tag, metrics in sorted(self._tags.items())}
+
+    def reset(self):
+        with self._lock:
+            self._tags.clear()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Cache de estados KV para prefijos fijos de los prompts.
+
+Los prompts de los agentes repiten prefijos largos (instrucciones, rol y
+trasfondo del agente). Tras evaluar un prefijo registrado se guarda el
+estado del modelo (save_state de llama.cpp); al llegar otro prompt que
+empieza por ese prefijo se restaura el estado y llama.cpp solo evalua el
+resto. Los estados viven en un LRU en memoria acotado en bytes y, si se
+indica un directorio, los desalojados se guardan en disco.
+"""
+import os
+import pickle
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple, Sequence
+
+class PrefixStateCache:
+    """Prefijos registrados (en tokens) y LRU de sus estados del modelo"""
+
+    def __init__(self, max_memory_bytes: int = 512 * 1024 * 1024,
+                 spill_directory: Optional[str] = None,
+                 max_disk_bytes: int = 2 * 1024 * 1024 * 1024,
+                 min_prefix_tokens: int = 16):
+        self.max_memory_bytes = max_memory_bytes
+        self.spill_directory = spill_directory
+        self.max_disk_bytes = max_disk_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.RLock()
+
+        self.prefixes: set = set()
+        # prefijo (tupla de tokens) -> (estado, bytes)
+        self._states: "OrderedDict[Tuple[int, ...], Tuple[Any, int]]" = OrderedDict()
+        self._memory_bytes = 0
+
+        self.stats = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'evaluations': 0,
+            'live_reuses': 0,
+            'tokens_skipped': 0,
+            'evictions': 0
+        }
+        if spill_directory:
+            os.makedirs(spill_directory, exist_ok=True)
+
+    def register(self, tokens: Sequence[int]) -> bool:
+        """Registra un prefijo ya tokenizado; los muy cortos no compensan"""
+        tokens = tuple(tokens)
+        if len(tokens) < self.min_prefix_tokens:
+            return False
+        with self._lock:
+            self.prefixes.add(tokens)
+        return True
+
+    def longest_match(self, tokens: Sequence[int]) -> Optional[Tuple[int, ...]]:
+        """Prefijo registrado mas largo con el que empieza tokens"""
+        best = None
+        with self._lock:
+            for prefix in self.prefixes:
+                if (len(prefix) < len(tokens)
+                        and (best is None or len(prefix) > len(best))
+                        and tuple(tokens[:len(prefix)]) == prefix):
+                    best = prefix
+        return best
+
+    # ------------------------------------------------------------------
+    # Estados
+    # ------------------------------------------------------------------
+
+    def _spill_path(self, prefix: Tuple[int, ...]) -> str:
+        digest = hashlib.sha1(repr(prefix).encode()).hexdigest()
+        return os.path.join(self.spill_directory, f"{digest}.state")
+
+    def get(self, prefix: Tuple[int, ...]) -> Optional[Any]:
+        """Estado guardado del prefijo (memoria, luego disco)"""
+        with self._lock:
+            entry = self._states.get(prefix)
+            if entry is not None:
+                self._states.move_to_end(prefix)
+                self.stats['memory_hits'] += 1
+                return entry[0]
+            if not self.spill_directory:
+                return None
+            path = self._spill_path(prefix)
+            if not os.path.exists(path):
+                return None
+            try:
+                with open(path, 'rb') as file:
+                    stored_prefix, state = pickle.load(file)
+                if stored_prefix != prefix:
+                    return None
+                os.utime(path)
+            except Exception as e:
+                self.logger.error(f"Error cargando estado de prefijo: {str(e)}")
+                return None
+            self.stats['disk_hits'] += 1
+            self._remember(prefix, state)
+            return state
+
+    def put(self, prefix: Tuple[int, ...], state: Any):
+        with self._lock:
+            self.stats['evaluations'] += 1
+            self._remember(prefix, state)
+
+    def _remember(self, prefix: Tuple[int, ...], state: Any):
+        # Estado KV mas los logits e ids que guarda save_state
+        size = int(getattr(state, 'llama_state_size', 0))
+        for array in (getattr(state, 'scores', None), getattr(state, 'input_ids', None)):
+            size += int(getattr(array, 'nbytes', 0))
+        size = size or len(prefix)
+        if size > self.max_memory_bytes:
+            self._spill(prefix, state)
+            return
+        previous = self._states.pop(prefix, None)
+        if previous is not None:
+            self._memory_bytes -= previous[1]
+        self._states[prefix] = (state, size)
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_memory_bytes:
+            evicted_prefix, (evicted, evicted_size) = self._states.popitem(last=False)
+            self._memory_bytes -= evicted_size
+            self.stats['evictions'] += 1
+            self._spill(evicted_prefix, evicted)
+
+    def _spill(self, prefix: Tuple[int, ...], state: Any):
+        """Guarda en disco un estado desalojado de memoria"""
+        if not self.spill_directory:
+            return
+        path = self._spill_path(prefix)
+        if os.path.exists(path):
+            return
+        try:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as file:
+                pickle.dump((prefix, state), file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            self._trim_disk()
+        except Exception as e:
+            self.logger.error(f"Error guardando estado de prefijo: {str(e)}")
+
+    def _trim_disk(self):
+        """Elimina los estados menos usados si el directorio supera su limite"""
+        files = []
+        for name in os.listdir(self.spill_directory):
+            if name.endswith(".state"):
+                path = os.path.join(self.spill_directory, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def record_reuse(self, prefix: Tuple[int, ...], live: bool):
+        with self._lock:
+            self.stats['tokens_skipped'] += len(prefix)
+            if live:
+                self.stats['live_reuses'] += 1
+
+    def clear(self):
+        """Olvida prefijos y estados (p. ej. al cambiar de modelo)"""
+        with self._lock:
+            self.prefixes.clear()
+            self._states.clear()
+            self._memory_bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            disk_states = 0
+            if self.spill_directory and os.path.isdir(self.spill_directory):
+                disk_states = sum(1 for name in os.listdir(self.spill_directory)
+                                  if name.endswith(".state"))
+            return {
+                **self.stats,
+                'registered_prefixes': len(self.prefixes),
+                'memory_states': len(self._states),
+                'memory_bytes': self._memory_bytes,
+                'max_memory_bytes': self.max_memory_bytes,
+                'disk_states': disk_states
+            }
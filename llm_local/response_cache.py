@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Cache persistente de respuestas del LLM.
+
+Dos niveles: un LRU en memoria acotado en bytes y un almacen SQLite en
+disco con TTL y tamaño maximo. La clave combina la huella del archivo del
+modelo, el hash del prompt y los parametros de muestreo, de modo que las
+respuestas sobreviven a reinicios pero nunca se sirven con otro modelo.
+"""
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+CACHE_FILENAME = "llm_responses.sqlite3"
+_FINGERPRINT_BLOCK = 4 * 1024 * 1024
+
+def model_fingerprint(model_path: str) -> str:
+    """Huella del archivo del modelo (tamaño, inicio y final del archivo)
+
+    Hashear un GGUF de varios GB en cada arranque es demasiado lento; la
+    cabecera, el final y el tamaño bastan para distinguir modelos y
+    cuantizaciones distintas.
+    """
+    digest = hashlib.sha256()
+    size = os.path.getsize(model_path)
+    digest.update(str(size).encode())
+    with open(model_path, 'rb') as file:
+        digest.update(file.read(_FINGERPRINT_BLOCK))
+        if size > 2 * _FINGERPRINT_BLOCK:
+            file.seek(-_FINGERPRINT_BLOCK, os.SEEK_END)
+            digest.update(file.read(_FINGERPRINT_BLOCK))
+    return digest.hexdigest()
+
+class ResponseCache:
+    """LRU en memoria (bytes) respaldado por SQLite (TTL y tamaño maximo)"""
+
+    def __init__(self, cache_dir: Optional[str] = None,
+                 max_memory_bytes: int = 32 * 1024 * 1024,
+                 max_disk_bytes: int = 512 * 1024 * 1024,
+                 ttl_seconds: Optional[float] = 30 * 24 * 3600):
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.RLock()
+
+        # clave -> (respuesta, bytes, creada)
+        self._memory: "OrderedDict[str, Tuple[str, int, float]]" = OrderedDict()
+        self._memory_bytes = 0
+
+        self.stats = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'memory_evictions': 0,
+            'disk_evictions': 0
+        }
+
+        self.path = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._disk_bytes = 0
+        if cache_dir:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                self.path = os.path.join(cache_dir, CACHE_FILENAME)
+                self._conn = sqlite3.connect(self.path, check_same_thread=False)
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    " key TEXT PRIMARY KEY,"
+                    " response BLOB NOT NULL,"
+                    " size INTEGER NOT NULL,"
+                    " created REAL NOT NULL,"
+                    " accessed REAL NOT NULL)"
+                )
+                self._conn.execute(
+                    "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+                )
+                self._conn.commit()
+                self._purge_expired()
+                self._disk_bytes = self._conn.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM responses"
+                ).fetchone()[0]
+            except Exception as e:
+                self.logger.error(f"Error abriendo cache de respuestas en disco: {str(e)}")
+                self._conn = None
+
+    @staticmethod
+    def make_key(model_hash: str, prompt: str, params: Dict[str, Any]) -> str:
+        """Clave (huella del modelo, hash del prompt, parametros de muestreo)"""
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        encoded = json.dumps([model_hash, prompt_hash, params], sort_keys=True)
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def _expired(self, created: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - created > self.ttl_seconds
+
+    # ------------------------------------------------------------------
+    # Memoria
+    # ------------------------------------------------------------------
+
+    def _remember(self, key: str, response: str, created: float):
+        size = len(response.encode('utf-8')) + len(key)
+        if size > self.max_memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= previous[1]
+        self._memory[key] = (response, size, created)
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_memory_bytes:
+            _, (_, evicted, _) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted
+            self.stats['memory_evictions'] += 1
+
+    def _forget(self, key: str):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= entry[1]
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+
+    def get(self, key: str) -> Optional[str]:
+        """Respuesta cacheada (memoria, luego disco) o None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[2], now):
+                    self._memory.move_to_end(key)
+                    self.stats['memory_hits'] += 1
+                    return entry[0]
+                self._forget(key)
+                self.stats['expired'] += 1
+
+            if self._conn is not None:
+                try:
+                    row = self._conn.execute(
+                        "SELECT response, created FROM responses WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row is not None:
+                        if self._expired(row[1], now):
+                            self._delete_disk(key)
+                            self.stats['expired'] += 1
+                        else:
+                            response = zlib.decompress(row[0]).decode('utf-8')
+                            self._conn.execute(
+                                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+                            )
+                            self._conn.commit()
+                            self._remember(key, response, row[1])
+                            self.stats['disk_hits'] += 1
+                            return response
+                except Exception as e:
+                    self.logger.error(f"Error leyendo cache de respuestas: {str(e)}")
+
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, key: str, response: str):
+        """Guarda una respuesta en memoria y en disco"""
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now)
+            if self._conn is None:
+                return
+            try:
+                blob = zlib.compress(response.encode('utf-8'))
+                previous = self._conn.execute(
+                    "SELECT size FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (key, blob, len(blob), now, now)
+                )
+                self._conn.commit()
+                self._disk_bytes += len(blob) - (previous[0] if previous else 0)
+                if self._disk_bytes > self.max_disk_bytes:
+                    self._evict_disk()
+            except Exception as e:
+                self.logger.error(f"Error guardando cache de respuestas: {str(e)}")
+
+    def _delete_disk(self, key: str):
+        row = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._conn.commit()
+            self._disk_bytes -= row[0]
+
+    def _evict_disk(self):
+        """Elimina las entradas menos usadas hasta quedar en el 90% del limite"""
+        target = int(self.max_disk_bytes * 0.9)
+        evicted = []
+        for key, size in self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY accessed"):
+            if self._disk_bytes <= target:
+                break
+            evicted.append((key,))
+            self._disk_bytes -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self._conn.commit()
+        self.stats['disk_evictions'] += len(evicted)
+
+    def _purge_expired(self):
+        if self.ttl_seconds is None:
+            return
+        cursor = self._conn.execute(
+            "DELETE FROM responses WHERE created < ?", (time.time() - self.ttl_seconds,)
+        )
+        self._conn.commit()
+        self.stats['expired'] += cursor.rowcount
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM responses")
+                self._conn.commit()
+                self._disk_bytes = 0
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            if self._conn is not None:
+                return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return len(self._memory)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Entradas y bytes por nivel, aciertos y desalojos"""
+        with self._lock:
+            lookups = self.stats['memory_hits'] + self.stats['disk_hits'] + self.stats['misses']
+            hits = lookups - self.stats['misses']
+            return {
+                **self.stats,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'max_memory_bytes': self.max_memory_bytes,
+                'disk_entries': len(self) if self._conn is not None else 0,
+                'disk_bytes': self._disk_bytes,
+                'max_disk_bytes': self.max_disk_bytes,
+                'ttl_seconds': self.ttl_seconds,
+                'path': self.path,
+                'hit_rate': round(hits / lookups, 4) if lookups else 0.0
+            }
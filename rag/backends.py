@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Backends de almacenamiento vectorial para el VectorStore.
+
+Todos exponen el subconjunto de la API de colecciones de ChromaDB que usa el
+VectorStore (upsert, get, update, delete, query, count) con el mismo formato
+de resultados, de modo que se pueden intercambiar y comparar directamente.
+"""
+import os
+import logging
+from typing import List, Dict, Any, Optional
+
+from .registry import get_chroma_client
+
+class VectorBackend:
+    """Interfaz comun de los backends vectoriales"""
+
+    name = "base"
+    # Directorio donde viven los datos auxiliares de la coleccion (manifiesto, BM25)
+    data_directory: str = ""
+
+    def upsert(self, ids: List[str], documents: List[str],
+               metadatas: List[Dict[str, Any]], embeddings: Any):
+        raise NotImplementedError
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict[str, Any]] = None,
+            include: Optional[List[str]] = None) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def update(self, ids: List[str], metadatas: List[Dict[str, Any]]):
+        raise NotImplementedError
+
+    def delete(self, ids: List[str]):
+        raise NotImplementedError
+
+    def query(self, query_embeddings: Any, n_results: int = 5,
+              where: Optional[Dict[str, Any]] = None,
+              include: Optional[List[str]] = None) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def flush(self):
+        """Persiste las escrituras pendientes (los backends que escriben al momento no hacen nada)"""
+
+    def close(self):
+        """Libera recursos al cerrar el proyecto (los datos ya estan persistidos)"""
+
+class ChromaBackend(VectorBackend):
+    """Backend sobre una coleccion persistente de ChromaDB"""
+
+    name = "chroma"
+
+    def __init__(self, persist_directory: str, collection_name: str,
+                 metadata: Optional[Dict[str, Any]] = None,
+                 data_directory: Optional[str] = None):
+        self.client = get_chroma_client(persist_directory)
+        # Cada proyecto guarda sus datos auxiliares en su propio directorio
+        self.data_directory = data_directory or persist_directory
+        os.makedirs(self.data_directory, exist_ok=True)
+        self.collection_name = collection_name
+        try:
+            self.collection = self.client.get_collection(name=collection_name)
+        except Exception:
+            self.collection = self.client.create_collection(
+                name=collection_name, metadata=metadata
+            )
+
+    @staticmethod
+    def _to_chroma(embeddings: Any) -> Any:
+        """Adapta matrices numpy al formato aceptado por ChromaDB 0.4"""
+        return embeddings.tolist() if hasattr(embeddings, "tolist") else embeddings
+
+    def upsert(self, ids, documents, metadatas, embeddings):
+        self.collection.upsert(
+            ids=ids, documents=documents, metadatas=metadatas,
+            embeddings=self._to_chroma(embeddings)
+        )
+
+    def get(self, ids=None, where=None, include=None):
+        kwargs = {"include": include if include is not None else ["documents", "metadatas"]}
+        if ids is not None:
+            kwargs["ids"] = ids
+        if where:
+            kwargs["where"] = where
+        return self.collection.get(**kwargs)
+
+    def update(self, ids, metadatas):
+        self.collection.update(ids=ids, metadatas=metadatas)
+
+    def delete(self, ids):
+        self.collection.delete(ids=ids)
+
+    def query(self, query_embeddings, n_results=5, where=None, include=None):
+        return self.collection.query(
+            query_embeddings=self._to_chroma(query_embeddings),
+            n_results=n_results,
+            where=where,
+            include=include if include is not None else ["documents", "metadatas", "distances"]
+        )
+
+    def count(self) -> int:
+        return self.collection.count()
+
+def create_backend(kind: str, persist_directory: str, collection_name: str,
+                   metadata: Optional[Dict[str, Any]] = None, **options) -> VectorBackend:
+    """Crea el backend indicado ("chroma" o "numpy")"""
+    if kind == "numpy":
+        from .numpy_index import NumpyBackend
+        return NumpyBackend(persist_directory, collection_name, **options)
+    if kind != "chroma":
+        logging.getLogger(__name__).warning(f"Backend {kind} desconocido, usando chroma")
+    return ChromaBackend(persist_directory, collection_name, metadata,
+                         data_directory=options.get("data_directory"))
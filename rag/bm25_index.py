@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Indice invertido con puntuacion BM25.
+
+Complementa la busqueda vectorial para nombres propios inventados (Aethermoor,
+Malachar, Umiel...) que el modelo de embeddings representa mal. Se mantiene
+sincronizado con la coleccion de ChromaDB y se persiste junto a ella.
+
+Las busquedas se resuelven en memoria; en disco cada documento es una fila
+SQLite con sus frecuencias de terminos, de modo que save() solo escribe los
+documentos añadidos o eliminados desde el ultimo guardado.
+"""
+import os
+import re
+import json
+import math
+import heapq
+import sqlite3
+import logging
+import threading
+import unicodedata
+from collections import Counter
+from typing import List, Dict, Any, Optional, Tuple, Iterable
+
+INDEX_FILENAME = "bm25_index.sqlite3"
+INDEX_VERSION = 1
+
+_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+def tokenize(text: str) -> List[str]:
+    """Minusculas, sin acentos y separado en palabras"""
+    normalized = unicodedata.normalize("NFKD", text.lower())
+    normalized = "".join(char for char in normalized if not unicodedata.combining(char))
+    return [token for token in _TOKEN_PATTERN.findall(normalized) if len(token) > 1]
+
+class BM25Index:
+    """Indice invertido en memoria con persistencia incremental en SQLite"""
+
+    def __init__(self, persist_directory: str, k1: float = 1.5, b: float = 0.75):
+        self.path = os.path.join(persist_directory, INDEX_FILENAME)
+        self.k1 = k1
+        self.b = b
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.RLock()
+
+        # termino -> {doc_id: frecuencia}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        # doc_id -> (longitud, doc_type, terminos)
+        self.documents: Dict[str, Tuple[int, Optional[str], Tuple[str, ...]]] = {}
+        self.total_length = 0
+
+        # Cambios pendientes de guardar (ver save)
+        self._connection: Optional[sqlite3.Connection] = None
+        self._changed: set = set()
+        self._removed: set = set()
+        self._reset = False
+
+        self.load()
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    # ------------------------------------------------------------------
+    # Persistencia
+    # ------------------------------------------------------------------
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """Conexion abierta bajo demanda (se reabre tras close)"""
+        with self._lock:
+            if self._connection is None:
+                self._connection = sqlite3.connect(self.path, check_same_thread=False)
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS documents ("
+                    " id TEXT PRIMARY KEY,"
+                    " length INTEGER NOT NULL,"
+                    " doc_type TEXT,"
+                    " terms TEXT NOT NULL)"
+                )
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)"
+                )
+                self._connection.commit()
+            return self._connection
+
+    def load(self):
+        """Carga el indice desde disco"""
+        with self._lock:
+            if not os.path.exists(self.path):
+                return
+            try:
+                meta = dict(self._conn.execute("SELECT key, value FROM meta"))
+                if meta and meta.get("version") != INDEX_VERSION:
+                    self._reset = True
+                    return
+                for doc_id, length, doc_type, terms in self._conn.execute(
+                        "SELECT id, length, doc_type, terms FROM documents"):
+                    counts = json.loads(terms)
+                    self.documents[doc_id] = (length, doc_type, tuple(counts))
+                    self.total_length += length
+                    for term, frequency in counts.items():
+                        self.postings.setdefault(term, {})[doc_id] = frequency
+            except Exception as e:
+                self.logger.error(f"Error cargando indice BM25: {str(e)}")
+                self.postings, self.documents, self.total_length = {}, {}, 0
+                self._reset = True
+
+    def _row(self, doc_id: str) -> tuple:
+        length, doc_type, terms = self.documents[doc_id]
+        counts = {term: self.postings[term][doc_id] for term in terms}
+        return (doc_id, length, doc_type, json.dumps(counts, ensure_ascii=False))
+
+    def save(self):
+        """Guarda los documentos añadidos o eliminados desde el ultimo guardado"""
+        with self._lock:
+            if not (self._reset or self._changed or self._removed):
+                return
+            try:
+                with self._conn:
+                    if self._reset:
+                        self._conn.execute("DELETE FROM documents")
+                    self._conn.executemany(
+                        "DELETE FROM documents WHERE id = ?", [(doc_id,) for doc_id in self._removed]
+                    )
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)",
+                        [self._row(doc_id) for doc_id in self._changed]
+                    )
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO meta VALUES ('version', ?)", (INDEX_VERSION,)
+                    )
+                self._reset = False
+                self._changed.clear()
+                self._removed.clear()
+            except Exception as e:
+                self.logger.error(f"Error guardando indice BM25: {str(e)}")
+
+    def close(self):
+        with self._lock:
+            self.save()
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    # ------------------------------------------------------------------
+    # Mantenimiento
+    # ------------------------------------------------------------------
+
+    def add(self, doc_id: str, text: str, metadata: Optional[Dict[str, Any]] = None):
+        """Añade (o reemplaza) un documento en el indice"""
+        with self._lock:
+            if doc_id in self.documents:
+                self._remove_one(doc_id)
+            counts = Counter(tokenize(text))
+            length = sum(counts.values())
+            doc_type = (metadata or {}).get("doc_type")
+            self.documents[doc_id] = (length, doc_type, tuple(counts.keys()))
+            self.total_length += length
+            for term, frequency in counts.items():
+                self.postings.setdefault(term, {})[doc_id] = frequency
+            self._changed.add(doc_id)
+            self._removed.discard(doc_id)
+
+    def add_many(self, ids: List[str], texts: List[str], metadatas: List[Dict[str, Any]]):
+        for doc_id, text, metadata in zip(ids, texts, metadatas):
+            self.add(doc_id, text, metadata)
+
+    def remove(self, doc_ids: Iterable[str]):
+        """Elimina documentos del indice"""
+        with self._lock:
+            for doc_id in doc_ids:
+                if doc_id in self.documents:
+                    self._remove_one(doc_id)
+                    self._changed.discard(doc_id)
+                    self._removed.add(doc_id)
+
+    def _remove_one(self, doc_id: str):
+        length, _, terms = self.documents.pop(doc_id)
+        self.total_length -= length
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            posting.pop(doc_id, None)
+            if not posting:
+                del self.postings[term]
+
+    def clear(self):
+        with self._lock:
+            self.postings, self.documents, self.total_length = {}, {}, 0
+            self._changed.clear()
+            self._removed.clear()
+            self._reset = True
+
+    # ------------------------------------------------------------------
+    # Busqueda
+    # ------------------------------------------------------------------
+
+    def search(self, query: str, k: int = 5,
+               doc_type: Optional[str] = None) -> List[Tuple[str, float]]:
+        """Devuelve los k documentos con mayor puntuacion BM25"""
+        with self._lock:
+            total_docs = len(self.documents)
+            if total_docs == 0:
+                return []
+            avg_length = self.total_length / total_docs
+            scores: Dict[str, float] = {}
+
+            for term in set(tokenize(query)):
+                posting = self.postings.get(term)
+                if not posting:
+                    continue
+                df = len(posting)
+                idf = math.log(1 + (total_docs - df + 0.5) / (df + 0.5))
+                for doc_id, frequency in posting.items():
+                    length, entry_type, _ = self.documents[doc_id]
+                    if doc_type and entry_type != doc_type:
+                        continue
+                    norm = self.k1 * (1 - self.b + self.b * length / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+            return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "documents": len(self.documents),
+                "terms": len(self.postings)
+            }
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Chunking consciente de la estructura de los manuscritos.
+
+Convierte el texto en una secuencia de bloques (parrafos, encabezados y
+separadores de escena) y agrupa los parrafos en chunks medidos en tokens
+del modelo de embeddings sin cruzar nunca un cambio de capitulo, seccion
+o escena. Cada chunk lleva en sus metadatos el capitulo, la seccion y el
+numero de escena a los que pertenece.
+"""
+import re
+from dataclasses import dataclass
+from typing import List, Dict, Any, Optional, Callable, Iterable, Iterator, Tuple
+
+# Encabezados de capitulo reconocibles por su texto ("Capitulo IV", "Prologo", "Acto 2: ...")
+CHAPTER_PATTERN = re.compile(
+    r'^(?:(?:cap[ií]tulo|chapter|parte|part|libro|book|acto|act)\s+'
+    r'(?:\d+|[ivxlcdm]+|uno|dos|tres|cuatro|cinco|seis|siete|ocho|nueve|diez|'
+    r'one|two|three|four|five|six|seven|eight|nine|ten|primer[oa]?|segund[oa]|tercer[oa]?)\b'
+    r'|(?:pr[oó]logo|prologue|ep[ií]logo|epilogue|interludio|interlude)\b)',
+    re.IGNORECASE
+)
+# Separadores de escena: "***", "* * *", "---", "###", "~~~"
+SCENE_BREAK_PATTERN = re.compile(r'^\s*(?:(?:\*\s*){3,}|(?:-\s*){3,}|(?:#\s*){3,}|(?:~\s*){3,})$')
+MARKDOWN_HEADING_PATTERN = re.compile(r'^(#{1,6})\s+(.+?)\s*#*\s*$')
+_SENTENCE_SPLIT = re.compile(r'(?<=[.!?…])\s+')
+
+# Longitud maxima de una linea para considerarla encabezado
+MAX_HEADING_CHARS = 80
+MAX_HEADING_WORDS = 12
+# Parrafos de texto plano sin lineas en blanco se cortan a este tamaño
+MAX_PARAGRAPH_CHARS = 8000
+
+@dataclass
+class Block:
+    """Unidad estructural del documento"""
+    text: str = ""
+    kind: str = "text"  # text, heading, scene_break
+    level: int = 0      # 1 = capitulo, 2+ = seccion
+
+def is_short_line(line: str) -> bool:
+    """Indica si una linea tiene la longitud de un titulo"""
+    return 0 < len(line) <= MAX_HEADING_CHARS and len(line.split()) <= MAX_HEADING_WORDS
+
+def is_chapter_heading(line: str) -> bool:
+    """Indica si una linea corta parece el titulo de un capitulo"""
+    line = line.strip()
+    return is_short_line(line) and bool(CHAPTER_PATTERN.match(line))
+
+def is_scene_break(line: str) -> bool:
+    return bool(SCENE_BREAK_PATTERN.match(line))
+
+def text_blocks(lines: Iterable[str]) -> Iterator[Block]:
+    """Agrupa lineas de texto plano en parrafos, capitulos y escenas"""
+    paragraph: List[str] = []
+    size = 0
+
+    def flush():
+        nonlocal size
+        if paragraph:
+            text = " ".join(paragraph)
+            paragraph.clear()
+            size = 0
+            return Block(text)
+        return None
+
+    for line in lines:
+        stripped = line.strip()
+        if size >= MAX_PARAGRAPH_CHARS:
+            yield flush()
+        if not stripped:
+            block = flush()
+            if block:
+                yield block
+            continue
+        if is_scene_break(stripped) or is_chapter_heading(stripped):
+            block = flush()
+            if block:
+                yield block
+            if is_scene_break(stripped):
+                yield Block(kind="scene_break")
+            else:
+                yield Block(stripped, kind="heading", level=1)
+            continue
+        paragraph.append(stripped)
+        size += len(stripped)
+
+    block = flush()
+    if block:
+        yield block
+
+def markdown_blocks(lines: Iterable[str]) -> Iterator[Block]:
+    """Divide Markdown en secciones por encabezados ('#'), escenas y parrafos"""
+    paragraph: List[str] = []
+    in_code = False
+
+    def flush():
+        if paragraph:
+            text = "\n".join(paragraph)
+            paragraph.clear()
+            return Block(text)
+        return None
+
+    for line in lines:
+        stripped = line.rstrip("\n").strip()
+        if stripped.startswith("```"):
+            in_code = not in_code
+            paragraph.append(stripped)
+            continue
+        if in_code:
+            paragraph.append(line.rstrip("\n"))
+            continue
+
+        heading = MARKDOWN_HEADING_PATTERN.match(stripped)
+        if heading or is_scene_break(stripped) or not stripped:
+            block = flush()
+            if block:
+                yield block
+            if heading:
+                yield Block(heading.group(2), kind="heading", level=len(heading.group(1)))
+            elif stripped:
+                yield Block(kind="scene_break")
+            continue
+        paragraph.append(stripped)
+
+    block = flush()
+    if block:
+        yield block
+
+class StructuredChunker:
+    """Agrupa bloques en chunks acotados en tokens respetando la estructura"""
+
+    def __init__(self, token_counter: Callable[[str], int], max_tokens: int = 240,
+                 overlap_tokens: int = 32):
+        self.count_tokens = token_counter
+        self.max_tokens = max(16, max_tokens)
+        self.overlap_tokens = max(0, min(overlap_tokens, self.max_tokens // 2))
+
+    def chunk(self, blocks: Iterable[Block]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Genera (texto, metadatos de estructura) para cada chunk"""
+        chapter: Optional[str] = None
+        sections: List[str] = []
+        scene = 1
+        # Piezas del chunk en curso como (texto, tokens, inicia parrafo)
+        current: List[Tuple[str, int, bool]] = []
+        current_tokens = 0
+        has_content = False
+
+        def structure() -> Dict[str, Any]:
+            metadata: Dict[str, Any] = {"scene": scene}
+            if chapter:
+                metadata["chapter"] = chapter
+            if sections:
+                metadata["section"] = " > ".join(sections)
+            return metadata
+
+        for block in blocks:
+            if block.kind == "text":
+                for piece, tokens, starts_paragraph in self._fit(block.text):
+                    if has_content and current_tokens + tokens > self.max_tokens:
+                        yield self._join(current), structure()
+                        current = self._overlap(current)
+                        current_tokens = sum(t for _, t, _ in current)
+                    current.append((piece, tokens, starts_paragraph))
+                    current_tokens += tokens
+                    has_content = True
+                continue
+
+            # Limite estructural: se cierra el chunk sin solapamiento
+            if has_content:
+                yield self._join(current), structure()
+                current, current_tokens, has_content = [], 0, False
+
+            if block.kind == "scene_break":
+                current, current_tokens = [], 0
+                scene += 1
+                continue
+
+            if block.level <= 1:
+                if current and chapter and not sections:
+                    # Titulo seguido de subtitulo ("Capitulo I" / "El comienzo")
+                    chapter = f"{chapter}: {block.text}"
+                else:
+                    chapter = block.text
+                    current, current_tokens = [], 0
+                sections = []
+                scene = 1
+            else:
+                depth = block.level - 2
+                sections = sections[:depth] + [block.text]
+            # El titulo encabeza el siguiente chunk para dar contexto al embedding
+            tokens = self.count_tokens(block.text)
+            current.append((block.text, tokens, True))
+            current_tokens += tokens
+
+        if current and has_content:
+            yield self._join(current), structure()
+
+    def _fit(self, text: str) -> Iterator[Tuple[str, int, bool]]:
+        """Divide un parrafo que no cabe en un chunk por frases (o palabras)"""
+        tokens = self.count_tokens(text)
+        if tokens <= self.max_tokens:
+            yield text, tokens, True
+            return
+        first = True
+        for sentence in _SENTENCE_SPLIT.split(text):
+            sentence_tokens = self.count_tokens(sentence)
+            if sentence_tokens <= self.max_tokens:
+                yield sentence, sentence_tokens, first
+                first = False
+                continue
+            # Frase desmesurada: trozos de palabras de tamaño proporcional (con margen)
+            words = sentence.split()
+            step = max(1, int(len(words) * self.max_tokens * 0.9 / sentence_tokens))
+            for start in range(0, len(words), step):
+                piece = " ".join(words[start:start + step])
+                yield piece, self.count_tokens(piece), first
+                first = False
+
+    def _overlap(self, pieces: List[Tuple[str, int, bool]]) -> List[Tuple[str, int, bool]]:
+        """Ultimas frases del chunk cerrado que caben en el solapamiento"""
+        if not self.overlap_tokens:
+            return []
+        carried: List[Tuple[str, int, bool]] = []
+        budget = self.overlap_tokens
+        for text, _, starts_paragraph in reversed(pieces):
+            sentences = _SENTENCE_SPLIT.split(text)
+            for position in range(len(sentences) - 1, -1, -1):
+                tokens = self.count_tokens(sentences[position])
+                if tokens > budget:
+                    return carried
+                carried.insert(0, (sentences[position], tokens, starts_paragraph and position == 0))
+                budget -= tokens
+        return carried
+
+    @staticmethod
+    def _join(pieces: List[Tuple[str, int, bool]]) -> str:
+        """Une las piezas: parrafos separados por linea en blanco, frases por espacio"""
+        parts: List[str] = []
+        for text, _, starts_paragraph in pieces:
+            if parts:
+                parts.append("\n\n" if starts_paragraph else " ")
+            parts.append(text)
+        return "".join(parts)
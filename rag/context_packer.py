@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Empaquetado del contexto RAG dentro de un presupuesto de tokens.
+
+Fusiona chunks adyacentes o solapados de la misma fuente (eliminando el
+texto repetido por el chunk_overlap), descarta pasajes casi duplicados y
+rellena el presupuesto por puntuacion, recortando en limite de frase en
+lugar de truncar a ciegas. Devuelve ademas la atribucion por fuente.
+"""
+import re
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Optional, Callable
+
+_SENTENCE_END = re.compile(r'(?<=[.!?…])\s+|\n{2,}')
+
+def approximate_token_count(text: str) -> int:
+    """Estimacion de tokens cuando no hay tokenizer disponible (~4 caracteres)"""
+    return max(1, len(text) // 4)
+
+def merge_overlapping(first: str, second: str, max_overlap: int = 400) -> str:
+    """Une dos textos consecutivos eliminando el solapamiento entre ambos"""
+    limit = min(max_overlap, len(first), len(second))
+    for size in range(limit, 0, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return first + "\n" + second
+
+def _shingles(text: str, size: int = 5) -> set:
+    words = text.lower().split()
+    if len(words) < size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+@dataclass
+class Passage:
+    """Fragmento continuo de una fuente formado por uno o varios chunks"""
+    source: str
+    doc_type: str
+    chunk_indices: List[int]
+    text: str
+    score: float
+    tokens: int = 0
+
+@dataclass
+class PackedContext:
+    """Contexto empaquetado y su atribucion"""
+    context: str
+    sources: List[Dict[str, Any]] = field(default_factory=list)
+    tokens_used: int = 0
+    token_budget: int = 0
+    dropped_duplicates: int = 0
+    dropped_over_budget: int = 0
+
+class ContextPacker:
+    """Empaqueta documentos recuperados en un presupuesto de tokens"""
+
+    def __init__(self, token_counter: Optional[Callable[[str], int]] = None,
+                 max_overlap: int = 400, duplicate_threshold: float = 0.8,
+                 min_fill_tokens: int = 48):
+        self.count_tokens = token_counter or approximate_token_count
+        self.max_overlap = max_overlap
+        self.duplicate_threshold = duplicate_threshold
+        self.min_fill_tokens = min_fill_tokens
+
+    def pack(self, relevant_docs: List[Dict[str, Any]], token_budget: int) -> PackedContext:
+        """Construye el contexto a partir de los resultados de busqueda (ordenados)"""
+        passages = self._merge_adjacent(relevant_docs)
+        passages, duplicates = self._drop_duplicates(passages)
+
+        packed = PackedContext(context="", token_budget=token_budget,
+                               dropped_duplicates=duplicates)
+        separator_tokens = self.count_tokens("\n\n[Fuente: x]\n")
+        remaining = token_budget
+        selected: List[Passage] = []
+
+        for passage in sorted(passages, key=lambda p: p.score, reverse=True):
+            passage.tokens = self.count_tokens(passage.text)
+            cost = passage.tokens + separator_tokens
+            if cost <= remaining:
+                selected.append(passage)
+                remaining -= cost
+            elif remaining - separator_tokens >= self.min_fill_tokens:
+                trimmed = self._trim_to_sentences(passage.text, remaining - separator_tokens)
+                if trimmed:
+                    passage.text = trimmed
+                    passage.tokens = self.count_tokens(trimmed)
+                    selected.append(passage)
+                    remaining -= passage.tokens + separator_tokens
+                else:
+                    packed.dropped_over_budget += 1
+            else:
+                packed.dropped_over_budget += 1
+
+        packed.context = "\n\n".join(
+            f"[Fuente: {passage.source}]\n{passage.text}" for passage in selected
+        )
+        packed.tokens_used = token_budget - remaining
+        packed.sources = [
+            {
+                "source": passage.source,
+                "doc_type": passage.doc_type,
+                "chunk_indices": passage.chunk_indices,
+                "tokens": passage.tokens,
+                "score": round(passage.score, 6)
+            }
+            for passage in selected
+        ]
+        return packed
+
+    def _merge_adjacent(self, relevant_docs: List[Dict[str, Any]]) -> List[Passage]:
+        """Agrupa por fuente y une chunks con indices consecutivos"""
+        by_source: Dict[str, List[Dict[str, Any]]] = {}
+        for rank, doc in enumerate(relevant_docs):
+            metadata = doc.get('metadata', {})
+            score = doc.get('score')
+            if score is None:
+                # Sin puntuacion explicita se usa el orden de recuperacion
+                score = 1.0 / (rank + 1)
+            by_source.setdefault(metadata.get('source', ''), []).append(
+                {**doc, '_score': score, '_index': metadata.get('chunk_index', rank)}
+            )
+
+        passages = []
+        for source, docs in by_source.items():
+            docs.sort(key=lambda d: d['_index'])
+            current: Optional[Passage] = None
+            for doc in docs:
+                index = doc['_index']
+                if current is not None and index - current.chunk_indices[-1] <= 1:
+                    if index != current.chunk_indices[-1]:
+                        current.text = merge_overlapping(current.text, doc['content'], self.max_overlap)
+                        current.chunk_indices.append(index)
+                    current.score = max(current.score, doc['_score'])
+                    continue
+                current = Passage(
+                    source=source,
+                    doc_type=doc.get('metadata', {}).get('doc_type', ''),
+                    chunk_indices=[index],
+                    text=doc['content'],
+                    score=doc['_score']
+                )
+                passages.append(current)
+        return passages
+
+    def _drop_duplicates(self, passages: List[Passage]):
+        """Descarta pasajes casi identicos a otros de mayor puntuacion"""
+        kept: List[Passage] = []
+        kept_shingles: List[set] = []
+        dropped = 0
+        for passage in sorted(passages, key=lambda p: p.score, reverse=True):
+            shingles = _shingles(passage.text)
+            duplicate = False
+            for other in kept_shingles:
+                union = len(shingles | other)
+                if union and len(shingles & other) / union >= self.duplicate_threshold:
+                    duplicate = True
+                    break
+            if duplicate:
+                dropped += 1
+                continue
+            kept.append(passage)
+            kept_shingles.append(shingles)
+        return kept, dropped
+
+    def _trim_to_sentences(self, text: str, token_limit: int) -> str:
+        """Recorta el texto al mayor prefijo de frases completas que cabe"""
+        pieces = _SENTENCE_END.split(text)
+        result = ""
+        for piece in pieces:
+            candidate = f"{result} {piece}".strip() if result else piece
+            if self.count_tokens(candidate) > token_limit:
+                break
+            result = candidate
+        return result
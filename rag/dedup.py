@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""
+Deteccion de chunks casi duplicados con MinHash y LSH.
+
+Las referencias suelen tener varias revisiones del mismo material. Cada
+chunk nuevo se compara (via bandas LSH sobre su firma MinHash) con los
+chunks canonicos ya indexados: si la similitud de Jaccard estimada supera
+el umbral, no se embebe ni se almacena y queda registrado como alias del
+canonico, cuyos metadatos listan todas las fuentes que lo contienen.
+
+Los registros se pueden preparar en una etapa (register con stage) y
+confirmarse solo cuando los chunks ya estan escritos en la coleccion; si
+la escritura falla, rollback los deshace y devuelve las fuentes cuyos
+chunks se descartaron como alias de un canonico que nunca se escribio.
+
+Firmas y alias se guardan en SQLite, una fila por chunk: save() solo
+escribe los chunks cuyo estado cambio desde el ultimo guardado. Las bandas
+LSH se derivan de la firma y se reconstruyen en memoria al cargar.
+"""
+import os
+import json
+import zlib
+import sqlite3
+import logging
+import threading
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Container
+
+import numpy as np
+
+from .bm25_index import tokenize
+
+INDEX_FILENAME = "dedup_index.sqlite3"
+INDEX_VERSION = 1
+
+_MAX_HASH = np.uint64(0xFFFFFFFF)
+
+class MinHasher:
+    """Firmas MinHash sobre shingles de palabras (estables entre procesos)"""
+
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5, seed: int = 1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        generator = np.random.RandomState(seed)
+        self._a = generator.randint(1, 2 ** 32 - 1, size=num_perm, dtype=np.uint64)
+        self._b = generator.randint(0, 2 ** 32 - 1, size=num_perm, dtype=np.uint64)
+
+    def shingles(self, text: str) -> np.ndarray:
+        tokens = tokenize(text)
+        size = self.shingle_size
+        if len(tokens) <= size:
+            grams = [" ".join(tokens)]
+        else:
+            grams = {" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+        return np.fromiter((zlib.crc32(gram.encode('utf-8')) for gram in grams),
+                           dtype=np.uint64, count=len(grams))
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = self.shingles(text)
+        # (a * x + b) mod 2^32 por permutacion y minimo sobre los shingles
+        permuted = (np.outer(hashes, self._a) + self._b) & _MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+    @staticmethod
+    def similarity(first: np.ndarray, second: np.ndarray) -> float:
+        """Jaccard estimado entre dos firmas"""
+        return float(np.count_nonzero(first == second)) / len(first)
+
+class NearDuplicateIndex:
+    """Indice LSH de chunks canonicos y registro de sus alias"""
+
+    def __init__(self, persist_directory: str, threshold: float = 0.85,
+                 num_perm: int = 128, bands: int = 32):
+        if num_perm % bands:
+            raise ValueError("num_perm debe ser multiplo de bands")
+        self.path = os.path.join(persist_directory, INDEX_FILENAME)
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm)
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.RLock()
+        self._connection: Optional[sqlite3.Connection] = None
+        # Chunks con cambios pendientes de guardar y contadores modificados
+        self._touched: set = set()
+        self._dirty = False
+        self._reset = False
+
+        # canonico -> firma; bucket de banda -> canonicos
+        self.signatures: Dict[str, np.ndarray] = {}
+        self._buckets: Dict[Tuple[int, bytes], set] = {}
+        # alias -> canonico; canonico -> {alias: (source, metadatos del alias)}
+        self.aliases: Dict[str, str] = {}
+        self.members: Dict[str, Dict[str, Tuple[str, Dict[str, Any]]]] = {}
+        # Etapas pendientes: etapa -> operaciones a deshacer
+        self._undo: Dict[str, List[tuple]] = {}
+
+        self.checked = 0
+        self.duplicates = 0
+        self.load()
+
+    # ------------------------------------------------------------------
+    # LSH
+    # ------------------------------------------------------------------
+
+    def _band_keys(self, signature: np.ndarray) -> List[Tuple[int, bytes]]:
+        rows = self.rows
+        return [(band, signature[band * rows:(band + 1) * rows].tobytes())
+                for band in range(self.bands)]
+
+    def _insert(self, doc_id: str, signature: np.ndarray):
+        self.signatures[doc_id] = signature
+        self._touched.add(doc_id)
+        for key in self._band_keys(signature):
+            self._buckets.setdefault(key, set()).add(doc_id)
+
+    def _remove(self, doc_id: str):
+        signature = self.signatures.pop(doc_id, None)
+        if signature is None:
+            return
+        self._touched.add(doc_id)
+        for key in self._band_keys(signature):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(doc_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def _find(self, signature: np.ndarray,
+              exclude: Container[str] = ()) -> Optional[str]:
+        """Canonico mas parecido por encima del umbral (sin los excluidos)"""
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates.update(self._buckets.get(key, ()))
+        best, best_score = None, self.threshold
+        for candidate in candidates:
+            if candidate in exclude:
+                continue
+            score = MinHasher.similarity(signature, self.signatures[candidate])
+            if score >= best_score:
+                best, best_score = candidate, score
+        return best
+
+    # ------------------------------------------------------------------
+    # Registro de chunks
+    # ------------------------------------------------------------------
+
+    def register(self, doc_id: str, text: str, source: str,
+                 metadata: Dict[str, Any], stage: Optional[str] = None,
+                 exclude: Container[str] = ()) -> Optional[str]:
+        """Registra un chunk nuevo; devuelve su canonico si es casi duplicado
+
+        Con stage el registro queda pendiente hasta commit(stage) o
+        rollback(stage). Los canonicos de exclude (chunks que se van a
+        eliminar) no cuentan como originales.
+        """
+        signature = self.hasher.signature(text)
+        with self._lock:
+            self.checked += 1
+            self._dirty = True
+            if doc_id in self.signatures:
+                return None
+            undo = self._undo.setdefault(stage, []) if stage is not None else None
+            previous = self.aliases.pop(doc_id, None)
+            if previous is not None:
+                self._touched.add(doc_id)
+                entry = self.members.get(previous, {}).pop(doc_id, None)
+                if undo is not None:
+                    undo.append(("unalias", doc_id, previous, entry))
+            canonical = self._find(signature, exclude)
+            if canonical is None:
+                self._insert(doc_id, signature)
+                if undo is not None:
+                    undo.append(("canonical", doc_id))
+                return None
+            self.duplicates += 1
+            self.aliases[doc_id] = canonical
+            self._touched.add(doc_id)
+            self.members.setdefault(canonical, {})[doc_id] = (source, dict(metadata))
+            if undo is not None:
+                undo.append(("alias", doc_id, canonical))
+            return canonical
+
+    def commit(self, stage: str) -> List[str]:
+        """Confirma los registros de una etapa; devuelve los canonicos con alias nuevos"""
+        with self._lock:
+            refresh = set()
+            for operation in self._undo.pop(stage, []):
+                if operation[0] != "canonical":
+                    refresh.add(operation[2])
+            return sorted(canonical for canonical in refresh if canonical in self.signatures)
+
+    def rollback(self, stage: str) -> List[str]:
+        """Deshace los registros pendientes de una etapa
+
+        Devuelve las fuentes de otras etapas con alias de los canonicos
+        deshechos: esos chunks no se escribieron y hay que volver a
+        ingestarlas.
+        """
+        affected = set()
+        with self._lock:
+            for operation in reversed(self._undo.pop(stage, [])):
+                kind, doc_id = operation[0], operation[1]
+                if kind == "canonical":
+                    for alias, (source, _) in self.members.pop(doc_id, {}).items():
+                        self.aliases.pop(alias, None)
+                        self._touched.add(alias)
+                        affected.add(source)
+                    self._remove(doc_id)
+                elif kind == "alias":
+                    self.aliases.pop(doc_id, None)
+                    self._touched.add(doc_id)
+                    members = self.members.get(operation[2])
+                    if members is not None:
+                        members.pop(doc_id, None)
+                        if not members:
+                            del self.members[operation[2]]
+                elif operation[2] in self.signatures:
+                    self.aliases[doc_id] = operation[2]
+                    self._touched.add(doc_id)
+                    if operation[3] is not None:
+                        self.members.setdefault(operation[2], {})[doc_id] = operation[3]
+        return sorted(affected)
+
+    def add_canonical(self, doc_id: str, text: str):
+        """Registra un chunk existente como canonico sin buscar duplicados"""
+        with self._lock:
+            if doc_id not in self.signatures and doc_id not in self.aliases:
+                self._insert(doc_id, self.hasher.signature(text))
+
+    def is_alias(self, doc_id: str) -> bool:
+        with self._lock:
+            return doc_id in self.aliases
+
+    def annotate(self, doc_id: str, metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """Añade a los metadatos del canonico las fuentes de sus alias"""
+        with self._lock:
+            members = self.members.get(doc_id)
+            metadata = {key: value for key, value in metadata.items()
+                        if key not in ('sources', 'duplicates')}
+            if members:
+                sources = {metadata.get('source', '')}
+                sources.update(source for source, _ in members.values())
+                metadata['sources'] = " | ".join(sorted(s for s in sources if s))
+                metadata['duplicates'] = len(members)
+            return metadata
+
+    def remove(self, ids: Iterable[str]) -> Tuple[List[str], List[Tuple[str, str, str, Dict[str, Any]]]]:
+        """Elimina chunks (alias o canonicos)
+
+        Devuelve los canonicos cuyos metadatos hay que refrescar y las
+        promociones necesarias: (canonico eliminado, alias que lo sustituye,
+        fuente del alias, metadatos del alias).
+        """
+        refresh, promotions = set(), []
+        with self._lock:
+            removed = set(ids)
+            # Primero los alias, para no promover uno que tambien se elimina
+            for doc_id in removed:
+                canonical = self.aliases.pop(doc_id, None)
+                if canonical is not None:
+                    self.members.get(canonical, {}).pop(doc_id, None)
+                    self._touched.add(doc_id)
+                    refresh.add(canonical)
+            for doc_id in removed:
+                if doc_id not in self.signatures:
+                    continue
+                members = self.members.pop(doc_id, {})
+                signature = self.signatures[doc_id]
+                self._remove(doc_id)
+                refresh.discard(doc_id)
+                if not members:
+                    continue
+                heir, (source, metadata) = next(iter(members.items()))
+                del members[heir]
+                del self.aliases[heir]
+                self._insert(heir, signature)
+                for alias in members:
+                    self.aliases[alias] = heir
+                    self._touched.add(alias)
+                if members:
+                    self.members[heir] = members
+                promotions.append((doc_id, heir, source, metadata))
+        return sorted(refresh - removed), promotions
+
+    def remove_source_aliases(self, source: str) -> List[str]:
+        """Elimina los alias de una fuente; devuelve los canonicos afectados"""
+        with self._lock:
+            ids = [alias for canonical, members in self.members.items()
+                   for alias, (alias_source, _) in members.items() if alias_source == source]
+        refresh, _ = self.remove(ids)
+        return refresh
+
+    def clear(self):
+        with self._lock:
+            self.signatures, self._buckets = {}, {}
+            self.aliases, self.members = {}, {}
+            self._undo = {}
+            self._touched.clear()
+            self._reset = True
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    # ------------------------------------------------------------------
+    # Persistencia
+    # ------------------------------------------------------------------
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """Conexion abierta bajo demanda (se reabre tras close)"""
+        with self._lock:
+            if self._connection is None:
+                self._connection = sqlite3.connect(self.path, check_same_thread=False)
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS canonicals ("
+                    " id TEXT PRIMARY KEY,"
+                    " signature BLOB NOT NULL)"
+                )
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS aliases ("
+                    " id TEXT PRIMARY KEY,"
+                    " canonical TEXT NOT NULL,"
+                    " source TEXT NOT NULL,"
+                    " metadata TEXT NOT NULL)"
+                )
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)"
+                )
+                self._connection.commit()
+            return self._connection
+
+    def load(self):
+        """Carga firmas y alias desde disco"""
+        with self._lock:
+            if not os.path.exists(self.path):
+                return
+            try:
+                meta = dict(self._conn.execute("SELECT key, value FROM meta"))
+                if not meta:
+                    return
+                if (meta.get("version") != INDEX_VERSION
+                        or meta.get("num_perm") != self.hasher.num_perm):
+                    self._reset = True
+                    return
+                for doc_id, signature in self._conn.execute("SELECT id, signature FROM canonicals"):
+                    self._insert(doc_id, np.frombuffer(signature, dtype=np.uint32).copy())
+                for doc_id, canonical, source, metadata in self._conn.execute(
+                        "SELECT id, canonical, source, metadata FROM aliases"):
+                    self.aliases[doc_id] = canonical
+                    self.members.setdefault(canonical, {})[doc_id] = (source, json.loads(metadata))
+                self.checked = meta.get("checked", 0)
+                self.duplicates = meta.get("duplicates", 0)
+                self._touched.clear()
+            except Exception as e:
+                self.logger.error(f"Error cargando indice de duplicados: {str(e)}")
+                self.signatures, self._buckets, self.aliases, self.members = {}, {}, {}, {}
+                self._touched.clear()
+                self._reset = True
+
+    def save(self):
+        """Guarda los chunks modificados si no quedan etapas pendientes"""
+        with self._lock:
+            if not (self._dirty or self._touched or self._reset) or self._undo:
+                return
+            try:
+                touched = [(doc_id,) for doc_id in self._touched]
+                with self._conn:
+                    if self._reset:
+                        self._conn.execute("DELETE FROM canonicals")
+                        self._conn.execute("DELETE FROM aliases")
+                    self._conn.executemany("DELETE FROM canonicals WHERE id = ?", touched)
+                    self._conn.executemany("DELETE FROM aliases WHERE id = ?", touched)
+                    self._conn.executemany(
+                        "INSERT INTO canonicals VALUES (?, ?)",
+                        [(doc_id, self.signatures[doc_id].tobytes())
+                         for doc_id in self._touched if doc_id in self.signatures]
+                    )
+                    self._conn.executemany(
+                        "INSERT INTO aliases VALUES (?, ?, ?, ?)",
+                        [self._alias_row(doc_id) for doc_id in self._touched if doc_id in self.aliases]
+                    )
+                    self._conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [
+                        ("version", INDEX_VERSION),
+                        ("num_perm", self.hasher.num_perm),
+                        ("checked", self.checked),
+                        ("duplicates", self.duplicates)
+                    ])
+                self._touched.clear()
+                self._dirty = False
+                self._reset = False
+            except Exception as e:
+                self.logger.error(f"Error guardando indice de duplicados: {str(e)}")
+
+    def _alias_row(self, doc_id: str) -> tuple:
+        canonical = self.aliases[doc_id]
+        source, metadata = self.members.get(canonical, {}).get(doc_id, ("", {}))
+        return (doc_id, canonical, source, json.dumps(metadata, ensure_ascii=False))
+
+    def close(self):
+        with self._lock:
+            self.save()
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Canonicos, alias y proporcion de duplicados detectados"""
+        with self._lock:
+            stored = len(self.signatures)
+            aliases = len(self.aliases)
+            total = stored + aliases
+            return {
+                "threshold": self.threshold,
+                "canonical_chunks": stored,
+                "duplicate_chunks": aliases,
+                "dedup_ratio": round(aliases / total, 4) if total else 0.0,
+                "checked": self.checked,
+                "detected": self.duplicates
+            }
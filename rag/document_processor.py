@@ -3,29 +3,56 @@ import os
 import json
 import logging
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterable, Iterator
 from dataclasses import dataclass
 
 import PyPDF2
 from docx import Document
 import openpyxl
-import markdown
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document as LangchainDocument
 
+from .chunking import Block, StructuredChunker, text_blocks, markdown_blocks, is_scene_break, \
+    is_chapter_heading, is_short_line
+from .tabular import Record, RecordChunker, iter_xlsx_records, iter_json_records
+
 @dataclass
 class ProcessedDocument:
     content: str
     metadata: Dict[str, Any]
     source: str
     doc_type: str
+    # Texto de la ventana padre en modo jerarquico (metadata['parent_index'])
+    parent: Optional[str] = None
 
 class DocumentProcessor:
     """Procesador de documentos con soporte para multiples formatos"""
     
-    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200):
+    # Bloque de lectura de archivos de texto en modo streaming
+    TEXT_BLOCK_SIZE = 16 * 1024
+    # Formatos narrativos que admiten chunking por estructura
+    STRUCTURED_EXTENSIONS = {'.pdf', '.docx', '.txt', '.md'}
+    # Formatos tabulares que se trocean por registros (filas u objetos)
+    TABULAR_EXTENSIONS = {'.json', '.xlsx', '.xls'}
+    
+    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200,
+                 chunking: str = "structured", chunk_tokens: int = 240,
+                 chunk_overlap_tokens: int = 32,
+                 embedding_model: str = "all-MiniLM-L6-v2",
+                 hierarchical: bool = False, parent_tokens: int = 768,
+                 child_tokens: int = 64):
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        # "structured" (capitulos/escenas/secciones, en tokens) o "recursive" (caracteres)
+        self.chunking = chunking
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap_tokens = chunk_overlap_tokens
+        self.embedding_model = embedding_model
+        # Modo jerarquico: se embeben hijos pequeños y se devuelven sus padres
+        self.hierarchical = hierarchical
+        self.parent_tokens = parent_tokens
+        self.child_tokens = child_tokens
+        self._token_counter = None
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap,
@@ -34,51 +61,178 @@ class DocumentProcessor:
         )
         self.logger = logging.getLogger(__name__)
     
+    def get_config(self) -> Dict[str, Any]:
+        """Parametros del procesador (recrean uno equivalente y versionan la ingesta)"""
+        return {
+            "chunk_size": self.chunk_size,
+            "chunk_overlap": self.chunk_overlap,
+            "chunking": self.chunking,
+            "chunk_tokens": self.chunk_tokens,
+            "chunk_overlap_tokens": self.chunk_overlap_tokens,
+            "embedding_model": self.embedding_model,
+            "hierarchical": self.hierarchical,
+            "parent_tokens": self.parent_tokens,
+            "child_tokens": self.child_tokens
+        }
+    
+    @property
+    def token_counter(self):
+        """Contador de tokens del modelo de embeddings (se carga al primer uso)"""
+        if self._token_counter is None:
+            from .registry import get_token_counter
+            self._token_counter = get_token_counter(self.embedding_model)
+        return self._token_counter
+    
     def process_document(self, file_path: str) -> List[ProcessedDocument]:
         """Procesa un documento segun su extension"""
-        file_path = Path(file_path)
+        try:
+            processed_docs = list(self.iter_document(file_path))
+        except Exception as e:
+            self.logger.error(f"Error procesando {file_path}: {str(e)}")
+            raise
         
+        for doc in processed_docs:
+            doc.metadata['total_chunks'] = len(processed_docs)
+        return processed_docs
+    
+    def iter_document(self, file_path: str) -> Iterator[ProcessedDocument]:
+        """Procesa un documento de forma incremental
+        
+        PDF, DOCX y TXT se leen por paginas, parrafos o bloques y se trocean
+        sobre la marcha, por lo que la memoria queda acotada por unos pocos
+        chunks y no por el tamaño del documento. Los chunks emitidos no
+        incluyen 'total_chunks', que solo se conoce al terminar.
+        
+        En modo jerarquico se emiten los chunks hijos, cada uno con el texto
+        de su ventana padre en ProcessedDocument.parent.
+        """
+        docs = self._iter_chunks(Path(file_path))
+        return self._split_children(docs) if self.hierarchical else docs
+    
+    def _iter_chunks(self, file_path: Path) -> Iterator[ProcessedDocument]:
+        """Chunks del documento (ventanas padre en modo jerarquico)"""
         if not file_path.exists():
             raise FileNotFoundError(f"El archivo {file_path} no existe")
         
         extension = file_path.suffix.lower()
         
+        if self.chunking == "structured" and extension in self.STRUCTURED_EXTENSIONS:
+            block_readers = {
+                '.pdf': lambda path: text_blocks(self._iter_pdf_lines(path)),
+                '.docx': self._iter_docx_blocks,
+                '.txt': lambda path: text_blocks(self._iter_text_lines(path)),
+                '.md': lambda path: markdown_blocks(self._iter_text_lines(path))
+            }
+            blocks = block_readers[extension](file_path)
+            return self._chunk_structured(blocks, str(file_path), extension[1:])
+        
+        if self.chunking == "structured" and extension in self.TABULAR_EXTENSIONS:
+            if extension == '.json':
+                records = iter_json_records(file_path)
+            else:
+                records = iter_xlsx_records(file_path)
+            return self._chunk_records(records, str(file_path), extension[1:])
+        
+        streamers = {
+            '.pdf': self._iter_pdf,
+            '.docx': self._iter_docx,
+            '.txt': self._iter_txt
+        }
         processors = {
-            '.pdf': self._process_pdf,
-            '.docx': self._process_docx,
-            '.txt': self._process_txt,
             '.md': self._process_markdown,
             '.json': self._process_json,
             '.xlsx': self._process_xlsx,
             '.xls': self._process_xlsx
         }
         
-        if extension not in processors:
+        if extension in streamers:
+            pieces = streamers[extension](file_path)
+        elif extension in processors:
+            pieces = iter([processors[extension](file_path)])
+        else:
             raise ValueError(f"Formato {extension} no soportado")
         
-        try:
-            content = processors[extension](file_path)
-            return self._chunk_content(content, str(file_path), extension[1:])
-        except Exception as e:
-            self.logger.error(f"Error procesando {file_path}: {str(e)}")
-            raise
+        return self._chunk_stream(pieces, str(file_path), extension[1:])
     
-    def _process_pdf(self, file_path: Path) -> str:
-        """Procesa archivos PDF"""
-        content = ""
+    def _iter_pdf(self, file_path: Path) -> Iterator[str]:
+        """Extrae el texto de un PDF pagina a pagina"""
         with open(file_path, 'rb') as file:
             pdf_reader = PyPDF2.PdfReader(file)
             for page in pdf_reader.pages:
-                content += page.extract_text() + "\n"
-        return content.strip()
+                yield (page.extract_text() or "") + "\n"
     
-    def _process_docx(self, file_path: Path) -> str:
-        """Procesa archivos DOCX"""
+    def _iter_docx(self, file_path: Path) -> Iterator[str]:
+        """Extrae el texto de un DOCX parrafo a parrafo"""
+        doc = Document(file_path)
+        for paragraph in doc.paragraphs:
+            yield paragraph.text + "\n"
+    
+    def _iter_pdf_lines(self, file_path: Path) -> Iterator[str]:
+        """Lineas de un PDF; cada cambio de pagina cierra el parrafo en curso"""
+        for page_text in self._iter_pdf(file_path):
+            yield from page_text.splitlines()
+            yield ""
+    
+    def _iter_text_lines(self, file_path: Path) -> Iterator[str]:
+        """Lee un archivo de texto linea a linea"""
+        with open(file_path, 'r', encoding='utf-8') as file:
+            yield from file
+    
+    def _iter_docx_blocks(self, file_path: Path) -> Iterator[Block]:
+        """Recorre un DOCX como bloques usando estilos de titulo y formato"""
         doc = Document(file_path)
-        content = ""
         for paragraph in doc.paragraphs:
-            content += paragraph.text + "\n"
-        return content.strip()
+            text = paragraph.text.strip()
+            if not text:
+                continue
+            if is_scene_break(text):
+                yield Block(kind="scene_break")
+                continue
+            level = self._docx_heading_level(paragraph, text)
+            if level:
+                yield Block(text, kind="heading", level=level)
+            else:
+                yield Block(text)
+    
+    @staticmethod
+    def _docx_heading_level(paragraph, text: str) -> int:
+        """Nivel de titulo de un parrafo DOCX (0 si es texto normal)
+        
+        Se usan los estilos de titulo ("Heading N", "Título N", "Title"); los
+        manuscritos sin estilos marcan los capitulos con lineas cortas en
+        negrita o con textos como "Capitulo IV".
+        """
+        style_name = (paragraph.style.name if paragraph.style is not None else "") or ""
+        style_name = style_name.lower()
+        if style_name in ("title", "título", "titulo"):
+            return 1
+        for prefix in ("heading", "título", "titulo"):
+            if style_name.startswith(prefix):
+                digits = "".join(ch for ch in style_name[len(prefix):] if ch.isdigit())
+                if digits:
+                    return max(1, int(digits))
+        
+        if is_chapter_heading(text):
+            return 1
+        runs = [run for run in paragraph.runs if run.text.strip()]
+        if (runs and is_short_line(text) and all(run.bold for run in runs)
+                and not text.endswith((':', ',', ';', '?', '!'))):
+            return 1
+        return 0
+    
+    def _iter_txt(self, file_path: Path) -> Iterator[str]:
+        """Lee un archivo de texto por bloques"""
+        with open(file_path, 'r', encoding='utf-8') as file:
+            for block in iter(lambda: file.read(self.TEXT_BLOCK_SIZE), ""):
+                yield block
+    
+    def _process_pdf(self, file_path: Path) -> str:
+        """Procesa archivos PDF"""
+        return "".join(self._iter_pdf(file_path)).strip()
+    
+    def _process_docx(self, file_path: Path) -> str:
+        """Procesa archivos DOCX"""
+        return "".join(self._iter_docx(file_path)).strip()
     
     def _process_txt(self, file_path: Path) -> str:
         """Procesa archivos TXT"""
@@ -88,11 +242,8 @@ class DocumentProcessor:
     def _process_markdown(self, file_path: Path) -> str:
         """Procesa archivos Markdown"""
         with open(file_path, 'r', encoding='utf-8') as file:
-            md_content = file.read()
-            # Convertir a texto plano manteniendo estructura
-            html = markdown.markdown(md_content)
-            # Para simplicidad, devolver el markdown original
-            return md_content.strip()
+            # Se conserva el Markdown original; su estructura la usa el chunker
+            return file.read().strip()
     
     def _process_json(self, file_path: Path) -> str:
         """Procesa archivos JSON"""
@@ -103,47 +254,139 @@ class DocumentProcessor:
     
     def _process_xlsx(self, file_path: Path) -> str:
         """Procesa archivos Excel"""
-        workbook = openpyxl.load_workbook(file_path)
-        content = ""
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        parts = []
         
-        for sheet_name in workbook.sheetnames:
-            sheet = workbook[sheet_name]
-            content += f"### Hoja: {sheet_name}\n\n"
-            
-            for row in sheet.iter_rows(values_only=True):
-                row_data = [str(cell) if cell is not None else "" for cell in row]
-                content += " | ".join(row_data) + "\n"
-            content += "\n"
+        try:
+            for sheet in workbook.worksheets:
+                parts.append(f"### Hoja: {sheet.title}\n\n")
+                
+                for row in sheet.iter_rows(values_only=True):
+                    row_data = [str(cell) if cell is not None else "" for cell in row]
+                    parts.append(" | ".join(row_data) + "\n")
+                parts.append("\n")
+        finally:
+            workbook.close()
         
-        return content.strip()
+        return "".join(parts).strip()
     
     def _chunk_content(self, content: str, source: str, doc_type: str) -> List[ProcessedDocument]:
         """Divide el contenido en chunks"""
-        if not content.strip():
-            return []
-        
-        chunks = self.text_splitter.split_text(content)
-        processed_docs = []
-        
-        for i, chunk in enumerate(chunks):
-            metadata = {
-                'source': source,
-                'doc_type': doc_type,
-                'chunk_index': i,
-                'total_chunks': len(chunks),
-                'chunk_size': len(chunk)
-            }
+        processed_docs = list(self._chunk_stream(iter([content]), source, doc_type))
+        for doc in processed_docs:
+            doc.metadata['total_chunks'] = len(processed_docs)
+        return processed_docs
+    
+    def _chunk_stream(self, pieces: Iterable[str], source: str,
+                      doc_type: str) -> Iterator[ProcessedDocument]:
+        """Trocea un flujo de fragmentos de texto de forma incremental
+        
+        Acumula fragmentos hasta tener unos pocos chunks, los divide y emite
+        todos menos el ultimo, que se conserva como arrastre: contiene el
+        solapamiento con el chunk anterior y puede seguir creciendo con el
+        texto que llegue despues.
+        """
+        window = self.chunk_size * 4
+        buffer: List[str] = []
+        buffered = 0
+        chunk_index = 0
+        
+        for piece in pieces:
+            if not piece:
+                continue
+            buffer.append(piece)
+            buffered += len(piece)
+            if buffered < window:
+                continue
             
-            processed_docs.append(
-                ProcessedDocument(
-                    content=chunk,
+            text = "".join(buffer)
+            chunks = self.text_splitter.split_text(text)
+            for chunk in chunks[:-1]:
+                yield self._make_document(chunk, source, doc_type, chunk_index)
+                chunk_index += 1
+            # Arrastrar el texto original desde el ultimo chunk (conserva separadores)
+            tail_start = text.rfind(chunks[-1]) if chunks else len(text)
+            tail = text[tail_start:] if tail_start >= 0 else chunks[-1] + "\n"
+            buffer = [tail]
+            buffered = len(tail)
+        
+        text = "".join(buffer)
+        if text.strip():
+            for chunk in self.text_splitter.split_text(text):
+                yield self._make_document(chunk, source, doc_type, chunk_index)
+                chunk_index += 1
+    
+    def _chunk_structured(self, blocks: Iterable[Block], source: str,
+                          doc_type: str) -> Iterator[ProcessedDocument]:
+        """Trocea bloques estructurales en chunks medidos en tokens"""
+        if self.hierarchical:
+            # Ventanas padre grandes y sin solapamiento (escena o seccion)
+            chunker = StructuredChunker(self.token_counter, max_tokens=self.parent_tokens,
+                                        overlap_tokens=0)
+        else:
+            chunker = StructuredChunker(
+                self.token_counter, max_tokens=self.chunk_tokens,
+                overlap_tokens=self.chunk_overlap_tokens
+            )
+        for index, (chunk, structure) in enumerate(chunker.chunk(blocks)):
+            yield self._make_document(chunk, source, doc_type, index, structure)
+    
+    def _split_children(self, parents: Iterable[ProcessedDocument]) -> Iterator[ProcessedDocument]:
+        """Divide cada ventana padre en hijos de pocas frases para embeber"""
+        splitter = StructuredChunker(self.token_counter, max_tokens=self.child_tokens,
+                                     overlap_tokens=0)
+        child_index = 0
+        for parent in parents:
+            parent_index = parent.metadata['chunk_index']
+            paragraphs = (Block(text) for text in parent.content.split("\n\n") if text.strip())
+            for child, _ in splitter.chunk(paragraphs):
+                metadata = {
+                    **parent.metadata,
+                    'chunk_index': child_index,
+                    'chunk_size': len(child),
+                    'parent_index': parent_index
+                }
+                yield ProcessedDocument(
+                    content=child,
                     metadata=metadata,
-                    source=source,
-                    doc_type=doc_type
+                    source=parent.source,
+                    doc_type=parent.doc_type,
+                    parent=parent.content
                 )
-            )
-        
-        return processed_docs
-
-
-
+                child_index += 1
+    
+    def _chunk_records(self, records: Iterable[Record], source: str,
+                       doc_type: str) -> Iterator[ProcessedDocument]:
+        """Agrupa registros tabulares en chunks medidos en tokens"""
+        chunker = RecordChunker(self.token_counter, max_tokens=self.chunk_tokens)
+        for index, chunk in enumerate(chunker.chunk(records)):
+            if doc_type == 'json':
+                extra = {'json_path': chunk.first_label, 'records': chunk.records}
+                if chunk.last_label != chunk.first_label:
+                    extra['json_path_end'] = chunk.last_label
+            else:
+                extra = {
+                    'sheet': chunk.group,
+                    'row_start': chunk.first_label,
+                    'row_end': chunk.last_label,
+                    'records': chunk.records
+                }
+            yield self._make_document(chunk.text, source, doc_type, index, extra)
+    
+    @staticmethod
+    def _make_document(chunk: str, source: str, doc_type: str, index: int,
+                       extra: Optional[Dict[str, Any]] = None) -> ProcessedDocument:
+        metadata = {
+            'source': source,
+            'doc_type': doc_type,
+            'chunk_index': index,
+            'chunk_size': len(chunk)
+        }
+        if extra:
+            metadata.update(extra)
+        return ProcessedDocument(
+            content=chunk,
+            metadata=metadata,
+            source=source,
+            doc_type=doc_type
+        )
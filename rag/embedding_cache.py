@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Cache persistente de embeddings de chunks.
+
+Los vectores se guardan en una matriz float16/float32 mapeada en memoria
+(un archivo por modelo de embeddings) y un indice SQLite relaciona el hash
+del texto del chunk con su fila. flush() solo escribe las entradas nuevas,
+desalojadas o consultadas desde el ultimo guardado. Re-ingestas,
+reconstrucciones de colecciones o cambios de coleccion reutilizan asi los
+vectores sin volver a codificar.
+El tamaño esta acotado: al llenarse se reemplazan las filas menos usadas.
+"""
+import os
+import re
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+
+INDEX_VERSION = 1
+
+class EmbeddingCache:
+    """Cache de embeddings por (modelo, hash del texto) sobre np.memmap"""
+
+    def __init__(self, cache_dir: str, model_name: str, max_size_mb: int = 512,
+                 dtype: str = "float16"):
+        if dtype not in ("float16", "float32"):
+            raise ValueError(f"dtype {dtype} no soportado para el cache de embeddings")
+
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.max_size_mb = max_size_mb
+        self.dtype = np.dtype(dtype)
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.RLock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        safe_name = re.sub(r'[^A-Za-z0-9_.-]', '_', model_name)
+        model_digest = hashlib.sha1(model_name.encode('utf-8')).hexdigest()[:8]
+        base = os.path.join(cache_dir, f"{safe_name}-{model_digest}")
+        self.matrix_path = f"{base}.{dtype}"
+        self.index_path = f"{base}.index.sqlite3"
+
+        self.dim: Optional[int] = None
+        self.capacity = 0
+        self._matrix: Optional[np.memmap] = None
+        # hash -> [fila, ultimo acceso]
+        self._slots: Dict[str, List[int]] = {}
+        self._free: List[int] = []
+        self._next_row = 0
+        self._clock = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        # Cambios pendientes de guardar en el indice
+        self._changed: set = set()
+        self._removed: set = set()
+        # Claves leidas: su ultimo acceso se guarda sin forzar un flush
+        self._touched: set = set()
+        self._reset = False
+        self._matrix_dirty = False
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._load()
+
+    # ------------------------------------------------------------------
+    # Persistencia
+    # ------------------------------------------------------------------
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.index_path, check_same_thread=False)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS slots ("
+            " key TEXT PRIMARY KEY,"
+            " row INTEGER NOT NULL,"
+            " accessed INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        conn.commit()
+        return conn
+
+    def _load(self):
+        """Abre la matriz e indice existentes si son compatibles"""
+        try:
+            self._conn = self._connect()
+            if not os.path.exists(self.matrix_path):
+                return
+            meta = dict(self._conn.execute("SELECT key, value FROM meta"))
+            if not meta:
+                return
+            if (meta.get("version") != INDEX_VERSION or meta.get("dtype") != self.dtype.name
+                    or meta.get("model") != self.model_name):
+                self.logger.info("Cache de embeddings incompatible, se recrea")
+                return
+            self._open_matrix(meta["dim"], meta["capacity"], mode="r+")
+            self._slots = {
+                key: [row, accessed]
+                for key, row, accessed in self._conn.execute("SELECT key, row, accessed FROM slots")
+            }
+            self._clock = meta.get("clock", 0)
+            used = {slot for slot, _ in self._slots.values()}
+            self._next_row = meta.get("next_row", max(used, default=-1) + 1)
+            self._free = [row for row in range(self._next_row) if row not in used]
+        except Exception as e:
+            self.logger.error(f"Error cargando cache de embeddings: {str(e)}")
+            self._matrix = None
+            self._slots = {}
+            self._free = []
+            self._next_row = 0
+
+    def _open_matrix(self, dim: int, capacity: int, mode: str):
+        self.dim = dim
+        self.capacity = capacity
+        self._matrix = np.memmap(self.matrix_path, dtype=self.dtype, mode=mode,
+                                 shape=(capacity, dim))
+
+    def _create(self, dim: int):
+        """Reserva la matriz para la dimension del modelo (archivo disperso)"""
+        row_bytes = dim * self.dtype.itemsize
+        capacity = max(1, (self.max_size_mb * 1024 * 1024) // row_bytes)
+        self._open_matrix(dim, capacity, mode="w+")
+        self._slots = {}
+        self._free = []
+        self._next_row = 0
+        self._reset = True
+        self._changed.clear()
+        self._removed.clear()
+        self._touched.clear()
+
+    def flush(self):
+        """Sincroniza la matriz y guarda en el indice los cambios pendientes"""
+        with self._lock:
+            if self._matrix is None or self._conn is None:
+                return
+            if not (self._reset or self._changed or self._removed or self._touched):
+                return
+            try:
+                # La matriz antes que el indice: una clave nunca apunta a una fila sin escribir
+                if self._matrix_dirty:
+                    self._matrix.flush()
+                    self._matrix_dirty = False
+                with self._conn:
+                    if self._reset:
+                        self._conn.execute("DELETE FROM slots")
+                    self._conn.executemany(
+                        "DELETE FROM slots WHERE key = ?", [(key,) for key in self._removed]
+                    )
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO slots VALUES (?, ?, ?)",
+                        [(key, *self._slots[key]) for key in self._changed if key in self._slots]
+                    )
+                    self._conn.executemany(
+                        "UPDATE slots SET accessed = ? WHERE key = ?",
+                        [(self._slots[key][1], key) for key in self._touched - self._changed
+                         if key in self._slots]
+                    )
+                    self._conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [
+                        ("version", INDEX_VERSION),
+                        ("model", self.model_name),
+                        ("dtype", self.dtype.name),
+                        ("dim", self.dim),
+                        ("capacity", self.capacity),
+                        ("clock", self._clock),
+                        ("next_row", self._next_row)
+                    ])
+                self._reset = False
+                self._changed.clear()
+                self._removed.clear()
+                self._touched.clear()
+            except Exception as e:
+                self.logger.error(f"Error guardando cache de embeddings: {str(e)}")
+
+    # ------------------------------------------------------------------
+    # Lectura / escritura
+    # ------------------------------------------------------------------
+
+    def get_many(self, keys: List[str]) -> Tuple[Dict[int, np.ndarray], List[int]]:
+        """Busca vectores por clave; devuelve {posicion: vector} y posiciones faltantes"""
+        found: Dict[int, np.ndarray] = {}
+        missing: List[int] = []
+        with self._lock:
+            for position, key in enumerate(keys):
+                entry = self._slots.get(key) if self._matrix is not None else None
+                if entry is None:
+                    missing.append(position)
+                    continue
+                self._clock += 1
+                entry[1] = self._clock
+                self._touched.add(key)
+                found[position] = np.asarray(self._matrix[entry[0]], dtype=np.float32)
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def put_many(self, keys: List[str], vectors: np.ndarray):
+        """Guarda vectores en el cache, reemplazando los menos usados si esta lleno"""
+        if len(keys) == 0:
+            return
+        vectors = np.asarray(vectors)
+        with self._lock:
+            if self._matrix is None or self.dim != vectors.shape[1]:
+                self._create(vectors.shape[1])
+
+            for key, vector in zip(keys, vectors):
+                entry = self._slots.get(key)
+                if entry is None:
+                    entry = [self._allocate_row(), 0]
+                    self._slots[key] = entry
+                self._clock += 1
+                entry[1] = self._clock
+                self._matrix[entry[0]] = vector
+                self._changed.add(key)
+                self._removed.discard(key)
+            self._matrix_dirty = True
+
+    def _allocate_row(self) -> int:
+        if self._free:
+            return self._free.pop()
+        if self._next_row < self.capacity:
+            self._next_row += 1
+            return self._next_row - 1
+        self._evict(max(1, self.capacity // 10))
+        return self._free.pop()
+
+    def _evict(self, count: int):
+        """Libera las filas con acceso mas antiguo"""
+        oldest = sorted(self._slots.items(), key=lambda item: item[1][1])[:count]
+        for key, (row, _) in oldest:
+            del self._slots[key]
+            self._free.append(row)
+            self._changed.discard(key)
+            self._touched.discard(key)
+            self._removed.add(key)
+        self.evictions += len(oldest)
+
+    def clear(self):
+        """Vacia el cache"""
+        with self._lock:
+            self._free = []
+            self._next_row = 0
+            self._slots = {}
+            self._reset = True
+            self._changed.clear()
+            self._removed.clear()
+            self._touched.clear()
+            self.flush()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Estadisticas de uso del cache"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._slots),
+                "capacity": self.capacity,
+                "dtype": self.dtype.name,
+                "max_size_mb": self.max_size_mb,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total * 100, 2) if total else 0.0,
+                "evictions": self.evictions
+            }
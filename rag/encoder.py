@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Codificador de embeddings por lotes agrupados por longitud.
+
+Ordena los textos por longitud en tokens, los codifica en lotes de tamaño
+configurable (cada lote con longitudes parecidas, minimizando el padding) y
+escribe cada lote en una matriz numpy preasignada, restaurando el orden
+original sin pasar por listas de Python.
+"""
+import logging
+import threading
+from typing import List, Optional
+
+import numpy as np
+
+class BucketedEncoder:
+    """Envoltorio de SentenceTransformer con lotes por longitud"""
+
+    _threads_configured = False
+    _threads_lock = threading.Lock()
+
+    def __init__(self, model, batch_size: int = 64, num_threads: int = 0,
+                 lock: Optional[threading.Lock] = None):
+        self.model = model
+        self.batch_size = max(1, batch_size)
+        self.num_threads = num_threads
+        # Compartido por todos los usuarios del modelo; se toma por lote
+        self._lock = lock or threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        self._configure_threads()
+
+    def _configure_threads(self):
+        """Fija los hilos de torch una sola vez por proceso"""
+        if self.num_threads <= 0:
+            return
+        with BucketedEncoder._threads_lock:
+            if BucketedEncoder._threads_configured:
+                return
+            try:
+                import torch
+                torch.set_num_threads(self.num_threads)
+                BucketedEncoder._threads_configured = True
+            except Exception as e:
+                self.logger.warning(f"No se pudo fijar el numero de hilos: {str(e)}")
+
+    @property
+    def dimension(self) -> Optional[int]:
+        getter = getattr(self.model, "get_sentence_embedding_dimension", None)
+        return getter() if getter else None
+
+    def token_lengths(self, texts: List[str]) -> np.ndarray:
+        """Longitud de cada texto en tokens del modelo (caracteres si no hay tokenizer)"""
+        tokenizer = getattr(self.model, "tokenizer", None)
+        if tokenizer is not None:
+            try:
+                max_length = getattr(self.model, "max_seq_length", None) or 512
+                with self._lock:
+                    encoded = tokenizer(
+                        texts, add_special_tokens=True, truncation=True,
+                        max_length=max_length, return_attention_mask=False
+                    )
+                return np.fromiter((len(ids) for ids in encoded["input_ids"]),
+                                   dtype=np.int64, count=len(texts))
+            except Exception:
+                pass
+        return np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Codifica textos y devuelve una matriz float32 en el orden original"""
+        if not texts:
+            return np.zeros((0, self.dimension or 0), dtype=np.float32)
+
+        # Mas largos primero: el primer lote fija el pico de memoria
+        order = np.argsort(-self.token_lengths(texts), kind="stable")
+        output: Optional[np.ndarray] = None
+
+        for start in range(0, len(order), self.batch_size):
+            positions = order[start:start + self.batch_size]
+            with self._lock:
+                batch = self.model.encode(
+                    [texts[i] for i in positions],
+                    batch_size=len(positions),
+                    convert_to_numpy=True,
+                    show_progress_bar=False
+                )
+            if output is None:
+                output = np.empty((len(texts), batch.shape[1]), dtype=np.float32)
+            output[positions] = batch
+
+        return output
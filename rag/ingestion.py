@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline de ingesta en paralelo para el sistema RAG.
+
+Separa la ingesta en tres etapas que trabajan a la vez:
+  1. Parseo y chunking de los archivos pesados (.docx, .pdf, .xlsx) en un
+     pool de procesos.
+  2. Una unica etapa de embeddings que agrupa los chunks en lotes grandes.
+  3. Un escritor que vuelca los chunks al vector store en lotes.
+
+Los archivos sin cambios segun el manifiesto se omiten antes de parsearlos
+y de los modificados solo se embeben los chunks nuevos.
+"""
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from dataclasses import dataclass, field, asdict
+from typing import List, Dict, Any, Optional, Callable
+
+import numpy as np
+
+from .document_processor import DocumentProcessor, ProcessedDocument
+from .manifest import SyncPlan, hash_file
+
+# Formatos cuyo parseo es costoso y compensa enviar al pool de procesos
+PARALLEL_EXTENSIONS = {'.pdf', '.docx', '.xlsx', '.xls'}
+
+_worker_processor: Optional[DocumentProcessor] = None
+
+def _parse_in_worker(file_path: str, processor_config: Dict[str, Any]):
+    """Parsea y divide un archivo dentro de un proceso del pool"""
+    global _worker_processor
+    if _worker_processor is None:
+        _worker_processor = DocumentProcessor(**processor_config)
+
+    start_time = time.time()
+    docs = _worker_processor.process_document(file_path)
+    return docs, time.time() - start_time
+
+@dataclass
+class FileIngestionStatus:
+    """Estado de ingesta de un archivo"""
+    file_path: str
+    status: str = "pending"  # pending, parsed, done, skipped, empty, failed
+    chunks: int = 0
+    written: int = 0
+    duplicates: int = 0
+    parse_time: float = 0.0
+    error: Optional[str] = None
+
+@dataclass
+class IngestionReport:
+    """Resultado de una ejecucion del pipeline de ingesta"""
+    files: Dict[str, FileIngestionStatus] = field(default_factory=dict)
+    total_chunks: int = 0
+    duplicate_chunks: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def successful_files(self) -> int:
+        return sum(1 for f in self.files.values() if f.status in ("done", "skipped", "empty"))
+
+    @property
+    def skipped_files(self) -> int:
+        return sum(1 for f in self.files.values() if f.status == "skipped")
+
+    @property
+    def files_per_second(self) -> float:
+        return len(self.files) / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def chunks_per_second(self) -> float:
+        return self.total_chunks / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def dedup_ratio(self) -> float:
+        """Proporcion de chunks nuevos descartados por casi duplicados"""
+        checked = self.total_chunks + self.duplicate_chunks
+        return self.duplicate_chunks / checked if checked else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "files": {path: asdict(status) for path, status in self.files.items()},
+            "total_files": len(self.files),
+            "successful_files": self.successful_files,
+            "skipped_files": self.skipped_files,
+            "total_chunks": self.total_chunks,
+            "duplicate_chunks": self.duplicate_chunks,
+            "dedup_ratio": round(self.dedup_ratio, 4),
+            "elapsed": round(self.elapsed, 2),
+            "files_per_second": round(self.files_per_second, 2),
+            "chunks_per_second": round(self.chunks_per_second, 2)
+        }
+
+class IngestionPipeline:
+    """Pipeline parseo -> embeddings -> escritura para ingestas masivas"""
+
+    def __init__(self, vector_store, document_processor: DocumentProcessor,
+                 max_workers: Optional[int] = None, embed_batch_size: int = 256,
+                 write_batch_size: int = 1024, queue_size: int = 8,
+                 ingestion_params: Optional[Dict[str, Any]] = None, force: bool = False,
+                 progress_callback: Optional[Callable[[FileIngestionStatus], None]] = None):
+        self.vector_store = vector_store
+        self.document_processor = document_processor
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self.embed_batch_size = embed_batch_size
+        self.write_batch_size = write_batch_size
+        self.queue_size = queue_size
+        self.ingestion_params = ingestion_params or {
+            "chunk_size": document_processor.chunk_size,
+            "chunk_overlap": document_processor.chunk_overlap,
+            "embedding_model": vector_store.embedding_model_name
+        }
+        self.force = force
+        self.progress_callback = progress_callback
+        self.logger = logging.getLogger(__name__)
+
+        self._status_lock = threading.Lock()
+        self._report = IngestionReport()
+        self._file_hashes: Dict[str, str] = {}
+        self._plans: Dict[str, SyncPlan] = {}
+
+    def run(self, file_paths: List[str]) -> IngestionReport:
+        """Ejecuta el pipeline sobre una lista de archivos"""
+        file_paths = [str(Path(path)) for path in file_paths]
+        self._report = IngestionReport(
+            files={path: FileIngestionStatus(file_path=path) for path in file_paths}
+        )
+        self._file_hashes = {}
+        self._plans = {}
+        start_time = time.time()
+        
+        file_paths = self._filter_unchanged(file_paths)
+
+        embed_queue: "queue.Queue" = queue.Queue(maxsize=self.queue_size)
+        write_queue: "queue.Queue" = queue.Queue(maxsize=self.queue_size)
+
+        embedder = threading.Thread(
+            target=self._embed_stage, args=(embed_queue, write_queue),
+            name="rag-ingest-embed", daemon=True
+        )
+        writer = threading.Thread(
+            target=self._write_stage, args=(write_queue,),
+            name="rag-ingest-write", daemon=True
+        )
+        embedder.start()
+        writer.start()
+
+        try:
+            self._parse_stage(file_paths, embed_queue)
+        finally:
+            embed_queue.put(None)
+            embedder.join()
+            writer.join()
+
+        self._report.elapsed = time.time() - start_time
+        self._finalize_statuses()
+        self.vector_store.flush_auxiliary()
+        self.vector_store.manifest.save()
+
+        self.logger.info(
+            f"Ingesta completada: {self._report.successful_files}/{len(self._report.files)} archivos "
+            f"({self._report.skipped_files} sin cambios), "
+            f"{self._report.total_chunks} chunks en {self._report.elapsed:.2f}s "
+            f"({self._report.chunks_per_second:.1f} chunks/s)"
+        )
+        return self._report
+
+    # ------------------------------------------------------------------
+    # Etapas
+    # ------------------------------------------------------------------
+
+    def _filter_unchanged(self, file_paths: List[str]) -> List[str]:
+        """Calcula el hash de cada archivo y descarta los ya ingresados"""
+        manifest = self.vector_store.manifest
+        changed = []
+        for path in file_paths:
+            try:
+                file_hash = hash_file(path)
+            except Exception as e:
+                self._on_failed(path, f"Error leyendo archivo: {str(e)}")
+                continue
+            self._file_hashes[path] = file_hash
+            if not self.force and manifest.is_unchanged(path, file_hash, self.ingestion_params):
+                self._report.files[path].status = "skipped"
+                self._notify(self._report.files[path])
+            else:
+                changed.append(path)
+        return changed
+
+    def _parse_stage(self, file_paths: List[str], embed_queue: "queue.Queue"):
+        """Parsea archivos (pesados en el pool, ligeros en linea) y encola chunks"""
+        heavy = [p for p in file_paths if os.path.splitext(p)[1].lower() in PARALLEL_EXTENSIONS]
+        light = [p for p in file_paths if os.path.splitext(p)[1].lower() not in PARALLEL_EXTENSIONS]
+        processor_config = self.document_processor.get_config()
+
+        pending = list(heavy)
+        if heavy and self.max_workers > 1:
+            try:
+                # spawn: hacer fork con los hilos del pipeline y el modelo cargados no es seguro
+                with ProcessPoolExecutor(
+                    max_workers=min(self.max_workers, len(heavy)),
+                    mp_context=multiprocessing.get_context("spawn")
+                ) as pool:
+                    futures = {
+                        pool.submit(_parse_in_worker, path, processor_config): path
+                        for path in heavy
+                    }
+                    # Los archivos ligeros se procesan mientras el pool trabaja
+                    for path in light:
+                        self._parse_inline(path, embed_queue)
+                    light = []
+
+                    for future in as_completed(futures):
+                        path = futures[future]
+                        try:
+                            docs, parse_time = future.result()
+                        except BrokenProcessPool:
+                            raise
+                        except Exception as e:
+                            pending.remove(path)
+                            self._on_failed(path, f"Error procesando: {str(e)}")
+                            continue
+                        pending.remove(path)
+                        self._on_parsed(path, docs, parse_time, embed_queue)
+            except (BrokenProcessPool, OSError) as e:
+                self.logger.warning(f"Pool de procesos no disponible, parseando en linea: {str(e)}")
+
+        for path in light + pending:
+            self._parse_inline(path, embed_queue)
+
+    def _parse_inline(self, path: str, embed_queue: "queue.Queue"):
+        """Parsea un archivo en el hilo actual"""
+        start_time = time.time()
+        try:
+            docs = self.document_processor.process_document(path)
+            self._on_parsed(path, docs, time.time() - start_time, embed_queue)
+        except Exception as e:
+            self._on_failed(path, f"Error procesando: {str(e)}")
+
+    def _embed_stage(self, embed_queue: "queue.Queue", write_queue: "queue.Queue"):
+        """Agrupa chunks de varios archivos y genera embeddings por lotes"""
+        buffer: List[ProcessedDocument] = []
+        try:
+            while True:
+                docs = embed_queue.get()
+                if docs is None:
+                    break
+                buffer.extend(docs)
+                while len(buffer) >= self.embed_batch_size:
+                    batch, buffer = buffer[:self.embed_batch_size], buffer[self.embed_batch_size:]
+                    self._embed_batch(batch, write_queue)
+            if buffer:
+                self._embed_batch(buffer, write_queue)
+        finally:
+            write_queue.put(None)
+
+    def _embed_batch(self, batch: List[ProcessedDocument], write_queue: "queue.Queue"):
+        try:
+            embeddings = self.vector_store.encode_texts([doc.content for doc in batch])
+            write_queue.put((batch, embeddings))
+        except Exception as e:
+            for source in {doc.source for doc in batch}:
+                self._on_failed(source, f"Error generando embeddings: {str(e)}")
+
+    def _write_stage(self, write_queue: "queue.Queue"):
+        """Vuelca los chunks con embeddings al vector store en lotes grandes"""
+        docs_buffer: List[ProcessedDocument] = []
+        embeddings_buffer: List[np.ndarray] = []
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            docs, embeddings = item
+            docs_buffer.extend(docs)
+            embeddings_buffer.append(embeddings)
+            if len(docs_buffer) >= self.write_batch_size:
+                self._flush(docs_buffer, embeddings_buffer)
+                docs_buffer, embeddings_buffer = [], []
+        if docs_buffer:
+            self._flush(docs_buffer, embeddings_buffer)
+
+    def _flush(self, docs: List[ProcessedDocument], embeddings: List[np.ndarray]):
+        if self.vector_store.add_documents(docs, embeddings=np.vstack(embeddings)):
+            self._on_written(docs)
+        else:
+            for source in {doc.source for doc in docs}:
+                self._on_failed(source, "Error escribiendo en el vector store")
+
+    # ------------------------------------------------------------------
+    # Seguimiento de estado por archivo
+    # ------------------------------------------------------------------
+
+    def _on_parsed(self, path: str, docs: List[ProcessedDocument], parse_time: float,
+                   embed_queue: "queue.Queue"):
+        if not docs:
+            with self._status_lock:
+                status = self._report.files[path]
+                status.parse_time = parse_time
+                status.status = "empty"
+            self.logger.warning(f"No se pudo procesar el documento: {path}")
+            self._notify(status)
+            return
+
+        manifest = self.vector_store.manifest
+        if self.force:
+            manifest.remove(path, save=False)
+        plan = manifest.plan(path, self._file_hashes[path], docs, self.ingestion_params)
+        if not self.vector_store.prepare_sync(plan):
+            self._on_failed(path, "Error sincronizando con el vector store")
+            return
+
+        # Los registros de duplicados se confirman cuando el archivo queda escrito
+        to_embed = self.vector_store.filter_duplicates(plan.to_upsert, stage=path)
+
+        with self._status_lock:
+            status = self._report.files[path]
+            status.parse_time = parse_time
+            status.chunks = len(to_embed)
+            status.duplicates = len(plan.to_upsert) - len(to_embed)
+            self._report.total_chunks += len(to_embed)
+            self._report.duplicate_chunks += status.duplicates
+            if to_embed:
+                status.status = "parsed"
+                self._plans[path] = plan
+            else:
+                status.status = "done"
+                manifest.commit(plan, save=False)
+
+        if to_embed:
+            embed_queue.put(to_embed)
+        else:
+            self.vector_store.commit_duplicates(path)
+            self._notify(status)
+
+    def _on_written(self, docs: List[ProcessedDocument]):
+        finished = []
+        with self._status_lock:
+            for doc in docs:
+                status = self._report.files.get(doc.source)
+                if status is None:
+                    continue
+                status.written += 1
+                if status.written == status.chunks and status.status == "parsed":
+                    status.status = "done"
+                    self.vector_store.manifest.commit(
+                        self._plans.pop(doc.source), save=False
+                    )
+                    finished.append(status)
+
+        for status in finished:
+            self.vector_store.commit_duplicates(status.file_path)
+            self.logger.info(
+                f"Documento ingresado: {status.file_path} ({status.chunks} chunks, "
+                f"parseo {status.parse_time:.2f}s)"
+            )
+            self._notify(status)
+
+    def _on_failed(self, path: str, error: str):
+        with self._status_lock:
+            status = self._report.files.get(path)
+            if status is None or status.status == "failed":
+                return
+            status.status = "failed"
+            status.error = error
+
+        affected = self.vector_store.discard_duplicates(path)
+        self.logger.error(f"{error} ({path})")
+        self._notify(status)
+        for source in affected:
+            self._on_failed(source, f"Casi duplicados de chunks no escritos de {path}")
+
+    def _finalize_statuses(self):
+        with self._status_lock:
+            unfinished = [status for status in self._report.files.values()
+                          if status.status in ("pending", "parsed")]
+            for status in unfinished:
+                status.status = "failed"
+                status.error = status.error or "Ingesta incompleta"
+        for status in unfinished:
+            for source in self.vector_store.discard_duplicates(status.file_path):
+                self._on_failed(source, f"Casi duplicados de chunks no escritos de {status.file_path}")
+
+    def _notify(self, status: FileIngestionStatus):
+        if self.progress_callback:
+            try:
+                self.progress_callback(status)
+            except Exception as e:
+                self.logger.warning(f"Error en callback de progreso: {str(e)}")
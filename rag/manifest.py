@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Manifiesto persistente de ingesta.
+
+Guarda, por cada documento ingresado, el hash del archivo, los parametros
+del chunker, el modelo de embeddings y el hash de cada chunk. Con esto una
+re-ingesta solo procesa lo que cambio: se omiten archivos identicos, se
+re-embeben solo los chunks nuevos o modificados y se eliminan los huerfanos.
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+
+MANIFEST_FILENAME = "ingestion_manifest.json"
+MANIFEST_VERSION = 1
+
+def hash_file(file_path: str, block_size: int = 1 << 20) -> str:
+    """Calcula el hash SHA-256 de un archivo leyendolo por bloques"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def hash_text(text: str) -> str:
+    """Calcula el hash SHA-256 de un texto"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def chunk_id(source: str, chunk_hash: str) -> str:
+    """Identificador estable de un chunk basado en su contenido"""
+    return f"{source}_{chunk_hash[:16]}"
+
+@dataclass
+class SyncPlan:
+    """Cambios necesarios para sincronizar un documento con el vector store"""
+    source: str
+    file_hash: str
+    params: Dict[str, Any]
+    chunks: Dict[str, str] = field(default_factory=dict)  # id -> hash
+    to_upsert: List[Any] = field(default_factory=list)
+    to_update: List[Any] = field(default_factory=list)
+    orphan_ids: List[str] = field(default_factory=list)
+    replace_source: bool = False
+    rebuild: bool = False
+    previous: Dict[str, str] = field(default_factory=dict, repr=False)
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.to_upsert or self.to_update or self.orphan_ids or self.replace_source)
+
+class IngestionManifest:
+    """Manifiesto JSON con el estado de ingesta de cada documento"""
+
+    def __init__(self, persist_directory: str):
+        self.path = os.path.join(persist_directory, MANIFEST_FILENAME)
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.RLock()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.load()
+
+    def load(self):
+        """Carga el manifiesto desde disco"""
+        with self._lock:
+            if not os.path.exists(self.path):
+                self.entries = {}
+                return
+            try:
+                with open(self.path, 'r', encoding='utf-8') as file:
+                    data = json.load(file)
+                self.entries = data.get("documents", {})
+            except Exception as e:
+                self.logger.error(f"Error leyendo manifiesto de ingesta: {str(e)}")
+                self.entries = {}
+
+    def save(self):
+        """Guarda el manifiesto de forma atomica"""
+        with self._lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump(
+                    {"version": MANIFEST_VERSION, "documents": self.entries},
+                    file, ensure_ascii=False
+                )
+            os.replace(tmp_path, self.path)
+
+    def get(self, source: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self.entries.get(source)
+
+    def sources(self) -> List[str]:
+        with self._lock:
+            return list(self.entries.keys())
+
+    def is_unchanged(self, source: str, file_hash: str, params: Dict[str, Any]) -> bool:
+        """Indica si el documento ya esta ingresado con el mismo contenido y parametros"""
+        entry = self.get(source)
+        return bool(entry and entry["file_hash"] == file_hash and entry["params"] == params)
+
+    def plan(self, source: str, file_hash: str, docs: List[Any],
+             params: Dict[str, Any]) -> SyncPlan:
+        """Calcula que chunks hay que embeber, actualizar o eliminar"""
+        plan = self.begin_plan(source, file_hash, params)
+        to_upsert, to_update = self.classify(plan, docs)
+        plan.to_upsert.extend(to_upsert)
+        plan.to_update.extend(to_update)
+        self.finish_plan(plan)
+        return plan
+
+    def begin_plan(self, source: str, file_hash: str, params: Dict[str, Any]) -> SyncPlan:
+        """Inicia un plan incremental; los chunks se clasifican por lotes con classify"""
+        entry = self.get(source)
+        plan = SyncPlan(source=source, file_hash=file_hash, params=params)
+
+        # Sin entrada previa: puede haber chunks antiguos con ids por indice
+        plan.replace_source = entry is None
+        plan.rebuild = entry is None or entry["params"] != params
+        plan.previous = {} if entry is None else entry["chunks"]
+        return plan
+
+    def classify(self, plan: SyncPlan, docs: Iterable[Any]) -> Tuple[List[Any], List[Any]]:
+        """Clasifica un lote de chunks en (a embeber, sin cambios) y los registra en el plan"""
+        to_upsert, to_update = [], []
+        for doc in docs:
+            doc_hash = hash_text(doc.content)
+            doc_id = chunk_id(plan.source, doc_hash)
+            if doc_id in plan.chunks:
+                # Chunk identico repetido dentro del mismo documento
+                continue
+            doc.metadata['chunk_hash'] = doc_hash
+            plan.chunks[doc_id] = doc_hash
+
+            if plan.rebuild or doc_id not in plan.previous:
+                to_upsert.append(doc)
+            else:
+                to_update.append(doc)
+        return to_upsert, to_update
+
+    def finish_plan(self, plan: SyncPlan):
+        """Calcula los chunks huerfanos una vez clasificado todo el documento"""
+        if not plan.replace_source:
+            plan.orphan_ids = [doc_id for doc_id in plan.previous if doc_id not in plan.chunks]
+
+    def commit(self, plan: SyncPlan, save: bool = True):
+        """Registra un plan ya aplicado al vector store"""
+        with self._lock:
+            self.entries[plan.source] = {
+                "file_hash": plan.file_hash,
+                "params": plan.params,
+                "chunks": plan.chunks,
+                "updated_at": datetime.now().isoformat()
+            }
+            if save:
+                self.save()
+
+    def remove(self, source: str, save: bool = True) -> bool:
+        """Elimina un documento del manifiesto"""
+        with self._lock:
+            removed = self.entries.pop(source, None) is not None
+            if removed and save:
+                self.save()
+            return removed
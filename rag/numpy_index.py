@@ -0,0 +1,587 @@
+# -*- coding: utf-8 -*-
+"""
+Backend vectorial local con NumPy.
+
+Guarda los vectores normalizados en float16 en un archivo mapeado en memoria
+(carga en milisegundos y paginas compartidas entre procesos), usa top-k
+exacto por producto de matrices para corpus pequeños y un indice IVF
+(particiones k-means) para corpus grandes. Los filtros de metadatos se
+resuelven con mascaras booleanas precalculadas.
+
+Con dtype="int8" cada vector se cuantiza con su propia escala (4x menos
+memoria que float32). La busqueda se hace sobre los vectores cuantizados y
+la lista corta de candidatos se puntua de nuevo con los vectores en float32
+de un archivo auxiliar mapeado en memoria, del que solo se leen esas filas.
+
+Los registros (id, documento, metadatos y particion IVF de cada fila) viven
+en SQLite. Las escrituras solo marcan filas sucias y flush() guarda
+unicamente esas filas, asi que persistir tras cada lote cuesta lo que el
+lote y no lo que el indice entero.
+"""
+import os
+import json
+import sqlite3
+import logging
+import threading
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+
+from .backends import VectorBackend
+
+RECORDS_VERSION = 1
+_BLOCK_ROWS = 65536
+
+def matches_where(metadata: Optional[Dict[str, Any]], where: Optional[Dict[str, Any]]) -> bool:
+    """Evalua un filtro estilo ChromaDB sobre unos metadatos"""
+    if not where:
+        return True
+    if metadata is None:
+        return False
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches_where(metadata, sub) for sub in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_where(metadata, sub) for sub in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for operator, expected in condition.items():
+                if operator == "$eq" and value != expected:
+                    return False
+                if operator == "$ne" and value == expected:
+                    return False
+                if operator == "$in" and value not in expected:
+                    return False
+                if operator == "$nin" and value in expected:
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+class NumpyBackend(VectorBackend):
+    """Indice vectorial plano/IVF sobre np.memmap"""
+
+    name = "numpy"
+
+    def __init__(self, persist_directory: str, collection_name: str,
+                 dtype: str = "float16", ivf_threshold: int = 50000,
+                 ivf_nprobe: int = 8, read_only: bool = False,
+                 exact_rerank: Optional[bool] = None, rerank_factor: int = 4):
+        self.directory = os.path.join(persist_directory, "numpy_index", collection_name)
+        self.data_directory = self.directory
+        self.dtype = np.dtype(dtype)
+        self.quantized = self.dtype == np.int8
+        # Re-puntuacion exacta: por defecto solo con int8; sin sentido en float32
+        if exact_rerank is None:
+            exact_rerank = self.quantized
+        self.exact_rerank = bool(exact_rerank) and self.dtype != np.float32
+        self.rerank_factor = max(1, rerank_factor)
+        self.ivf_threshold = ivf_threshold
+        self.ivf_nprobe = ivf_nprobe
+        self.read_only = read_only
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.RLock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.vectors_path = os.path.join(self.directory, f"vectors.{self.dtype.name}")
+        self.records_path = os.path.join(self.directory, "records.sqlite3")
+        self.ivf_path = os.path.join(self.directory, "ivf.npz")
+        self.scales_path = os.path.join(self.directory, "scales.float32")
+        self.exact_path = os.path.join(self.directory, "vectors.exact.float32")
+
+        self.dim: Optional[int] = None
+        self.capacity = 0
+        self._vectors: Optional[np.memmap] = None
+        # Escala por vector (int8) y copia float32 para la re-puntuacion exacta
+        self._scales: Optional[np.memmap] = None
+        self._exact: Optional[np.memmap] = None
+
+        # Registros por fila (None en filas libres)
+        self.ids: List[Optional[str]] = []
+        self.documents: List[Optional[str]] = []
+        self.metadatas: List[Optional[Dict[str, Any]]] = []
+        self.id_to_row: Dict[str, int] = {}
+        self.free_rows: List[int] = []
+
+        # Cambios pendientes de persistir (ver flush)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._dirty_rows = set()
+        self._ivf_dirty = False
+
+        self._active = np.zeros(0, dtype=bool)
+        self._mask_cache: Dict[str, np.ndarray] = {}
+
+        # IVF
+        self._centroids: Optional[np.ndarray] = None
+        self._assign: Optional[np.ndarray] = None
+        self._ivf_lists: Optional[List[np.ndarray]] = None
+        self._ivf_trained_size = 0
+
+        self._load()
+
+    # ------------------------------------------------------------------
+    # Persistencia
+    # ------------------------------------------------------------------
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        exists = os.path.exists(self.records_path)
+        if self.read_only:
+            if not exists:
+                return None
+            return sqlite3.connect(f"file:{self.records_path}?mode=ro", uri=True,
+                                   check_same_thread=False)
+        conn = sqlite3.connect(self.records_path, check_same_thread=False)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            " row INTEGER PRIMARY KEY,"
+            " id TEXT NOT NULL,"
+            " document TEXT,"
+            " metadata TEXT,"
+            " cluster INTEGER)"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+        conn.commit()
+        return conn
+
+    def _load(self):
+        try:
+            self._conn = self._connect()
+            if self._conn is None:
+                return
+            meta = dict(self._conn.execute("SELECT key, value FROM meta"))
+            if meta.get("version") != RECORDS_VERSION:
+                return
+
+            rows = meta.get("rows", 0)
+            self.ids = [None] * rows
+            self.documents = [None] * rows
+            self.metadatas = [None] * rows
+            clusters = {}
+            for row, doc_id, document, metadata, cluster in self._conn.execute(
+                    "SELECT row, id, document, metadata, cluster FROM records"):
+                self.ids[row] = doc_id
+                self.documents[row] = document
+                self.metadatas[row] = json.loads(metadata) if metadata else {}
+                if cluster is not None:
+                    clusters[row] = cluster
+            self.id_to_row = {doc_id: row for row, doc_id in enumerate(self.ids) if doc_id is not None}
+            self.free_rows = [row for row, doc_id in enumerate(self.ids) if doc_id is None]
+            if meta.get("dim"):
+                self._open_vectors(meta["dim"], meta["capacity"])
+            self._active = np.zeros(self.capacity, dtype=bool)
+            self._active[list(self.id_to_row.values())] = True
+            if os.path.exists(self.ivf_path):
+                ivf = np.load(self.ivf_path)
+                self._centroids = ivf["centroids"]
+                self._ivf_trained_size = int(ivf["trained_size"])
+                self._assign = np.full(self.capacity, -1, dtype=np.int32)
+                if clusters:
+                    self._assign[list(clusters)] = list(clusters.values())
+        except Exception as e:
+            self.logger.error(f"Error cargando indice NumPy: {str(e)}")
+
+    def _open_memmap(self, path: str, dtype: Any, shape: Tuple[int, ...]) -> np.memmap:
+        mode = "r" if self.read_only else "r+"
+        if not os.path.exists(path):
+            mode = "w+"
+        return np.memmap(path, dtype=dtype, mode=mode, shape=shape)
+
+    def _open_vectors(self, dim: int, capacity: int):
+        self.dim = dim
+        self.capacity = capacity
+        exact_missing = self.exact_rerank and not os.path.exists(self.exact_path)
+        self._vectors = self._open_memmap(self.vectors_path, self.dtype, (capacity, dim))
+        if self.quantized:
+            self._scales = self._open_memmap(self.scales_path, np.float32, (capacity,))
+        if self.exact_rerank:
+            if exact_missing and self.read_only:
+                self.exact_rerank = False
+                return
+            self._exact = self._open_memmap(self.exact_path, np.float32, (capacity, dim))
+            if exact_missing and capacity:
+                # Indice creado sin copia exacta: se parte de los vectores almacenados
+                for start in range(0, capacity, _BLOCK_ROWS):
+                    block = np.arange(start, min(capacity, start + _BLOCK_ROWS))
+                    self._exact[block] = self._read_vectors(block, exact=False)
+
+    def _files(self) -> List[Tuple[str, int]]:
+        """Archivos por fila y bytes que ocupa cada fila"""
+        files = [(self.vectors_path, self.dim * self.dtype.itemsize)]
+        if self.quantized:
+            files.append((self.scales_path, 4))
+        if self.exact_rerank:
+            files.append((self.exact_path, self.dim * 4))
+        return files
+
+    def _flush(self):
+        for array in (self._vectors, self._scales, self._exact):
+            if array is not None:
+                array.flush()
+
+    def _grow(self, min_capacity: int):
+        """Amplia los archivos de vectores (extension dispersa, sin copia)"""
+        new_capacity = max(min_capacity, self.capacity * 2, 1024)
+        self._flush()
+        self._vectors = self._scales = self._exact = None
+        for path, row_bytes in self._files():
+            with open(path, 'ab') as file:
+                file.truncate(new_capacity * row_bytes)
+        self._open_vectors(self.dim, new_capacity)
+
+        # Las estructuras por fila crecen con la capacidad
+        extra = new_capacity - len(self._active)
+        self._active = np.concatenate([self._active, np.zeros(extra, dtype=bool)])
+        if self._assign is not None:
+            self._assign = np.concatenate([self._assign, np.full(extra, -1, dtype=np.int32)])
+
+    def _record(self, row: int) -> tuple:
+        metadata = self.metadatas[row]
+        cluster = None
+        if self._assign is not None and self._assign[row] >= 0:
+            cluster = int(self._assign[row])
+        return (row, self.ids[row], self.documents[row],
+                json.dumps(metadata, ensure_ascii=False) if metadata else None, cluster)
+
+    def flush(self):
+        """Guarda en disco los vectores, las filas modificadas y el IVF"""
+        if self.read_only:
+            return
+        with self._lock:
+            if self._conn is None:
+                # Cerrado al desalojar el proyecto: se reabre para no perder escrituras
+                self._conn = self._connect()
+            # Primero los vectores: un registro nunca apunta a una fila sin escribir
+            self._flush()
+            dirty = sorted(self._dirty_rows)
+            with self._conn:
+                self._conn.executemany(
+                    "DELETE FROM records WHERE row = ?",
+                    [(row,) for row in dirty if self.ids[row] is None]
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)",
+                    [self._record(row) for row in dirty if self.ids[row] is not None]
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                    [("version", RECORDS_VERSION), ("dim", self.dim),
+                     ("capacity", self.capacity), ("rows", len(self.ids))]
+                )
+            self._dirty_rows.clear()
+            if self._ivf_dirty and self._centroids is not None:
+                tmp_path = f"{self.ivf_path}.tmp.npz"
+                np.savez(tmp_path, centroids=self._centroids,
+                         trained_size=self._ivf_trained_size)
+                os.replace(tmp_path, self.ivf_path)
+            self._ivf_dirty = False
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # ------------------------------------------------------------------
+    # Escritura
+    # ------------------------------------------------------------------
+
+    def _invalidate(self):
+        self._mask_cache.clear()
+        self._ivf_lists = None
+
+    def _allocate_row(self) -> int:
+        if self.free_rows:
+            return self.free_rows.pop()
+        row = len(self.ids)
+        if row >= self.capacity:
+            self._grow(row + 1)
+        self.ids.append(None)
+        self.documents.append(None)
+        self.metadatas.append(None)
+        return row
+
+    def upsert(self, ids, documents, metadatas, embeddings):
+        if self.read_only:
+            raise RuntimeError("Indice NumPy abierto en solo lectura")
+        vectors = _normalize(embeddings)
+        with self._lock:
+            if self._vectors is None:
+                self.dim = vectors.shape[1]
+                self.capacity = 0
+                self._grow(len(ids))
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Dimension {vectors.shape[1]} distinta de la del indice ({self.dim})")
+
+            rows = []
+            for doc_id, document, metadata in zip(ids, documents, metadatas):
+                row = self.id_to_row.get(doc_id)
+                if row is None:
+                    row = self._allocate_row()
+                    self.id_to_row[doc_id] = row
+                self.ids[row] = doc_id
+                self.documents[row] = document
+                self.metadatas[row] = dict(metadata) if metadata else {}
+                self._active[row] = True
+                self._dirty_rows.add(row)
+                rows.append(row)
+
+            rows = np.asarray(rows, dtype=np.int64)
+            self._write_vectors(rows, vectors)
+            if self._centroids is not None:
+                self._assign[rows] = np.argmax(vectors @ self._centroids.T, axis=1)
+            self._invalidate()
+
+    def _write_vectors(self, rows: np.ndarray, vectors: np.ndarray):
+        if self.quantized:
+            # Escala simetrica por vector: el mayor componente se lleva a 127
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            self._vectors[rows] = np.round(vectors / scales[:, None]).astype(np.int8)
+            self._scales[rows] = scales
+        else:
+            self._vectors[rows] = vectors.astype(self.dtype)
+        if self._exact is not None:
+            self._exact[rows] = vectors
+
+    def _read_vectors(self, rows: np.ndarray, exact: bool = True) -> np.ndarray:
+        """Vectores en float32 (de la copia exacta si existe y se pide)"""
+        if exact and self._exact is not None:
+            return np.asarray(self._exact[rows], dtype=np.float32)
+        vectors = np.asarray(self._vectors[rows], dtype=np.float32)
+        if self.quantized:
+            vectors *= self._scales[rows][..., None]
+        return vectors
+
+    def update(self, ids, metadatas):
+        with self._lock:
+            for doc_id, metadata in zip(ids, metadatas):
+                row = self.id_to_row.get(doc_id)
+                if row is not None:
+                    self.metadatas[row] = dict(metadata) if metadata else {}
+                    self._dirty_rows.add(row)
+            self._invalidate()
+
+    def delete(self, ids):
+        with self._lock:
+            for doc_id in ids:
+                row = self.id_to_row.pop(doc_id, None)
+                if row is None:
+                    continue
+                self.ids[row] = None
+                self.documents[row] = None
+                self.metadatas[row] = None
+                self._active[row] = False
+                if self._assign is not None:
+                    self._assign[row] = -1
+                self.free_rows.append(row)
+                self._dirty_rows.add(row)
+            self._invalidate()
+
+    # ------------------------------------------------------------------
+    # Lectura
+    # ------------------------------------------------------------------
+
+    def count(self) -> int:
+        return len(self.id_to_row)
+
+    def _where_mask(self, where: Optional[Dict[str, Any]]) -> np.ndarray:
+        """Mascara booleana de filas activas que cumplen el filtro (cacheada)"""
+        if not where:
+            return self._active
+        key = repr(sorted(where.items(), key=lambda item: item[0]))
+        mask = self._mask_cache.get(key)
+        if mask is None:
+            mask = np.zeros(len(self._active), dtype=bool)
+            for row, metadata in enumerate(self.metadatas):
+                if metadata is not None and matches_where(metadata, where):
+                    mask[row] = True
+            self._mask_cache[key] = mask
+        return mask
+
+    def _rows_result(self, rows: List[int], include: List[str]) -> Dict[str, Any]:
+        result: Dict[str, Any] = {"ids": [self.ids[row] for row in rows]}
+        if "documents" in include:
+            result["documents"] = [self.documents[row] for row in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [self.metadatas[row] for row in rows]
+        if "embeddings" in include:
+            result["embeddings"] = [self._read_vectors(row) for row in rows]
+        return result
+
+    def get(self, ids=None, where=None, include=None):
+        include = include if include is not None else ["documents", "metadatas"]
+        with self._lock:
+            if ids is not None:
+                rows = [self.id_to_row[doc_id] for doc_id in ids if doc_id in self.id_to_row]
+                rows = [row for row in rows if matches_where(self.metadatas[row], where)]
+            else:
+                rows = np.flatnonzero(self._where_mask(where)).tolist()
+            return self._rows_result(rows, include)
+
+    def query(self, query_embeddings, n_results=5, where=None, include=None):
+        include = include if include is not None else ["documents", "metadatas", "distances"]
+        queries = _normalize(query_embeddings)
+        result: Dict[str, Any] = {key: [] for key in ["ids"] + list(include)}
+
+        with self._lock:
+            if self._vectors is None or self.count() == 0:
+                for key in result:
+                    result[key] = [[] for _ in range(len(queries))]
+                return result
+
+            mask = self._where_mask(where)
+            if self._use_ivf():
+                hits = [self._ivf_search(query, n_results, mask) for query in queries]
+            else:
+                hits = self._flat_search(queries, n_results, np.flatnonzero(mask))
+
+            for rows, scores in hits:
+                rows_result = self._rows_result(rows.tolist(), include)
+                for key, values in rows_result.items():
+                    result[key].append(values)
+                if "distances" in include:
+                    # Distancia L2 al cuadrado entre vectores unitarios
+                    result["distances"].append((2.0 - 2.0 * scores).tolist())
+        return result
+
+    def _score_rows(self, queries: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Producto escalar (m consultas x n filas) procesando por bloques"""
+        scores = np.empty((len(queries), len(rows)), dtype=np.float32)
+        for start in range(0, len(rows), _BLOCK_ROWS):
+            block = rows[start:start + _BLOCK_ROWS]
+            vectors = np.asarray(self._vectors[block], dtype=np.float32)
+            block_scores = queries @ vectors.T
+            if self.quantized:
+                block_scores *= self._scales[block]
+            scores[:, start:start + len(block)] = block_scores
+        return scores
+
+    def _shortlist_k(self, k: int) -> int:
+        return k * self.rerank_factor if self._exact is not None else k
+
+    def _rerank(self, query: np.ndarray, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Re-puntua la lista corta con los vectores float32 (lectura en orden de fila)"""
+        order = np.argsort(rows)
+        exact = np.asarray(self._exact[rows[order]], dtype=np.float32) @ query
+        return self._top_k(rows[order], exact, k)
+
+    @staticmethod
+    def _top_k(rows: np.ndarray, scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        if len(rows) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(rows))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return rows[top], scores[top]
+
+    def _flat_search(self, queries: np.ndarray, k: int,
+                     rows: np.ndarray) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Top-k exacto por producto de matrices"""
+        if len(rows) == 0:
+            return [(rows, np.zeros(0, dtype=np.float32)) for _ in queries]
+        scores = self._score_rows(queries, rows)
+        shortlist_k = self._shortlist_k(k)
+        hits = [self._top_k(rows, scores[i], shortlist_k) for i in range(len(queries))]
+        if self._exact is None:
+            return hits
+        return [self._rerank(queries[i], hit_rows, k) for i, (hit_rows, _) in enumerate(hits)]
+
+    # ------------------------------------------------------------------
+    # IVF
+    # ------------------------------------------------------------------
+
+    def _use_ivf(self) -> bool:
+        active = self.count()
+        if active < self.ivf_threshold:
+            return False
+        if self._centroids is None or active > 2 * self._ivf_trained_size:
+            self.build_ivf()
+        return self._centroids is not None
+
+    def build_ivf(self, iterations: int = 10, seed: int = 0):
+        """Entrena las particiones k-means y asigna cada fila a su lista"""
+        with self._lock:
+            rows = np.flatnonzero(self._active)
+            if len(rows) == 0:
+                return
+            nlist = int(min(1024, max(8, np.sqrt(len(rows)))))
+            rng = np.random.default_rng(seed)
+            sample = rng.choice(rows, size=min(len(rows), nlist * 64), replace=False)
+            data = self._read_vectors(np.sort(sample), exact=False)
+            centroids = data[rng.choice(len(data), size=nlist, replace=False)]
+
+            for _ in range(iterations):
+                labels = np.argmax(data @ centroids.T, axis=1)
+                for cluster in range(nlist):
+                    members = data[labels == cluster]
+                    if len(members):
+                        centroids[cluster] = members.mean(axis=0)
+                centroids = _normalize(centroids)
+
+            assign = np.full(len(self._active), -1, dtype=np.int32)
+            for start in range(0, len(rows), _BLOCK_ROWS):
+                block = rows[start:start + _BLOCK_ROWS]
+                vectors = self._read_vectors(block, exact=False)
+                assign[block] = np.argmax(vectors @ centroids.T, axis=1)
+
+            self._centroids = centroids
+            self._assign = assign
+            self._ivf_trained_size = len(rows)
+            self._ivf_lists = None
+            # Todas las filas cambian de particion; se persiste en el proximo flush
+            self._dirty_rows.update(rows.tolist())
+            self._ivf_dirty = True
+            self.logger.info(f"Indice IVF construido: {nlist} listas para {len(rows)} vectores")
+
+    def _lists(self) -> List[np.ndarray]:
+        if self._ivf_lists is None:
+            order = np.argsort(self._assign, kind="stable")
+            sorted_assign = self._assign[order]
+            bounds = np.searchsorted(sorted_assign, np.arange(len(self._centroids) + 1))
+            self._ivf_lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self._centroids))]
+        return self._ivf_lists
+
+    def _ivf_search(self, query: np.ndarray, k: int,
+                    mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Busca solo en las nprobe particiones mas cercanas a la consulta"""
+        lists = self._lists()
+        nprobe = min(self.ivf_nprobe, len(lists))
+        probed = np.argpartition(-(self._centroids @ query), nprobe - 1)[:nprobe]
+        rows = np.concatenate([lists[cluster] for cluster in probed])
+        rows = rows[mask[rows]]
+        if len(rows) < k:
+            # Filtros muy selectivos: recurrir a la busqueda exacta
+            rows = np.flatnonzero(mask)
+        if len(rows) == 0:
+            return rows, np.zeros(0, dtype=np.float32)
+        scores = self._score_rows(query[None, :], rows)[0]
+        hit_rows, hit_scores = self._top_k(rows, scores, self._shortlist_k(k))
+        if self._exact is None:
+            return hit_rows, hit_scores
+        return self._rerank(query, hit_rows, k)
+
+    def get_stats(self) -> Dict[str, Any]:
+        dim = self.dim or 0
+        # Bytes por vector que recorre la busqueda (codigos + escala)
+        search_bytes = dim * self.dtype.itemsize + (4 if self.quantized else 0)
+        return {
+            "backend": self.name,
+            "vectors": self.count(),
+            "capacity": self.capacity,
+            "dtype": self.dtype.name,
+            "exact_rerank": self._exact is not None,
+            "index_bytes": self.count() * search_bytes,
+            "float32_bytes": self.count() * dim * 4,
+            "ivf_lists": len(self._centroids) if self._centroids is not None else 0
+        }
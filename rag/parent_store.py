@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Almacen de ventanas padre para la recuperacion jerarquica (small-to-big).
+
+En modo jerarquico solo se embeben chunks hijos pequeños (grupos de
+frases); el texto completo de su ventana padre (seccion o escena) se guarda
+aqui, comprimido y direccionable por (source, indice del padre), y se
+recupera al resolver los resultados de una busqueda.
+"""
+import os
+import json
+import zlib
+import sqlite3
+import logging
+import threading
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Iterator
+
+PARENT_STORE_FILENAME = "parent_windows.sqlite3"
+
+class ParentStore:
+    """Textos de ventanas padre en SQLite con compresion zlib"""
+
+    def __init__(self, persist_directory: str):
+        self.path = os.path.join(persist_directory, PARENT_STORE_FILENAME)
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.RLock()
+        os.makedirs(persist_directory, exist_ok=True)
+        self._connection: Optional[sqlite3.Connection] = None
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS parents ("
+            " source TEXT NOT NULL,"
+            " parent_index INTEGER NOT NULL,"
+            " content BLOB NOT NULL,"
+            " metadata TEXT NOT NULL,"
+            " PRIMARY KEY (source, parent_index))"
+        )
+        self._conn.commit()
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """Conexion abierta bajo demanda (se reabre tras close)"""
+        with self._lock:
+            if self._connection is None:
+                self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            return self._connection
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def put_many(self, parents: Iterable[Tuple[str, int, str, Dict[str, Any]]]):
+        """Guarda ventanas (source, parent_index, texto, metadatos)"""
+        rows = [
+            (source, int(index), zlib.compress(text.encode('utf-8')),
+             json.dumps(metadata, ensure_ascii=False))
+            for source, index, text, metadata in parents
+        ]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO parents VALUES (?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+
+    def get_many(self, keys: List[Tuple[str, int]]) -> Dict[Tuple[str, int], Dict[str, Any]]:
+        """Obtiene ventanas por (source, parent_index)"""
+        found: Dict[Tuple[str, int], Dict[str, Any]] = {}
+        if not keys:
+            return found
+        with self._lock:
+            for source, index in set(keys):
+                row = self._conn.execute(
+                    "SELECT content, metadata FROM parents WHERE source = ? AND parent_index = ?",
+                    (source, int(index))
+                ).fetchone()
+                if row is not None:
+                    found[(source, index)] = {
+                        "content": zlib.decompress(row[0]).decode('utf-8'),
+                        "metadata": json.loads(row[1])
+                    }
+        return found
+
+    def iter_all(self) -> Iterator[Tuple[str, int, str, Dict[str, Any]]]:
+        """Recorre todas las ventanas (source, parent_index, texto, metadatos)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT source, parent_index, content, metadata FROM parents"
+                " ORDER BY source, parent_index"
+            ).fetchall()
+        for source, index, content, metadata in rows:
+            yield source, index, zlib.decompress(content).decode('utf-8'), json.loads(metadata)
+
+    def delete_source(self, source: str) -> int:
+        """Elimina todas las ventanas de una fuente"""
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM parents WHERE source = ?", (source,))
+            self._conn.commit()
+            return cursor.rowcount
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM parents")
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM parents").fetchone()[0]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Numero de ventanas y tamaño en disco"""
+        with self._lock:
+            count, stored = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(content)), 0) FROM parents"
+            ).fetchone()
+        return {
+            "parents": count,
+            "compressed_bytes": stored,
+            "file_bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        }
@@ -1,34 +1,141 @@
 # -*- coding: utf-8 -*-
+import os
 import logging
-from typing import List, Dict, Any, Optional
+import functools
+import itertools
+from typing import List, Dict, Any, Optional, Callable
 from pathlib import Path
 
 from .document_processor import DocumentProcessor, ProcessedDocument
 from .vector_store import VectorStore
+from .registry import get_vector_store, use_vector_store, rag_setting
+from .ingestion import IngestionPipeline, IngestionReport
+from .manifest import hash_file
+from .context_packer import ContextPacker
+from .retrieval import mmr_select, CrossEncoderReranker
+
+def _holds_store(method):
+    """Reserva el VectorStore del proyecto durante la llamada (el LRU no lo cierra)"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with use_vector_store(
+            self.vector_store_path, self.embedding_model, self.backend, self.project
+        ):
+            return method(self, *args, **kwargs)
+    return wrapper
 
 class RAGManager:
-    """Gestor principal del sistema RAG"""
+    """Gestor principal del sistema RAG
+    
+    project selecciona el espacio de nombres (coleccion, manifiesto, BM25 y
+    caches propios); sin project se usa la coleccion por defecto.
+    """
     
     def __init__(self, vector_store_path: str = "./rag/vectorstore",
-                 embedding_model: str = "all-MiniLM-L6-v2"):
-        self.document_processor = DocumentProcessor()
-        self.vector_store = VectorStore(vector_store_path, embedding_model)
+                 embedding_model: str = "all-MiniLM-L6-v2",
+                 backend: Optional[str] = None,
+                 project: Optional[str] = None):
+        self.document_processor = DocumentProcessor(
+            chunking=rag_setting("chunking_strategy", "structured"),
+            chunk_tokens=rag_setting("chunk_max_tokens", 240),
+            chunk_overlap_tokens=rag_setting("chunk_overlap_tokens", 32),
+            embedding_model=embedding_model,
+            hierarchical=rag_setting("hierarchical_retrieval", False),
+            parent_tokens=rag_setting("parent_chunk_tokens", 768),
+            child_tokens=rag_setting("child_chunk_tokens", 64)
+        )
+        self.vector_store_path = vector_store_path
+        self.embedding_model = embedding_model
+        self.backend = backend
+        self.project = project
+        # Abre (o reutiliza) el VectorStore del proyecto al crear el gestor
+        get_vector_store(vector_store_path, embedding_model, backend, project)
         self.logger = logging.getLogger(__name__)
+        self.last_ingestion_report: Optional[IngestionReport] = None
+        self._reranker: Optional[CrossEncoderReranker] = None
+        self._project_managers: Dict[str, "RAGManager"] = {}
+        self._load_initial_snapshot()
     
-    def ingest_document(self, file_path: str) -> bool:
-        """Ingesta un documento al sistema RAG"""
+    @_holds_store
+    def _load_initial_snapshot(self):
+        """Carga settings.rag_snapshot_path si la coleccion esta vacia (arranque en frio)"""
+        path = rag_setting("rag_snapshot_path", "")
+        if self.project or not path or not os.path.exists(path):
+            return
+        store = self.vector_store
+        if store.collection.count():
+            return
         try:
+            store.import_snapshot(path)
+        except Exception as e:
+            self.logger.error(f"Error cargando snapshot inicial {path}: {str(e)}")
+    
+    @property
+    def vector_store(self) -> VectorStore:
+        """VectorStore compartido del proyecto
+        
+        Se resuelve en el registro en cada acceso: si el proyecto se cerro por
+        inactividad (LRU) se vuelve a abrir de forma transparente.
+        """
+        return get_vector_store(
+            self.vector_store_path, self.embedding_model, self.backend, self.project
+        )
+    
+    def for_project(self, project: Optional[str]) -> "RAGManager":
+        """RAGManager con la misma configuracion sobre otro proyecto"""
+        if not project or project == self.project:
+            return self
+        manager = self._project_managers.get(project)
+        if manager is None:
+            manager = RAGManager(
+                self.vector_store_path, self.embedding_model, self.backend, project
+            )
+            manager._reranker = self._reranker
+            self._project_managers[project] = manager
+        return manager
+    
+    def ingestion_params(self) -> Dict[str, Any]:
+        """Parametros que invalidan los embeddings si cambian"""
+        return {
+            **self.document_processor.get_config(),
+            "embedding_model": self.vector_store.embedding_model_name
+        }
+    
+    @_holds_store
+    def ingest_document(self, file_path: str, force: bool = False) -> bool:
+        """Ingesta un documento al sistema RAG
+        
+        Los documentos sin cambios (mismo hash y parametros) se omiten y los
+        modificados solo re-embeben los chunks nuevos, salvo con force=True.
+        """
+        try:
+            source = str(Path(file_path))
+            params = self.ingestion_params()
+            manifest = self.vector_store.manifest
+            
+            file_hash = hash_file(source)
+            if not force and manifest.is_unchanged(source, file_hash, params):
+                self.logger.info(f"Documento sin cambios, se omite: {file_path}")
+                return True
+            
             self.logger.info(f"Procesando documento: {file_path}")
             
-            # Procesar documento
-            processed_docs = self.document_processor.process_document(file_path)
+            # Procesar documento de forma incremental (chunks bajo demanda)
+            processed_docs = self.document_processor.iter_document(source)
+            first_doc = next(processed_docs, None)
             
-            if not processed_docs:
+            if first_doc is None:
                 self.logger.warning(f"No se pudo procesar el documento: {file_path}")
                 return False
             
-            # Añadir al vector store
-            success = self.vector_store.add_documents(processed_docs)
+            # Sincronizar con el vector store por lotes
+            if force:
+                manifest.remove(source)
+            plan = manifest.begin_plan(source, file_hash, params)
+            success = self.vector_store.apply_sync_stream(
+                plan, itertools.chain([first_doc], processed_docs),
+                batch_size=rag_setting("ingest_stream_batch_size", 256)
+            )
             
             if success:
                 self.logger.info(f"Documento ingresado exitosamente: {file_path}")
@@ -39,8 +146,17 @@ class RAGManager:
             self.logger.error(f"Error ingresando documento {file_path}: {str(e)}")
             return False
     
-    def ingest_directory(self, directory_path: str) -> Dict[str, bool]:
-        """Ingesta todos los documentos de un directorio"""
+    @_holds_store
+    def ingest_directory(self, directory_path: str, parallel: bool = False,
+                         max_workers: Optional[int] = None, force: bool = False,
+                         prune: bool = False) -> Dict[str, bool]:
+        """Ingesta todos los documentos de un directorio
+        
+        Con parallel=True usa el pipeline de ingesta (parseo en pool de procesos,
+        embeddings y escritura por lotes). El informe detallado queda en
+        self.last_ingestion_report. Con prune=True se eliminan del indice los
+        documentos del manifiesto que ya no existen en el directorio.
+        """
         directory = Path(directory_path)
         results = {}
         
@@ -51,66 +167,281 @@ class RAGManager:
         # Extensiones soportadas
         supported_extensions = {'.pdf', '.docx', '.txt', '.md', '.json', '.xlsx', '.xls'}
         
-        for file_path in directory.rglob("*"):
-            if file_path.suffix.lower() in supported_extensions:
-                results[str(file_path)] = self.ingest_document(str(file_path))
+        file_paths = sorted(
+            str(file_path) for file_path in directory.rglob("*")
+            if file_path.is_file() and file_path.suffix.lower() in supported_extensions
+        )
+        
+        if prune:
+            self._prune_missing(directory, set(file_paths))
+        
+        if parallel:
+            pipeline = IngestionPipeline(
+                self.vector_store, self.document_processor, max_workers=max_workers,
+                ingestion_params=self.ingestion_params(), force=force
+            )
+            self.last_ingestion_report = pipeline.run(file_paths)
+            results = {
+                path: status.status in ("done", "empty", "skipped")
+                for path, status in self.last_ingestion_report.files.items()
+            }
+        else:
+            for file_path in file_paths:
+                results[file_path] = self.ingest_document(file_path, force=force)
         
         successful = sum(1 for success in results.values() if success)
         self.logger.info(f"Ingresados {successful}/{len(results)} documentos del directorio")
+        if self.vector_store.dedup is not None:
+            dedup_stats = self.vector_store.dedup.get_stats()
+            self.logger.info(
+                f"Chunks casi duplicados: {dedup_stats['duplicate_chunks']} "
+                f"(dedup_ratio {dedup_stats['dedup_ratio']:.2%})"
+            )
         
         return results
     
-    def query(self, question: str, k: int = 5, doc_type: Optional[str] = None) -> Dict[str, Any]:
-        """Realiza una consulta al sistema RAG"""
+    def _prune_missing(self, directory: Path, present: set):
+        """Elimina del indice los documentos del directorio que ya no existen"""
+        prefix = str(directory).rstrip(os.sep) + os.sep
+        for source in self.vector_store.manifest.sources():
+            if source.startswith(prefix) and source not in present:
+                self.logger.info(f"Documento eliminado del directorio: {source}")
+                self.vector_store.delete_documents_by_source(source)
+    
+    @property
+    def reranker(self) -> CrossEncoderReranker:
+        """Cross-encoder de reranking (el modelo se carga en segundo plano al usarlo)"""
+        if self._reranker is None:
+            self._reranker = CrossEncoderReranker(
+                rag_setting("cross_encoder_model", "cross-encoder/ms-marco-MiniLM-L-6-v2"),
+                budget_ms=rag_setting("rerank_budget_ms", 300)
+            )
+        return self._reranker
+    
+    @_holds_store
+    def _search_many(self, questions: List[str], k: int, doc_type: Optional[str],
+                     mode: Optional[str],
+                     filters: Optional[Dict[str, Any]] = None,
+                     rerank: Optional[str] = None) -> List[List[Dict[str, Any]]]:
+        """Recupera documentos segun el modo ("vector" o "hybrid")
+        
+        En modo jerarquico se buscan mas hijos de los necesarios y se resuelven
+        a k ventanas padre distintas. Con rerank "mmr" o "cross_encoder" se
+        recuperan rerank_fetch_factor veces mas candidatos y se diversifican.
+        Los resultados se cachean hasta la siguiente escritura en la coleccion.
+        """
+        mode = mode or rag_setting("retrieval_mode", "hybrid")
+        rerank = rerank or rag_setting("rerank_mode", "none")
+        hierarchical = self.document_processor.hierarchical
+        
+        # Resultados cacheados para la version actual de la coleccion
+        store = self.vector_store
+        version = store.version
+        keys = [
+            store.result_cache.make_key(
+                question, version, k=k, doc_type=doc_type, mode=mode, filters=filters,
+                rerank=rerank, hierarchical=hierarchical, model=store.embedding_model_name
+            )
+            for question in questions
+        ]
+        cached = [store.result_cache.get(key) for key in keys]
+        missing = [i for i, docs in enumerate(cached) if docs is None]
+        if missing:
+            # Consultas repetidas en el mismo lote se buscan una sola vez
+            first: Dict[str, int] = {}
+            for i in missing:
+                first.setdefault(keys[i], i)
+            found = self._search_uncached(
+                [questions[i] for i in first.values()], k, doc_type, mode, filters,
+                rerank, hierarchical
+            )
+            by_key = dict(zip(first, found))
+            for key, docs in by_key.items():
+                # No se cachea si la coleccion cambio durante la busqueda ni el
+                # orden provisional de MMR mientras carga el cross-encoder
+                fallback = rerank == "cross_encoder" and docs and 'rerank_score' not in docs[0]
+                if store.version == version and not fallback:
+                    store.result_cache.put(key, docs)
+            for i in missing:
+                cached[i] = by_key[keys[i]]
+        return cached
+    
+    def _search_uncached(self, questions: List[str], k: int, doc_type: Optional[str],
+                         mode: str, filters: Optional[Dict[str, Any]], rerank: str,
+                         hierarchical: bool) -> List[List[Dict[str, Any]]]:
+        diversify = rerank in ("mmr", "cross_encoder")
+        fetch_k = k * rag_setting("child_fanout", 3) if hierarchical else k
+        search_k = fetch_k * rag_setting("rerank_fetch_factor", 4) if diversify else fetch_k
+        if mode == "hybrid":
+            all_docs = self.vector_store.hybrid_search_many(
+                questions, search_k, doc_type, rrf_k=rag_setting("rrf_k", 60), filters=filters,
+                include_embeddings=diversify
+            )
+        else:
+            all_docs = self.vector_store.similarity_search_many(
+                questions, search_k, doc_type, filters, include_embeddings=diversify
+            )
+        if diversify:
+            # Vectores de consulta del cache LRU: no se vuelve a codificar
+            query_embeddings = self.vector_store.encode_queries(questions)
+            all_docs = [
+                self._diversify(question, query_embedding, docs, fetch_k, rerank)
+                for question, query_embedding, docs in zip(questions, query_embeddings, all_docs)
+            ]
+        if hierarchical:
+            all_docs = [self.vector_store.resolve_parents(docs, k) for docs in all_docs]
+        return all_docs
+    
+    def _diversify(self, question: str, query_embedding: Any, docs: List[Dict[str, Any]],
+                   k: int, rerank: str) -> List[Dict[str, Any]]:
+        """MMR sobre los candidatos y, opcionalmente, reranking con cross-encoder
+        
+        El cross-encoder reordena un conjunto diverso de 2k candidatos; si no
+        esta listo o excede rerank_budget_ms se mantiene el orden de MMR.
+        """
+        candidates = [doc for doc in docs if doc.get('embedding') is not None]
+        if len(candidates) < len(docs):
+            # Sin vector no se puede medir la redundancia: orden original
+            selected = docs
+        else:
+            pool = 2 * k if rerank == "cross_encoder" else k
+            order = mmr_select(
+                query_embedding, [doc['embedding'] for doc in candidates], pool,
+                rag_setting("mmr_lambda", 0.5)
+            )
+            selected = [candidates[i] for i in order]
+        selected = [
+            {key: value for key, value in doc.items() if key != 'embedding'} for doc in selected
+        ]
+        if rerank == "cross_encoder":
+            reranked = self.reranker.rerank(question, selected)
+            if reranked is not None:
+                return reranked[:k]
+        return selected[:k]
+    
+    def query(self, question: str, k: int = 5, doc_type: Optional[str] = None,
+              mode: Optional[str] = None, token_budget: Optional[int] = None,
+              token_counter: Optional[Callable[[str], int]] = None,
+              filters: Optional[Dict[str, Any]] = None,
+              rerank: Optional[str] = None) -> Dict[str, Any]:
+        """Realiza una consulta al sistema RAG
+        
+        mode: "vector" (solo embeddings) o "hybrid" (BM25 + embeddings con RRF);
+        por defecto settings.retrieval_mode.
+        token_budget: si se indica, el contexto se empaqueta en ese numero de
+        tokens (medidos con token_counter, p. ej. LlamaManager.count_tokens).
+        filters: metadatos exactos que deben cumplir los chunks, p. ej.
+        {"chapter": "Prologo: El Conjuro Prohibido"} o {"scene": 2}.
+        rerank: "none", "mmr" (diversifica el top-k) o "cross_encoder" (MMR y
+        reranking con presupuesto de latencia); por defecto settings.rerank_mode.
+        """
         try:
             # Buscar documentos relevantes
-            relevant_docs = self.vector_store.similarity_search(question, k, doc_type)
-            
-            if not relevant_docs:
-                return {
-                    "question": question,
-                    "answer": "No se encontraron documentos relevantes para la consulta.",
-                    "sources": [],
-                    "context": ""
-                }
-            
-            # Construir contexto
-            context = "\n\n".join([
-                f"Documento {i+1}:\n{doc['content']}"
-                for i, doc in enumerate(relevant_docs)
-            ])
+            relevant_docs = self._search_many([question], k, doc_type, mode, filters, rerank)[0]
+            return self._build_response(question, relevant_docs, token_budget, token_counter)
             
-            # Preparar fuentes
-            sources = [
-                {
-                    "source": doc['metadata']['source'],
-                    "doc_type": doc['metadata']['doc_type'],
-                    "chunk_index": doc['metadata']['chunk_index'],
-                    "distance": doc['distance']
-                }
-                for doc in relevant_docs
+        except Exception as e:
+            self.logger.error(f"Error en consulta RAG: {str(e)}")
+            return self._error_response(question)
+    
+    def query_many(self, questions: List[str], k: int = 5, doc_type: Optional[str] = None,
+                   mode: Optional[str] = None,
+                   filters: Optional[Dict[str, Any]] = None,
+                   rerank: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Realiza varias consultas con un solo encode y una sola busqueda"""
+        try:
+            all_docs = self._search_many(questions, k, doc_type, mode, filters, rerank)
+            return [
+                self._build_response(question, relevant_docs)
+                for question, relevant_docs in zip(questions, all_docs)
             ]
             
-            return {
-                "question": question,
-                "context": context,
-                "sources": sources,
-                "num_sources": len(relevant_docs)
-            }
-            
         except Exception as e:
-            self.logger.error(f"Error en consulta RAG: {str(e)}")
+            self.logger.error(f"Error en consulta RAG multiple: {str(e)}")
+            return [self._error_response(question) for question in questions]
+    
+    def _build_response(self, question: str, relevant_docs: List[Dict[str, Any]],
+                        token_budget: Optional[int] = None,
+                        token_counter: Optional[Callable[[str], int]] = None) -> Dict[str, Any]:
+        """Construye la respuesta de una consulta a partir de los documentos recuperados"""
+        if not relevant_docs:
             return {
                 "question": question,
-                "answer": "Error procesando la consulta.",
+                "answer": "No se encontraron documentos relevantes para la consulta.",
                 "sources": [],
                 "context": ""
             }
+        
+        if token_budget:
+            # Contexto empaquetado por tokens con atribucion por fuente
+            packed = ContextPacker(token_counter).pack(relevant_docs, token_budget)
+            return {
+                "question": question,
+                "context": packed.context,
+                "sources": packed.sources,
+                "num_sources": len(packed.sources),
+                "tokens": packed.tokens_used,
+                "token_budget": token_budget
+            }
+        
+        # Construir contexto
+        context = "\n\n".join([
+            f"Documento {i+1}:\n{doc['content']}"
+            for i, doc in enumerate(relevant_docs)
+        ])
+        
+        # Preparar fuentes
+        sources = [
+            {
+                "source": doc['metadata']['source'],
+                "doc_type": doc['metadata']['doc_type'],
+                "chunk_index": doc['metadata']['chunk_index'],
+                **{
+                    key: doc['metadata'][key]
+                    for key in ("chapter", "section", "scene", "sources", "duplicates")
+                    if key in doc['metadata']
+                },
+                "distance": doc.get('distance'),
+                "score": doc.get('score')
+            }
+            for doc in relevant_docs
+        ]
+        
+        return {
+            "question": question,
+            "context": context,
+            "sources": sources,
+            "num_sources": len(relevant_docs)
+        }
     
+    @staticmethod
+    def _error_response(question: str) -> Dict[str, Any]:
+        return {
+            "question": question,
+            "answer": "Error procesando la consulta.",
+            "sources": [],
+            "context": ""
+        }
+    
+    @_holds_store
     def get_stats(self) -> Dict[str, Any]:
         """Obtiene estadisticas del sistema RAG"""
-        return self.vector_store.get_collection_stats()
+        stats = self.vector_store.get_collection_stats()
+        if self._reranker is not None:
+            stats["reranker"] = self._reranker.get_stats()
+        return stats
     
+    @_holds_store
     def remove_document(self, file_path: str) -> bool:
         """Elimina un documento del sistema RAG"""
         return self.vector_store.delete_documents_by_source(file_path)
+    
+    @_holds_store
+    def export_snapshot(self, path: str, dtype: str = "float16") -> Dict[str, Any]:
+        """Exporta el proyecto a un snapshot portable (vectores, textos y manifiesto)"""
+        return self.vector_store.export_snapshot(path, dtype)
+    
+    @_holds_store
+    def import_snapshot(self, path: str) -> Dict[str, Any]:
+        """Sustituye el proyecto por el contenido de un snapshot sin re-embeber"""
+        return self.vector_store.import_snapshot(path)
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Registro de recursos compartidos del sistema RAG.
+
+Mantiene una unica instancia por proceso del modelo de embeddings, del cliente
+de ChromaDB, del cache de embeddings y del VectorStore, indexadas por
+directorio de persistencia y nombre de modelo. Todos los RAGManager, RAGTool y la interfaz web reutilizan
+asi los mismos objetos en lugar de cargar una copia por agente.
+"""
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from typing import Dict, Tuple, Any, Optional, Callable
+
+_lock = threading.RLock()
+_embedding_models: Dict[str, Any] = {}
+_cross_encoders: Dict[str, Any] = {}
+_token_counters: Dict[str, Callable[[str], int]] = {}
+_chroma_clients: Dict[str, Any] = {}
+# (directorio del cache, modelo) -> EmbeddingCache
+_embedding_caches: Dict[Tuple[str, str], Any] = {}
+# (directorio, modelo, backend, proyecto) -> VectorStore, en orden de uso (LRU)
+_vector_stores: "OrderedDict[Tuple[str, str, str, str], Any]" = OrderedDict()
+# Usuarios activos de cada VectorStore (use_vector_store); no se cierran por LRU
+_vector_store_users: Dict[Tuple[str, str, str, str], int] = {}
+
+logger = logging.getLogger(__name__)
+
+def rag_setting(name: str, default: Any) -> Any:
+    """Lee un parametro de config.settings con valor por defecto si no esta disponible"""
+    try:
+        from config.settings import settings
+        return getattr(settings, name, default)
+    except Exception:
+        return default
+
+def _normalize_path(path: str) -> str:
+    """Normaliza un directorio para usarlo como clave del registro"""
+    return os.path.normcase(os.path.abspath(path))
+
+class EmbeddingModelHandle:
+    """Referencia perezosa a un modelo de embeddings compartido
+    
+    El modelo se carga en la primera llamada a get() o, si se invoca
+    warm_up(), en un hilo en segundo plano. Mientras tanto las operaciones
+    que no codifican texto (estadisticas, borrados, metadatos) no esperan.
+    """
+    
+    def __init__(self, model_name: str, loader: Optional[Callable[[str], Any]] = None,
+                 kind: str = "de embeddings"):
+        self.model_name = model_name
+        self.kind = kind
+        self._loader = loader or _load_sentence_transformer
+        self._model = None
+        self._load_lock = threading.Lock()
+        # Serializa la inferencia: el tokenizer del modelo no admite llamadas concurrentes
+        self.inference_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._warm_thread: Optional[threading.Thread] = None
+        self.load_time: Optional[float] = None
+        self.error: Optional[str] = None
+    
+    @property
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+    
+    def get(self):
+        """Devuelve el modelo, cargandolo (o esperando a su carga) si hace falta"""
+        if self._model is not None:
+            return self._model
+        with self._load_lock:
+            if self._model is None:
+                logger.info(f"Cargando modelo {self.kind} compartido: {self.model_name}")
+                start_time = time.time()
+                try:
+                    self._model = self._loader(self.model_name)
+                except Exception as e:
+                    self.error = str(e)
+                    raise
+                self.load_time = time.time() - start_time
+                self.error = None
+                self._ready.set()
+        return self._model
+    
+    def warm_up(self) -> "EmbeddingModelHandle":
+        """Inicia la carga del modelo en segundo plano"""
+        with _lock:
+            if self._model is None and self._warm_thread is None:
+                self._warm_thread = threading.Thread(
+                    target=self._warm, name=f"model-warmup-{self.model_name}", daemon=True
+                )
+                self._warm_thread.start()
+        return self
+    
+    def _warm(self):
+        try:
+            self.get()
+        except Exception as e:
+            logger.error(f"Error precargando modelo {self.kind} {self.model_name}: {str(e)}")
+    
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Espera a que el modelo este listo; devuelve si lo esta"""
+        return self._ready.wait(timeout)
+
+def _load_sentence_transformer(model_name: str):
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+def _load_cross_encoder(model_name: str):
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(model_name, device="cpu")
+
+def get_embedding_model_handle(model_name: str) -> EmbeddingModelHandle:
+    """Devuelve la referencia perezosa compartida para model_name"""
+    with _lock:
+        handle = _embedding_models.get(model_name)
+        if handle is None:
+            handle = EmbeddingModelHandle(model_name)
+            _embedding_models[model_name] = handle
+        return handle
+
+def get_cross_encoder_handle(model_name: str) -> EmbeddingModelHandle:
+    """Devuelve la referencia perezosa compartida al cross-encoder de reranking (CPU)"""
+    with _lock:
+        handle = _cross_encoders.get(model_name)
+        if handle is None:
+            handle = EmbeddingModelHandle(model_name, _load_cross_encoder, kind="de reranking")
+            _cross_encoders[model_name] = handle
+        return handle
+
+def get_embedding_model(model_name: str):
+    """Devuelve el modelo de embeddings compartido para model_name (bloqueante)"""
+    return get_embedding_model_handle(model_name).get()
+
+def _load_tokenizer(model_name: str):
+    """Obtiene el tokenizer del modelo sin cargar el modelo completo si es posible"""
+    handle = _embedding_models.get(model_name)
+    if handle is not None and handle.is_ready:
+        tokenizer = getattr(handle.get(), "tokenizer", None)
+        if tokenizer is not None:
+            return tokenizer
+    try:
+        from transformers import AutoTokenizer
+    except ImportError:
+        return None
+    for name in (model_name, f"sentence-transformers/{model_name}"):
+        try:
+            return AutoTokenizer.from_pretrained(name)
+        except Exception:
+            continue
+    return None
+
+def get_token_counter(model_name: str) -> Callable[[str], int]:
+    """Devuelve una funcion que cuenta tokens del tokenizer del modelo de embeddings
+    
+    Si el tokenizer no esta disponible se usa una estimacion por caracteres.
+    """
+    with _lock:
+        counter = _token_counters.get(model_name)
+        if counter is not None:
+            return counter
+        
+        tokenizer = _load_tokenizer(model_name)
+        if tokenizer is None:
+            from .context_packer import approximate_token_count
+            
+            logger.warning(f"Tokenizer de {model_name} no disponible, se estiman los tokens")
+            counter = approximate_token_count
+        else:
+            def counter(text: str) -> int:
+                return len(tokenizer(
+                    text, add_special_tokens=False, return_attention_mask=False, verbose=False
+                )["input_ids"])
+        _token_counters[model_name] = counter
+        return counter
+
+def get_chroma_client(persist_directory: str):
+    """Devuelve el cliente persistente de ChromaDB compartido para un directorio"""
+    key = _normalize_path(persist_directory)
+    with _lock:
+        client = _chroma_clients.get(key)
+        if client is None:
+            import chromadb
+            from chromadb.config import Settings
+
+            os.makedirs(persist_directory, exist_ok=True)
+            client = chromadb.PersistentClient(
+                path=persist_directory,
+                settings=Settings(anonymized_telemetry=False)
+            )
+            _chroma_clients[key] = client
+        return client
+
+def get_embedding_cache(cache_dir: str, model_name: str, **options):
+    """Devuelve el cache de embeddings compartido para (directorio, modelo)
+    
+    Los VectorStore de distintos backends sobre el mismo directorio usan asi
+    una sola instancia sobre los mismos archivos. options (max_size_mb,
+    dtype) solo se aplican al crearlo.
+    """
+    key = (_normalize_path(cache_dir), model_name)
+    with _lock:
+        cache = _embedding_caches.get(key)
+        if cache is None:
+            from .embedding_cache import EmbeddingCache
+
+            cache = EmbeddingCache(cache_dir, model_name, **options)
+            _embedding_caches[key] = cache
+        return cache
+
+def _vector_store_key(persist_directory: str, embedding_model: str,
+                      backend: Optional[str], project: Optional[str]) -> Tuple[str, str, str, str]:
+    from .vector_store import DEFAULT_PROJECT, project_slug
+
+    backend = backend or rag_setting("vector_backend", "chroma")
+    project = project_slug(project) if project else DEFAULT_PROJECT
+    return (_normalize_path(persist_directory), embedding_model, backend, project)
+
+def _open_vector_store(persist_directory: str, key: Tuple[str, str, str, str]):
+    from .vector_store import VectorStore
+
+    store = _vector_stores.get(key)
+    if store is None:
+        _, embedding_model, backend, project = key
+        store = VectorStore(persist_directory, embedding_model, backend, project)
+        _vector_stores[key] = store
+    _vector_stores.move_to_end(key)
+    return store
+
+def _close_idle_stores(keep: Optional[Tuple[str, str, str, str]] = None):
+    """Cierra los proyectos sin usuarios activos que exceden max_open_projects
+    
+    Un proyecto en uso (o keep, el que se acaba de pedir) se salta aunque
+    sea el mas antiguo: se cerrara cuando lo libere su ultimo usuario si
+    para entonces sigue sobrando.
+    """
+    evicted = []
+    with _lock:
+        max_open = max(1, rag_setting("max_open_projects", 8))
+        excess = len(_vector_stores) - max_open
+        for key in list(_vector_stores):
+            if excess <= 0:
+                break
+            if key == keep or _vector_store_users.get(key):
+                continue
+            evicted.append((key, _vector_stores.pop(key)))
+            excess -= 1
+    for (_, _, _, name), idle_store in evicted:
+        logger.info(f"Cerrando proyecto RAG inactivo: {name}")
+        try:
+            idle_store.close()
+        except Exception as e:
+            logger.error(f"Error cerrando proyecto RAG {name}: {str(e)}")
+
+def get_vector_store(persist_directory: str = "./rag/vectorstore",
+                     embedding_model: str = "all-MiniLM-L6-v2",
+                     backend: Optional[str] = None,
+                     project: Optional[str] = None):
+    """Devuelve el VectorStore compartido para (directorio, modelo, backend, proyecto)
+    
+    Los proyectos se abren al primer uso; si hay mas de max_open_projects
+    abiertos se cierra el usado hace mas tiempo que no este en uso (sus
+    datos quedan en disco y se vuelve a abrir si se pide de nuevo). Para
+    operaciones largas use use_vector_store, que lo protege del cierre.
+    """
+    key = _vector_store_key(persist_directory, embedding_model, backend, project)
+    with _lock:
+        store = _open_vector_store(persist_directory, key)
+    _close_idle_stores(keep=key)
+    return store
+
+@contextmanager
+def use_vector_store(persist_directory: str = "./rag/vectorstore",
+                     embedding_model: str = "all-MiniLM-L6-v2",
+                     backend: Optional[str] = None,
+                     project: Optional[str] = None):
+    """VectorStore compartido reservado mientras dura el bloque (no se cierra por LRU)"""
+    key = _vector_store_key(persist_directory, embedding_model, backend, project)
+    with _lock:
+        store = _open_vector_store(persist_directory, key)
+        _vector_store_users[key] = _vector_store_users.get(key, 0) + 1
+    try:
+        _close_idle_stores()
+        yield store
+    finally:
+        with _lock:
+            users = _vector_store_users.pop(key, 1) - 1
+            if users > 0:
+                _vector_store_users[key] = users
+        _close_idle_stores()
+
+def get_registry_stats() -> Dict[str, Any]:
+    """Obtiene un resumen de los recursos compartidos cargados"""
+    with _lock:
+        return {
+            "embedding_models": {
+                name: {"ready": handle.is_ready, "load_time": handle.load_time}
+                for name, handle in _embedding_models.items()
+            },
+            "cross_encoders": {
+                name: {"ready": handle.is_ready, "load_time": handle.load_time}
+                for name, handle in _cross_encoders.items()
+            },
+            "chroma_clients": list(_chroma_clients.keys()),
+            "embedding_caches": [
+                {"cache_dir": path, "embedding_model": model}
+                for path, model in _embedding_caches.keys()
+            ],
+            "vector_stores": [
+                {"persist_directory": path, "embedding_model": model, "backend": backend,
+                 "project": project,
+                 "users": _vector_store_users.get((path, model, backend, project), 0)}
+                for path, model, backend, project in _vector_stores.keys()
+            ]
+        }
+
+def clear_registry():
+    """Libera todas las instancias compartidas (uso en pruebas y recargas)"""
+    with _lock:
+        _vector_stores.clear()
+        _vector_store_users.clear()
+        _chroma_clients.clear()
+        _embedding_caches.clear()
+        _embedding_models.clear()
+        _cross_encoders.clear()
+        _token_counters.clear()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Utilidades de recuperacion compartidas por el VectorStore y el RAGManager.
+
+Incluye la fusion de rankings (RRF), la diversificacion por Maximal Marginal
+Relevance sobre los embeddings ya recuperados, el reranking opcional con un
+cross-encoder local en CPU sujeto a un presupuesto de latencia y el cache de
+resultados de busqueda ligado a la version de la coleccion.
+"""
+import re
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Tuple, Iterable, Dict, Any, Optional
+
+import numpy as np
+
+from .registry import get_cross_encoder_handle
+
+logger = logging.getLogger(__name__)
+
+def reciprocal_rank_fusion(rankings: Iterable[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """Fusiona varias listas ordenadas de ids con Reciprocal Rank Fusion"""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+def _unit(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def mmr_select(query_embedding: Any, candidate_embeddings: Any, k: int,
+               lambda_mult: float = 0.5) -> List[int]:
+    """Indices de k candidatos elegidos por Maximal Marginal Relevance
+    
+    Cada paso elige el candidato que maximiza
+    lambda * sim(consulta, c) - (1 - lambda) * max sim(c, elegidos),
+    de modo que los chunks casi consecutivos de un mismo documento no
+    acaparan el top-k.
+    """
+    candidates = _unit(np.asarray(candidate_embeddings, dtype=np.float32))
+    if len(candidates) == 0:
+        return []
+    query = _unit(np.asarray(query_embedding, dtype=np.float32).reshape(-1))
+    relevance = candidates @ query
+    similarity = candidates @ candidates.T
+
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    available = np.ones(len(candidates), dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < min(k, len(candidates)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+    return selected
+
+class CrossEncoderReranker:
+    """Reranking con cross-encoder en CPU dentro de un presupuesto de latencia
+    
+    El modelo se carga en segundo plano la primera vez que se pide; mientras
+    no este listo, o si la puntuacion no cabe en el presupuesto, rerank
+    devuelve None y el llamador se queda con el orden de MMR.
+    """
+    
+    def __init__(self, model_name: str, budget_ms: float = 300.0, batch_size: int = 16):
+        self.model_name = model_name
+        self.budget_ms = budget_ms
+        self.batch_size = batch_size
+        self.handle = get_cross_encoder_handle(model_name)
+        # Media movil del coste por par (consulta, chunk) para no empezar en vano
+        self._pair_ms: Optional[float] = None
+        self.reranked = 0
+        self.fallbacks = 0
+    
+    def rerank(self, query: str, docs: List[Dict[str, Any]],
+               budget_ms: Optional[float] = None) -> Optional[List[Dict[str, Any]]]:
+        """Ordena docs por la puntuacion del cross-encoder, o None si no da tiempo"""
+        budget_ms = self.budget_ms if budget_ms is None else budget_ms
+        if not docs:
+            return docs
+        if not self.handle.is_ready:
+            self.handle.warm_up()
+            self.fallbacks += 1
+            return None
+        if self._pair_ms is not None and self._pair_ms * len(docs) > budget_ms:
+            self.fallbacks += 1
+            return None
+        
+        model = self.handle.get()
+        pairs = [(query, doc['content']) for doc in docs]
+        scores: List[float] = []
+        start = time.perf_counter()
+        try:
+            for offset in range(0, len(pairs), self.batch_size):
+                batch = pairs[offset:offset + self.batch_size]
+                scores.extend(float(score) for score in model.predict(batch))
+                if (time.perf_counter() - start) * 1000 > budget_ms and len(scores) < len(pairs):
+                    self._observe(start, len(scores))
+                    self.fallbacks += 1
+                    return None
+        except Exception as e:
+            logger.error(f"Error en reranking con {self.model_name}: {str(e)}")
+            self.fallbacks += 1
+            return None
+        self._observe(start, len(scores))
+        
+        self.reranked += 1
+        order = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)
+        return [{**docs[i], 'rerank_score': scores[i]} for i in order]
+    
+    def _observe(self, start: float, pairs: int):
+        if not pairs:
+            return
+        pair_ms = (time.perf_counter() - start) * 1000 / pairs
+        self._pair_ms = pair_ms if self._pair_ms is None else 0.8 * self._pair_ms + 0.2 * pair_ms
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "model": self.model_name,
+            "ready": self.handle.is_ready,
+            "budget_ms": self.budget_ms,
+            "pair_ms": round(self._pair_ms, 3) if self._pair_ms is not None else None,
+            "reranked": self.reranked,
+            "fallbacks": self.fallbacks
+        }
+
+def normalize_query(query: str) -> str:
+    """Forma canonica de una consulta para el cache (minusculas, espacios simples)"""
+    return re.sub(r'\s+', ' ', query).strip().lower()
+
+class ResultCache:
+    """Cache LRU acotado de resultados de busqueda
+    
+    La clave incluye la version de la coleccion, de modo que cualquier
+    escritura en el indice invalida los resultados anteriores.
+    """
+    
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    @staticmethod
+    def make_key(query: str, version: int, **params: Any) -> str:
+        return json.dumps(
+            [normalize_query(query), version, params], sort_keys=True, ensure_ascii=False, default=str
+        )
+    
+    def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            results = self._entries.get(key)
+            if results is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        # Copias: los llamadores pueden modificar los resultados
+        return [dict(doc) for doc in results]
+    
+    def put(self, key: str, results: List[Dict[str, Any]]):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = [dict(doc) for doc in results]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self):
+        """Descarta todas las entradas (la coleccion ha cambiado)"""
+        with self._lock:
+            if self._entries:
+                self._entries.clear()
+                self.invalidations += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "invalidations": self.invalidations
+            }
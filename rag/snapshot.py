@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshots portables del vector store.
+
+Un snapshot es un unico archivo con los vectores (float16, o int8 con una
+escala por vector), los textos y metadatos de los chunks, el manifiesto de
+ingesta y las ventanas padre. Permite arrancar un contenedor nuevo listo
+para consultar sin volver a ingerir ni a codificar la biblioteca.
+
+Formato:
+    MAGIC | seccion | relleno | seccion | ... | cabecera JSON | longitud (uint64) | MAGIC
+
+Cada seccion esta alineada a 64 bytes y la cabecera guarda su desplazamiento,
+su tamaño y su SHA-256. Los vectores se leen directamente del archivo
+mapeado en memoria; el resto de secciones son JSON por lineas comprimido.
+"""
+import os
+import json
+import zlib
+import mmap
+import struct
+import hashlib
+from datetime import datetime
+from typing import Dict, Any, Optional, Iterable, Iterator, Tuple
+
+import numpy as np
+
+MAGIC = b"RAGSNAP1"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_DTYPES = ("float16", "int8")
+_ALIGNMENT = 64
+_TRAILER = struct.Struct("<Q8s")
+_HASH_BLOCK = 1 << 20
+
+class SnapshotError(Exception):
+    """Snapshot corrupto, incompleto o incompatible"""
+
+def quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Convierte vectores float32 al tipo del snapshot (con escalas si es int8)"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+class SnapshotWriter:
+    """Escribe un snapshot seccion a seccion sin cargarlo entero en memoria"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._tmp_path = f"{path}.tmp"
+        self._file = open(self._tmp_path, 'wb')
+        self._file.write(MAGIC)
+        self.sections: Dict[str, Dict[str, Any]] = {}
+        self._current: Optional[str] = None
+        self._digest = None
+        self._compressor = None
+
+    def _align(self):
+        padding = -self._file.tell() % _ALIGNMENT
+        if padding:
+            self._file.write(b"\0" * padding)
+
+    def begin(self, name: str, compressed: bool = False):
+        self._align()
+        self._current = name
+        self._digest = hashlib.sha256()
+        self._compressor = zlib.compressobj(6) if compressed else None
+        self.sections[name] = {"offset": self._file.tell(), "length": 0,
+                               "compressed": compressed}
+
+    def _write_raw(self, data: bytes):
+        if data:
+            self._file.write(data)
+            self._digest.update(data)
+            self.sections[self._current]["length"] += len(data)
+
+    def write(self, data: bytes):
+        self._write_raw(self._compressor.compress(data) if self._compressor else data)
+
+    def write_array(self, array: np.ndarray):
+        self.write(np.ascontiguousarray(array).tobytes())
+
+    def write_lines(self, items: Iterable[Any]):
+        for item in items:
+            self.write(json.dumps(item, ensure_ascii=False).encode('utf-8') + b"\n")
+
+    def end(self):
+        if self._compressor is not None:
+            self._write_raw(self._compressor.flush())
+        self.sections[self._current]["sha256"] = self._digest.hexdigest()
+        self._current = None
+
+    def close(self, header: Dict[str, Any]):
+        """Escribe la cabecera y publica el archivo de forma atomica"""
+        header = {**header, "version": SNAPSHOT_VERSION, "sections": self.sections,
+                  "created_at": datetime.now().isoformat()}
+        encoded = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        self._file.write(encoded)
+        self._file.write(_TRAILER.pack(len(encoded), MAGIC))
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+class SnapshotReader:
+    """Lee un snapshot mapeado en memoria y verifica sus checksums"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise SnapshotError(f"Snapshot vacio: {path}")
+        try:
+            self.header = self._read_header()
+        except Exception:
+            self.close()
+            raise
+
+    def _read_header(self) -> Dict[str, Any]:
+        size = len(self._map)
+        if size < len(MAGIC) + _TRAILER.size or self._map[:len(MAGIC)] != MAGIC:
+            raise SnapshotError(f"{self.path} no es un snapshot del vector store")
+        length, magic = _TRAILER.unpack(self._map[size - _TRAILER.size:])
+        if magic != MAGIC or length > size:
+            raise SnapshotError(f"Snapshot incompleto: {self.path}")
+        start = size - _TRAILER.size - length
+        header = json.loads(bytes(self._map[start:start + length]).decode('utf-8'))
+        if header.get("version") != SNAPSHOT_VERSION:
+            raise SnapshotError(f"Version de snapshot no soportada: {header.get('version')}")
+        return header
+
+    def _section(self, name: str) -> Dict[str, Any]:
+        section = self.header["sections"].get(name)
+        if section is None:
+            raise SnapshotError(f"El snapshot no contiene la seccion {name}")
+        return section
+
+    def has_section(self, name: str) -> bool:
+        return name in self.header["sections"]
+
+    def verify(self):
+        """Comprueba el SHA-256 de todas las secciones"""
+        for name, section in self.header["sections"].items():
+            digest = hashlib.sha256()
+            offset, end = section["offset"], section["offset"] + section["length"]
+            while offset < end:
+                block_end = min(end, offset + _HASH_BLOCK)
+                digest.update(self._map[offset:block_end])
+                offset = block_end
+            if digest.hexdigest() != section["sha256"]:
+                raise SnapshotError(f"Checksum incorrecto en la seccion {name} de {self.path}")
+
+    def array(self, name: str, dtype: Any, shape: Tuple[int, ...]) -> np.ndarray:
+        """Vista de solo lectura sobre una seccion binaria (sin copia)"""
+        section = self._section(name)
+        count = int(np.prod(shape))
+        if count * np.dtype(dtype).itemsize != section["length"]:
+            raise SnapshotError(f"Tamaño inesperado de la seccion {name}")
+        return np.frombuffer(self._map, dtype=dtype, count=count,
+                             offset=section["offset"]).reshape(shape)
+
+    def lines(self, name: str) -> Iterator[Any]:
+        """Recorre una seccion JSON por lineas descomprimiendola por bloques"""
+        section = self._section(name)
+        decompressor = zlib.decompressobj() if section["compressed"] else None
+        offset, end = section["offset"], section["offset"] + section["length"]
+        pending = b""
+        while offset < end:
+            block_end = min(end, offset + _HASH_BLOCK)
+            block = self._map[offset:block_end]
+            offset = block_end
+            pending += decompressor.decompress(block) if decompressor else block
+            *complete, pending = pending.split(b"\n")
+            for line in complete:
+                yield json.loads(line)
+        if decompressor is not None:
+            pending += decompressor.flush()
+        for line in pending.split(b"\n"):
+            if line:
+                yield json.loads(line)
+
+    def close(self):
+        if getattr(self, "_map", None) is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Aun hay vistas de numpy vivas: el mapa se libera con ellas
+                pass
+            self._map = None
+        self._file.close()
+
+    def __enter__(self) -> "SnapshotReader":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
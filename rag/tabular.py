@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Ingesta de datos tabulares y estructurados (XLSX y JSON).
+
+Las hojas de calculo se leen en modo read_only fila a fila y los JSON se
+recorren de forma incremental (con ijson si esta instalado). Ambos se
+convierten en registros (una fila, un elemento del primer array de la ruta)
+que se agrupan en chunks acotados en tokens sin partir registros; cada
+chunk de una hoja repite su fila de cabecera para que sea interpretable por
+si solo.
+"""
+import os
+import json
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Any, Optional, Callable, Iterable, Iterator, Tuple
+
+import openpyxl
+
+from .registry import rag_setting
+
+# Lineas maximas que se acumulan de un registro antes de emitirlo por partes
+_MAX_RECORD_LINES = 512
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class Record:
+    """Registro indivisible: una fila de una hoja o un elemento de un JSON"""
+    lines: List[str]
+    label: Any
+    group: str = ""
+    header: str = ""
+    title: str = ""  # se repite si el registro no cabe en un chunk y hay que partirlo
+
+@dataclass
+class RecordChunk:
+    """Grupo de registros consecutivos de un mismo grupo"""
+    text: str
+    group: str
+    first_label: Any
+    last_label: Any
+    records: int
+
+def _cell_text(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+def iter_xlsx_records(file_path: Path) -> Iterator[Record]:
+    """Lee un libro en modo read_only; la primera fila no vacia de cada hoja es la cabecera"""
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            header: Optional[str] = None
+            for row_number, row in enumerate(sheet.iter_rows(values_only=True), start=1):
+                cells = [_cell_text(value) for value in row]
+                while cells and not cells[-1]:
+                    cells.pop()
+                if not cells:
+                    continue
+                line = " | ".join(cells)
+                if header is None:
+                    header = f"### Hoja: {sheet.title}\n{line}"
+                    continue
+                yield Record([line], row_number, group=sheet.title, header=header)
+    finally:
+        workbook.close()
+
+def _format_path(components: List[Any]) -> str:
+    path = ""
+    for component in components:
+        if isinstance(component, int):
+            path += f"[{component}]"
+        else:
+            path += f".{component}" if path else str(component)
+    return path
+
+def _scalar_text(value: Any) -> str:
+    if isinstance(value, str):
+        return value
+    # Decimales de ijson, booleanos y null en notacion JSON
+    return json.dumps(value if not hasattr(value, "is_finite") else float(value))
+
+def _walk(value: Any, path: List[Any]) -> Iterator[Tuple[List[Any], Any]]:
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _walk(item, path + [key])
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            yield from _walk(item, path + [index])
+    else:
+        yield path, value
+
+def iter_json_leaves(file) -> Iterator[Tuple[List[Any], Any]]:
+    """Recorre un JSON devolviendo (ruta, valor escalar) sin cargarlo entero si hay ijson
+    
+    Sin ijson el archivo se carga completo: se avisa, y por encima de
+    json_max_load_mb se rechaza en lugar de agotar la memoria.
+    """
+    try:
+        import ijson
+    except ImportError:
+        size = os.fstat(file.fileno()).st_size
+        max_mb = rag_setting("json_max_load_mb", 64)
+        if size > max_mb * 1024 * 1024:
+            raise ValueError(
+                f"JSON de {size / 1024 / 1024:.0f} MB demasiado grande para cargarlo sin ijson "
+                f"(limite json_max_load_mb={max_mb}); instale ijson"
+            )
+        logger.warning(f"ijson no disponible: se carga el JSON completo ({size / 1024:.0f} KB)")
+        yield from _walk(json.load(file), [])
+        return
+
+    # Pila de contenedores abiertos: [clave actual] en objetos, [indice] en listas
+    stack: List[List[Any]] = []
+    kinds: List[str] = []
+    for _, event, value in ijson.parse(file):
+        if event == "map_key":
+            stack[-1][0] = value
+            continue
+        if event in ("end_map", "end_array"):
+            stack.pop()
+            kinds.pop()
+            continue
+        if kinds and kinds[-1] == "array":
+            stack[-1][0] += 1
+        if event == "start_map":
+            stack.append([None])
+            kinds.append("map")
+        elif event == "start_array":
+            stack.append([-1])
+            kinds.append("array")
+        else:
+            yield [entry[0] for entry in stack], value
+
+def _record_key_length(path: List[Any]) -> int:
+    """Componentes de la ruta que identifican el registro
+    
+    Hasta el primer indice de array, a cualquier profundidad
+    ("personajes[3]", "data.items[3]"); sin arrays, la clave de primer
+    nivel ("config").
+    """
+    for position, component in enumerate(path):
+        if isinstance(component, int):
+            return position + 1
+    return min(1, len(path))
+
+def iter_json_records(file_path: Path) -> Iterator[Record]:
+    """Agrupa las hojas de un JSON en registros con claves relativas ("nombre: Umiel")"""
+    with open(file_path, 'rb') as file:
+        current_key: Optional[str] = None
+        title = ""
+        lines: List[str] = []
+        for path, value in iter_json_leaves(file):
+            length = _record_key_length(path)
+            record_key = _format_path(path[:length]) or "$"
+            if record_key != current_key:
+                if lines:
+                    yield Record(lines, current_key, title=title)
+                current_key, lines = record_key, []
+                # Un valor escalar en la raiz del registro no necesita titulo
+                title = record_key if len(path) > length else ""
+            relative = _format_path(path[length:]) or record_key
+            lines.append(f"{relative}: {_scalar_text(value)}")
+            if len(lines) >= _MAX_RECORD_LINES:
+                # Objeto enorme sin arrays: se emite por partes con su titulo
+                yield Record(lines, current_key, title=title)
+                lines = []
+        if lines:
+            yield Record(lines, current_key, title=title)
+
+class RecordChunker:
+    """Agrupa registros en chunks acotados en tokens sin partirlos"""
+
+    def __init__(self, token_counter: Callable[[str], int], max_tokens: int = 240):
+        self.count_tokens = token_counter
+        self.max_tokens = max(16, max_tokens)
+
+    def chunk(self, records: Iterable[Record]) -> Iterator[RecordChunk]:
+        group: Optional[str] = None
+        header = ""
+        header_tokens = 0
+        lines: List[str] = []
+        tokens = 0
+        labels: List[Any] = []
+
+        def emit() -> RecordChunk:
+            body = "\n".join(lines)
+            return RecordChunk(
+                text=f"{header}\n{body}" if header else body,
+                group=group or "", first_label=labels[0], last_label=labels[-1],
+                records=len(labels)
+            )
+
+        for record in records:
+            if record.group != group:
+                if labels:
+                    yield emit()
+                group, header = record.group, record.header
+                header_tokens = self.count_tokens(header) if header else 0
+                lines, tokens, labels = [], header_tokens, []
+
+            title = record.title
+            title_tokens = self.count_tokens(title) if title else 0
+            line_tokens = [self.count_tokens(line) for line in record.lines]
+            if labels and tokens + title_tokens + sum(line_tokens) > self.max_tokens:
+                yield emit()
+                lines, tokens, labels = [], header_tokens, []
+
+            if title:
+                lines.append(title)
+                tokens += title_tokens
+            labels.append(record.label)
+            written = 0
+            for line, count in zip(record.lines, line_tokens):
+                # Solo se parte un registro que por si mismo no cabe en un chunk
+                if written and tokens + count > self.max_tokens:
+                    yield emit()
+                    lines, tokens, labels = [], header_tokens + title_tokens, [record.label]
+                    if title:
+                        lines.append(title)
+                    written = 0
+                lines.append(line)
+                tokens += count
+                written += 1
+
+        if labels:
+            yield emit()
@@ -1,49 +1,214 @@
 # -*- coding: utf-8 -*-
 import os
+import re
 import logging
-from typing import List, Dict, Any, Optional
-import chromadb
-from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
-from langchain.schema import Document
+import threading
+from collections import OrderedDict
+from itertools import islice
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Iterator, Container
+import numpy as np
+
+from .registry import get_embedding_model_handle, get_embedding_cache, rag_setting
+from .backends import VectorBackend, create_backend
+from .manifest import IngestionManifest, SyncPlan, chunk_id, hash_text
+from .embedding_cache import EmbeddingCache
+from .encoder import BucketedEncoder
+from .bm25_index import BM25Index
+from .parent_store import ParentStore
+from .dedup import NearDuplicateIndex
+from .retrieval import reciprocal_rank_fusion, ResultCache
+from .snapshot import (
+    SnapshotWriter, SnapshotReader, SnapshotError, SNAPSHOT_DTYPES, quantize
+)
+
+def _batched(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Agrupa un iterable en listas de como maximo size elementos"""
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+DEFAULT_PROJECT = "default"
+BASE_COLLECTION_NAME = "novel_documents"
+
+def project_slug(project: str) -> str:
+    """Nombre seguro para colecciones y directorios a partir del id de proyecto"""
+    slug = re.sub(r'[^a-zA-Z0-9_-]+', '_', project.strip()).strip('_-')[:40]
+    if not slug:
+        raise ValueError(f"Id de proyecto no valido: {project!r}")
+    return slug
 
 class VectorStore:
-    """Gestor del almacen vectorial con ChromaDB"""
+    """Gestor del almacen vectorial (ChromaDB o indice NumPy local)
+    
+    Cada proyecto (libro, serie) tiene su propia coleccion con su manifiesto,
+    indice BM25, caches y ventanas padre; el proyecto por defecto usa la
+    coleccion historica 'novel_documents'.
+    """
     
     def __init__(self, persist_directory: str = "./rag/vectorstore", 
-                 embedding_model: str = "all-MiniLM-L6-v2"):
+                 embedding_model: str = "all-MiniLM-L6-v2",
+                 backend: Optional[str] = None,
+                 project: Optional[str] = None):
         self.persist_directory = persist_directory
         self.embedding_model_name = embedding_model
+        self.project = project_slug(project) if project else DEFAULT_PROJECT
         self.logger = logging.getLogger(__name__)
         
+        # Acceso concurrente desde varios agentes/hilos
+        self._lock = threading.RLock()
+        
         # Crear directorio si no existe
         os.makedirs(persist_directory, exist_ok=True)
         
-        # Inicializar ChromaDB
-        self.client = chromadb.PersistentClient(
-            path=persist_directory,
-            settings=Settings(anonymized_telemetry=False)
+        # El modelo se carga perezosamente (o en segundo plano) al codificar
+        self._model_handle = get_embedding_model_handle(embedding_model)
+        if rag_setting("embedding_preload", True):
+            self._model_handle.warm_up()
+        self._encoder: Optional[BucketedEncoder] = None
+        
+        # Coleccion principal sobre el backend configurado ("chroma" o "numpy")
+        self.collection_name = (
+            BASE_COLLECTION_NAME if self.project == DEFAULT_PROJECT
+            else f"{BASE_COLLECTION_NAME}_{self.project}"
         )
+        self.backend_name = backend or rag_setting("vector_backend", "chroma")
+        self.collection = self._create_backend()
+        
+        # Manifiesto de ingesta incremental
+        self.manifest = IngestionManifest(self.collection.data_directory)
+        
+        # Cache persistente de embeddings de chunks
+        self.embedding_cache = self._init_embedding_cache()
+        
+        # Indice lexico BM25 sincronizado con la coleccion
+        self.lexical_index = BM25Index(self.collection.data_directory)
+        self._lexical_synced = False
         
-        # Cargar modelo de embeddings
-        self.embedding_model = SentenceTransformer(embedding_model)
+        # Ventanas padre de la recuperacion jerarquica (small-to-big)
+        self.parent_store = ParentStore(self.collection.data_directory)
         
-        # Coleccion principal
-        self.collection_name = "novel_documents"
-        self.collection = self._get_or_create_collection()
+        # Deteccion de chunks casi duplicados (MinHash/LSH)
+        self.dedup: Optional[NearDuplicateIndex] = None
+        if rag_setting("dedup_enabled", True):
+            self.dedup = NearDuplicateIndex(
+                self.collection.data_directory,
+                threshold=rag_setting("dedup_threshold", 0.85)
+            )
+        self._dedup_synced = False
+        
+        # Cache LRU de embeddings de consultas
+        self.query_cache_size = rag_setting("query_embedding_cache_size", 1024)
+        self._query_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
+        
+        # Version de la coleccion (crece con cada escritura) y cache de resultados
+        self.version = 0
+        self.result_cache = ResultCache(rag_setting("result_cache_size", 512))
+    
+    def _create_backend(self) -> VectorBackend:
+        """Crea la coleccion principal sobre el backend configurado"""
+        options = {}
+        if self.project != DEFAULT_PROJECT:
+            options["data_directory"] = os.path.join(
+                self.persist_directory, "projects", self.project
+            )
+        if self.backend_name == "numpy":
+            options = {
+                # El indice NumPy ya vive en un directorio por coleccion
+                "dtype": rag_setting("numpy_index_dtype", "float16"),
+                "ivf_threshold": rag_setting("numpy_ivf_threshold", 50000),
+                "ivf_nprobe": rag_setting("numpy_ivf_nprobe", 8),
+                "exact_rerank": rag_setting("numpy_exact_rerank", None),
+                "rerank_factor": rag_setting("numpy_rerank_factor", 4)
+            }
+        return create_backend(
+            self.backend_name, self.persist_directory, self.collection_name,
+            metadata={"description": "Documentos para sistema multi-agente de novelas"},
+            **options
+        )
+    
+    @property
+    def embedding_model(self):
+        """Modelo de embeddings (bloquea hasta que este cargado)"""
+        return self._model_handle.get()
+    
+    @property
+    def encoder(self) -> BucketedEncoder:
+        """Codificador por lotes, creado al primer uso"""
+        if self._encoder is None:
+            # Esperar al modelo fuera del lock para no bloquear otras operaciones
+            model = self.embedding_model
+            with self._lock:
+                if self._encoder is None:
+                    self._encoder = BucketedEncoder(
+                        model,
+                        batch_size=rag_setting("embedding_batch_size", 64),
+                        num_threads=rag_setting("embedding_num_threads", 0),
+                        lock=self._model_handle.inference_lock
+                    )
+        return self._encoder
     
-    def _get_or_create_collection(self):
-        """Obtiene o crea la coleccion principal"""
+    def is_encoder_ready(self) -> bool:
+        """Indica si el modelo de embeddings ya esta cargado"""
+        return self._model_handle.is_ready
+    
+    def _init_embedding_cache(self) -> Optional[EmbeddingCache]:
+        """Obtiene el cache de embeddings compartido segun la configuracion"""
+        if not rag_setting("embedding_cache_enabled", True):
+            return None
         try:
-            return self.client.get_collection(name=self.collection_name)
-        except Exception:
-            return self.client.create_collection(
-                name=self.collection_name,
-                metadata={"description": "Documentos para sistema multi-agente de novelas"}
+            cache_root = (
+                self.persist_directory if self.project == DEFAULT_PROJECT
+                else self.collection.data_directory
+            )
+            return get_embedding_cache(
+                os.path.join(cache_root, "embedding_cache"),
+                self.embedding_model_name,
+                max_size_mb=rag_setting("embedding_cache_max_mb", 512),
+                dtype=rag_setting("embedding_cache_dtype", "float16")
             )
+        except Exception as e:
+            self.logger.warning(f"Cache de embeddings deshabilitado: {str(e)}")
+            return None
     
-    def add_documents(self, processed_docs: List[Any]) -> bool:
-        """Añade documentos procesados al vector store"""
+    def encode_texts(self, texts: List[str]) -> np.ndarray:
+        """Genera embeddings (matriz float32) reutilizando el cache
+        
+        Se codifica sin el lock del store (el codificador serializa el uso
+        del modelo por lotes), asi las busquedas no esperan a una ingesta.
+        """
+        encoder = self.encoder
+        if self.embedding_cache is None:
+            return encoder.encode(texts)
+        
+        keys = [hash_text(text) for text in texts]
+        found, missing = self.embedding_cache.get_many(keys)
+        if not missing:
+            return np.stack([found[i] for i in range(len(texts))]).astype(np.float32, copy=False)
+        
+        encoded = encoder.encode([texts[i] for i in missing])
+        self.embedding_cache.put_many([keys[i] for i in missing], encoded)
+        
+        output = np.empty((len(texts), encoded.shape[1]), dtype=np.float32)
+        output[missing] = encoded
+        for position, vector in found.items():
+            output[position] = vector
+        return output
+    
+    def add_documents(self, processed_docs: List[Any],
+                      embeddings: Optional[np.ndarray] = None,
+                      persist: bool = True) -> bool:
+        """Añade documentos procesados al vector store
+        
+        Si se proporcionan embeddings ya calculados (p. ej. por el pipeline de
+        ingesta) se usan directamente en lugar de volver a codificar. Con
+        persist=False no se guardan aun el cache de embeddings ni el indice
+        BM25 (ver flush_auxiliary), util al añadir un documento por lotes.
+        """
         try:
             if not processed_docs:
                 self.logger.warning("No hay documentos para añadir")
@@ -51,24 +216,35 @@ class VectorStore:
             
             # Preparar datos para ChromaDB
             documents = []
-            metadatas = []
             ids = []
             
             for i, doc in enumerate(processed_docs):
                 documents.append(doc.content)
-                metadatas.append(doc.metadata)
-                ids.append(f"{doc.source}_{doc.metadata.get('chunk_index', i)}")
-            
-            # Generar embeddings
-            embeddings = self.embedding_model.encode(documents).tolist()
-            
-            # Añadir a ChromaDB
-            self.collection.add(
-                documents=documents,
-                metadatas=metadatas,
-                ids=ids,
-                embeddings=embeddings
-            )
+                ids.append(self._document_id(doc, i))
+            
+            # Generar embeddings (fuera del lock: solo se bloquea la escritura)
+            if embeddings is None:
+                embeddings = self.encode_texts(documents)
+            
+            with self._lock:
+                # Fuentes de los casi duplicados asociados a cada chunk
+                metadatas = [
+                    self._annotate(doc_id, doc.metadata)
+                    for doc_id, doc in zip(ids, processed_docs)
+                ]
+                
+                # Añadir a ChromaDB (upsert: re-ingestas sin ids duplicados)
+                self.collection.upsert(
+                    documents=documents,
+                    metadatas=metadatas,
+                    ids=ids,
+                    embeddings=embeddings
+                )
+                self._bump_version()
+            
+            self.lexical_index.add_many(ids, documents, metadatas)
+            if persist:
+                self.flush_auxiliary()
             
             self.logger.info(f"Añadidos {len(documents)} chunks al vector store")
             return True
@@ -77,41 +253,691 @@ class VectorStore:
             self.logger.error(f"Error añadiendo documentos: {str(e)}")
             return False
     
+    def _document_id(self, doc: Any, position: int = 0) -> str:
+        """Id del chunk: por contenido si tiene hash, por indice si no"""
+        chunk_hash = doc.metadata.get('chunk_hash')
+        if chunk_hash:
+            return chunk_id(doc.source, chunk_hash)
+        return f"{doc.source}_{doc.metadata.get('chunk_index', position)}"
+    
+    def _bump_version(self):
+        """Marca un cambio en la coleccion: los resultados cacheados dejan de valer"""
+        with self._lock:
+            self.version += 1
+            self.result_cache.invalidate()
+    
+    def _annotate(self, doc_id: str, metadata: Dict[str, Any]) -> Dict[str, Any]:
+        return self.dedup.annotate(doc_id, metadata) if self.dedup is not None else metadata
+    
+    def _ensure_dedup_index(self):
+        """Registra como canonicos los chunks indexados antes de activar la deduplicacion"""
+        if self.dedup is None or self._dedup_synced:
+            return
+        with self._lock:
+            if self._dedup_synced:
+                return
+            if len(self.dedup) == 0 and self.collection.count():
+                results = self.collection.get(include=["documents"])
+                for doc_id, content in zip(results['ids'], results['documents']):
+                    self.dedup.add_canonical(doc_id, content)
+                self.dedup.save()
+            self._dedup_synced = True
+    
+    def filter_duplicates(self, processed_docs: List[Any],
+                          stage: Optional[str] = None,
+                          exclude: Container[str] = ()) -> List[Any]:
+        """Descarta los chunks casi duplicados de otros ya indexados
+        
+        Los descartados quedan como alias de su chunk canonico, cuyos
+        metadatos ('sources', 'duplicates') se actualizan con su fuente.
+        Con stage los registros quedan pendientes hasta commit_duplicates
+        (tras escribir los chunks) o discard_duplicates (si falla). Los ids
+        de exclude (chunks que aun se van a eliminar) no sirven de canonico.
+        """
+        if self.dedup is None or not processed_docs:
+            return processed_docs
+        self._ensure_dedup_index()
+        
+        kept, canonicals = [], set()
+        for position, doc in enumerate(processed_docs):
+            doc_id = self._document_id(doc, position)
+            canonical = self.dedup.register(
+                doc_id, doc.content, doc.source, doc.metadata, stage=stage, exclude=exclude
+            )
+            if canonical is None:
+                kept.append(doc)
+            else:
+                canonicals.add(canonical)
+        
+        if stage is None:
+            self._refresh_duplicate_metadata(sorted(canonicals))
+        if len(kept) < len(processed_docs):
+            self.logger.info(
+                f"Descartados {len(processed_docs) - len(kept)} chunks casi duplicados"
+            )
+        return kept
+    
+    def commit_duplicates(self, stage: str):
+        """Confirma los registros de deduplicacion de una etapa ya escrita"""
+        if self.dedup is not None:
+            self._refresh_duplicate_metadata(self.dedup.commit(stage))
+    
+    def discard_duplicates(self, stage: str) -> List[str]:
+        """Deshace los registros de deduplicacion de una etapa que no se escribio
+        
+        Las fuentes con alias de los canonicos deshechos salen del manifiesto
+        para que la proxima ingesta las procese de nuevo; se devuelven.
+        """
+        if self.dedup is None:
+            return []
+        affected = [source for source in self.dedup.rollback(stage) if source != stage]
+        for source in affected:
+            self.logger.warning(f"Casi duplicados de un chunk no escrito, se re-ingestara: {source}")
+            self.manifest.remove(source, save=False)
+        return affected
+    
+    def _refresh_duplicate_metadata(self, ids: List[str]):
+        """Reescribe las fuentes de los canonicos ya almacenados"""
+        if self.dedup is None or not ids:
+            return
+        with self._lock:
+            results = self.collection.get(ids=ids, include=["metadatas"])
+            if results['ids']:
+                self.collection.update(
+                    ids=results['ids'],
+                    metadatas=[
+                        self.dedup.annotate(doc_id, metadata)
+                        for doc_id, metadata in zip(results['ids'], results['metadatas'])
+                    ]
+                )
+                self._bump_version()
+    
+    def _delete_rows(self, ids: List[str], refresh: Optional[List[str]] = None):
+        """Elimina chunks de la coleccion y del indice BM25
+        
+        Con deduplicacion, los alias solo se dan de baja del indice y, si se
+        elimina un canonico con alias de otras fuentes, uno de ellos hereda
+        su texto y su vector. Los indices se guardan con flush_auxiliary.
+        """
+        refresh = list(refresh or [])
+        promotions = []
+        stored_ids = ids
+        if self.dedup is not None:
+            stored_ids = [doc_id for doc_id in ids if not self.dedup.is_alias(doc_id)]
+            removed_refresh, promotions = self.dedup.remove(ids)
+            refresh.extend(removed_refresh)
+        
+        with self._lock:
+            inherited = {}
+            if promotions:
+                rows = self.collection.get(
+                    ids=[old_id for old_id, _, _, _ in promotions],
+                    include=["documents", "embeddings"]
+                )
+                inherited = {
+                    doc_id: (content, embedding) for doc_id, content, embedding in zip(
+                        rows['ids'], rows['documents'], rows['embeddings']
+                    )
+                }
+            
+            if stored_ids:
+                self.collection.delete(ids=stored_ids)
+                self.lexical_index.remove(stored_ids)
+            
+            for old_id, heir_id, _, metadata in promotions:
+                if old_id not in inherited:
+                    continue
+                content, embedding = inherited[old_id]
+                heir_metadata = self._annotate(heir_id, metadata)
+                self.collection.upsert(
+                    ids=[heir_id], documents=[content], metadatas=[heir_metadata],
+                    embeddings=np.asarray([embedding], dtype=np.float32)
+                )
+                self.lexical_index.add_many([heir_id], [content], [heir_metadata])
+            
+            self._bump_version()
+        
+        self._refresh_duplicate_metadata(sorted(set(refresh) - set(ids)))
+    
+    def delete_ids(self, ids: List[str]) -> bool:
+        """Elimina chunks por id"""
+        if not ids:
+            return True
+        try:
+            self._delete_rows(ids)
+            return True
+        except Exception as e:
+            self.logger.error(f"Error eliminando chunks: {str(e)}")
+            return False
+    
+    def update_metadatas(self, processed_docs: List[Any]) -> bool:
+        """Actualiza metadatos de chunks existentes sin re-embeber"""
+        if not processed_docs:
+            return True
+        try:
+            with self._lock:
+                ids = [self._document_id(doc) for doc in processed_docs]
+                stored = [
+                    (doc_id, self._annotate(doc_id, doc.metadata))
+                    for doc_id, doc in zip(ids, processed_docs)
+                    if self.dedup is None or not self.dedup.is_alias(doc_id)
+                ]
+                if stored:
+                    self.collection.update(
+                        ids=[doc_id for doc_id, _ in stored],
+                        metadatas=[metadata for _, metadata in stored]
+                    )
+                    self._bump_version()
+            return True
+        except Exception as e:
+            self.logger.error(f"Error actualizando metadatos: {str(e)}")
+            return False
+    
+    def flush_auxiliary(self):
+        """Guarda en disco las escrituras pendientes del backend, el cache de embeddings y el indice BM25"""
+        self.collection.flush()
+        if self.embedding_cache is not None:
+            self.embedding_cache.flush()
+        self.lexical_index.save()
+        if self.dedup is not None:
+            self.dedup.save()
+    
+    def close(self):
+        """Persiste los indices auxiliares y libera recursos del proyecto"""
+        with self._lock:
+            self.flush_auxiliary()
+            self.lexical_index.close()
+            if self.dedup is not None:
+                self.dedup.close()
+            self.parent_store.close()
+            self.collection.close()
+            self._query_cache.clear()
+            self.result_cache.invalidate()
+    
+    def export_snapshot(self, path: str, dtype: str = "float16",
+                        batch_size: int = 4096) -> Dict[str, Any]:
+        """Exporta la coleccion a un snapshot portable (ver rag.snapshot)
+        
+        dtype "float16" o "int8" (escala por vector, la mitad de tamaño).
+        """
+        if dtype not in SNAPSHOT_DTYPES:
+            raise ValueError(f"dtype {dtype} no soportado para snapshots")
+        with self._lock:
+            ids = self.collection.get(include=[])['ids']
+            writer = SnapshotWriter(path)
+            try:
+                dim = None
+                scales: List[np.ndarray] = []
+                writer.begin("vectors")
+                for batch in _batched(ids, batch_size):
+                    rows = self._get_ordered(batch, "embeddings")
+                    vectors, batch_scales = quantize(np.asarray(rows['embeddings']), dtype)
+                    dim = vectors.shape[1]
+                    writer.write_array(vectors)
+                    if batch_scales is not None:
+                        scales.append(batch_scales)
+                writer.end()
+                if scales:
+                    writer.begin("scales")
+                    writer.write_array(np.concatenate(scales))
+                    writer.end()
+                
+                writer.begin("records", compressed=True)
+                for batch in _batched(ids, batch_size):
+                    rows = self._get_ordered(batch, "documents", "metadatas")
+                    writer.write_lines(zip(batch, rows['documents'], rows['metadatas']))
+                writer.end()
+                
+                writer.begin("manifest", compressed=True)
+                writer.write_lines(sorted(self.manifest.entries.items()))
+                writer.end()
+                
+                writer.begin("parents", compressed=True)
+                writer.write_lines(self.parent_store.iter_all())
+                writer.end()
+                
+                writer.close({
+                    "embedding_model": self.embedding_model_name,
+                    "project": self.project,
+                    "dtype": dtype,
+                    "dim": dim or 0,
+                    "count": len(ids)
+                })
+            except Exception:
+                writer.abort()
+                raise
+        
+        self.logger.info(f"Snapshot exportado: {len(ids)} chunks en {path}")
+        return {"path": path, "chunks": len(ids), "dtype": dtype,
+                "bytes": os.path.getsize(path)}
+    
+    def _get_ordered(self, ids: List[str], *include: str) -> Dict[str, List[Any]]:
+        """collection.get con los resultados en el orden de ids"""
+        rows = self.collection.get(ids=ids, include=list(include))
+        position = {doc_id: i for i, doc_id in enumerate(rows['ids'])}
+        if len(position) != len(ids) or any(doc_id not in position for doc_id in ids):
+            raise RuntimeError("La coleccion cambio durante la exportacion")
+        return {key: [rows[key][position[doc_id]] for doc_id in ids] for key in include}
+    
+    def import_snapshot(self, path: str, batch_size: int = 4096) -> Dict[str, Any]:
+        """Sustituye el contenido de la coleccion por el de un snapshot
+        
+        El archivo se mapea en memoria y se verifican sus checksums antes de
+        tocar la coleccion; los vectores se cargan sin volver a codificar.
+        """
+        with SnapshotReader(path) as reader:
+            header = reader.header
+            if header["embedding_model"] != self.embedding_model_name:
+                raise SnapshotError(
+                    f"El snapshot usa el modelo {header['embedding_model']} "
+                    f"y el vector store {self.embedding_model_name}"
+                )
+            reader.verify()
+            
+            count, dim = header["count"], header["dim"]
+            vectors = reader.array("vectors", header["dtype"], (count, dim))
+            scales = reader.array("scales", np.float32, (count,)) if reader.has_section("scales") else None
+            # Solo los vectores float16 son fieles para el cache de embeddings
+            prefill_cache = self.embedding_cache is not None and scales is None
+            
+            with self._lock:
+                self._clear_collection()
+                loaded = 0
+                records = reader.lines("records")
+                for start in range(0, count, batch_size):
+                    batch = list(islice(records, batch_size))
+                    embeddings = np.asarray(vectors[start:start + len(batch)], dtype=np.float32)
+                    if scales is not None:
+                        embeddings *= scales[start:start + len(batch), None]
+                    ids = [doc_id for doc_id, _, _ in batch]
+                    documents = [document for _, document, _ in batch]
+                    metadatas = [metadata for _, _, metadata in batch]
+                    self.collection.upsert(
+                        ids=ids, documents=documents, metadatas=metadatas, embeddings=embeddings
+                    )
+                    self.lexical_index.add_many(ids, documents, metadatas)
+                    if prefill_cache:
+                        self.embedding_cache.put_many(
+                            [hash_text(document) for document in documents], embeddings
+                        )
+                    loaded += len(batch)
+                del vectors, scales
+                
+                self.parent_store.put_many(tuple(parent) for parent in reader.lines("parents"))
+                self._lexical_synced = True
+                self._dedup_synced = False
+                self.flush_auxiliary()
+                self.manifest.entries = dict(reader.lines("manifest"))
+                self.manifest.save()
+                self._bump_version()
+        
+        self.logger.info(f"Snapshot importado: {loaded} chunks desde {path}")
+        return {"path": path, "chunks": loaded, "dtype": header["dtype"],
+                "created_at": header.get("created_at")}
+    
+    def _clear_collection(self, batch_size: int = 4096):
+        """Vacia la coleccion y sus indices auxiliares"""
+        with self._lock:
+            ids = self.collection.get(include=[])['ids']
+            for batch in _batched(ids, batch_size):
+                self.collection.delete(ids=batch)
+            self.lexical_index.clear()
+            self.parent_store.clear()
+            if self.dedup is not None:
+                self.dedup.clear()
+            self.flush_auxiliary()
+            self.manifest.entries = {}
+            self.manifest.save()
+            self._bump_version()
+    
+    def _store_parents(self, processed_docs: List[Any]):
+        """Guarda las ventanas padre de chunks hijos (modo jerarquico)"""
+        parents = {}
+        for doc in processed_docs:
+            if getattr(doc, 'parent', None) is None:
+                continue
+            index = doc.metadata['parent_index']
+            if (doc.source, index) not in parents:
+                metadata = {
+                    key: value for key, value in doc.metadata.items()
+                    if key not in ('chunk_index', 'chunk_size', 'chunk_hash',
+                                   'parent_index', 'total_chunks')
+                }
+                parents[(doc.source, index)] = (doc.source, index, doc.parent, metadata)
+        if parents:
+            self.parent_store.put_many(parents.values())
+            self._bump_version()
+    
+    def prepare_sync(self, plan: SyncPlan) -> bool:
+        """Aplica la parte barata de un plan: borrados y metadatos"""
+        if plan.replace_source:
+            # Chunks previos al manifiesto (ids por indice)
+            self._delete_source_chunks(plan.source)
+        self.parent_store.delete_source(plan.source)
+        self._store_parents(plan.to_upsert + plan.to_update)
+        return self.delete_ids(plan.orphan_ids) and self.update_metadatas(plan.to_update)
+    
+    def apply_sync_plan(self, plan: SyncPlan) -> bool:
+        """Sincroniza un documento con el vector store segun su plan"""
+        if not self.prepare_sync(plan):
+            return False
+        
+        to_embed = self.filter_duplicates(plan.to_upsert, stage=plan.source)
+        if to_embed and not self.add_documents(to_embed, persist=False):
+            self.discard_duplicates(plan.source)
+            return False
+        self.commit_duplicates(plan.source)
+        self.flush_auxiliary()
+        
+        self.manifest.commit(plan)
+        self.logger.info(
+            f"Sincronizado {plan.source}: {len(to_embed)} chunks embebidos, "
+            f"{len(plan.to_upsert) - len(to_embed)} casi duplicados, "
+            f"{len(plan.to_update)} sin cambios, {len(plan.orphan_ids)} eliminados"
+        )
+        return True
+    
+    def apply_sync_stream(self, plan: SyncPlan, processed_docs: Iterable[Any],
+                          batch_size: int = 256) -> bool:
+        """Sincroniza un documento consumiendo sus chunks de forma incremental
+        
+        El plan debe venir de IngestionManifest.begin_plan. Los chunks se
+        clasifican, embeben y escriben por lotes, de modo que nunca se
+        mantiene el documento completo en memoria.
+        """
+        if plan.replace_source:
+            self._delete_source_chunks(plan.source)
+        self.parent_store.delete_source(plan.source)
+        
+        embedded = unchanged = duplicates = 0
+        for batch in _batched(processed_docs, batch_size):
+            self._store_parents(batch)
+            to_upsert, to_update = self.manifest.classify(plan, batch)
+            if not self.update_metadatas(to_update):
+                return False
+            # Los huerfanos solo se conocen al final: los chunks previos que aun
+            # no han reaparecido no pueden ser canonicos (se borrarian despues)
+            pending = {doc_id for doc_id in plan.previous if doc_id not in plan.chunks}
+            to_embed = self.filter_duplicates(to_upsert, stage=plan.source, exclude=pending)
+            if to_embed and not self.add_documents(to_embed, persist=False):
+                self.discard_duplicates(plan.source)
+                return False
+            self.commit_duplicates(plan.source)
+            embedded += len(to_embed)
+            duplicates += len(to_upsert) - len(to_embed)
+            unchanged += len(to_update)
+        
+        self.manifest.finish_plan(plan)
+        if not self.delete_ids(plan.orphan_ids):
+            return False
+        self.flush_auxiliary()
+        
+        self.manifest.commit(plan)
+        self.logger.info(
+            f"Sincronizado {plan.source}: {embedded} chunks embebidos, "
+            f"{duplicates} casi duplicados, {unchanged} sin cambios, "
+            f"{len(plan.orphan_ids)} eliminados"
+        )
+        return True
+    
+    def encode_queries(self, queries: List[str]) -> np.ndarray:
+        """Genera embeddings de consultas usando el cache LRU"""
+        keys = [query.strip() for query in queries]
+        output: Optional[np.ndarray] = None
+        missing: List[int] = []
+        found: Dict[int, np.ndarray] = {}
+        
+        with self._lock:
+            for position, key in enumerate(keys):
+                vector = self._query_cache.get(key)
+                if vector is None:
+                    missing.append(position)
+                else:
+                    self._query_cache.move_to_end(key)
+                    found[position] = vector
+            self.query_cache_hits += len(found)
+            self.query_cache_misses += len(missing)
+        
+        if missing:
+            # Consultas repetidas en el mismo lote se codifican una sola vez
+            unique = list(dict.fromkeys(keys[i] for i in missing))
+            # Sin lock durante la codificacion; solo para tocar el cache
+            encoded = self.encoder.encode(unique)
+            with self._lock:
+                for key, vector in zip(unique, encoded):
+                    self._query_cache[key] = vector
+                    self._query_cache.move_to_end(key)
+                while len(self._query_cache) > self.query_cache_size:
+                    self._query_cache.popitem(last=False)
+            by_key = dict(zip(unique, encoded))
+            for position in missing:
+                found[position] = by_key[keys[position]]
+        
+        for position, vector in found.items():
+            if output is None:
+                output = np.empty((len(keys), vector.shape[0]), dtype=np.float32)
+            output[position] = vector
+        return output
+    
     def similarity_search(self, query: str, k: int = 5, 
-                         doc_type: Optional[str] = None) -> List[Dict[str, Any]]:
+                         doc_type: Optional[str] = None,
+                         filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         """Busqueda por similitud en el vector store"""
+        return self.similarity_search_many([query], k, doc_type, filters)[0]
+    
+    @staticmethod
+    def _build_where(doc_type: Optional[str] = None,
+                     filters: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """Combina doc_type y filtros de metadatos (p. ej. {"chapter": ...}) en un where"""
+        conditions = dict(filters or {})
+        if doc_type:
+            conditions["doc_type"] = doc_type
+        if not conditions:
+            return None
+        if len(conditions) == 1:
+            return conditions
+        return {"$and": [{key: value} for key, value in conditions.items()]}
+    
+    def similarity_search_many(self, queries: List[str], k: int = 5,
+                               doc_type: Optional[str] = None,
+                               filters: Optional[Dict[str, Any]] = None,
+                               include_embeddings: bool = False) -> List[List[Dict[str, Any]]]:
+        """Busqueda por similitud de varias consultas con un solo encode y una sola query
+        
+        filters restringe por metadatos exactos, p. ej. {"chapter": "Prologo"}.
+        Con include_embeddings cada resultado trae su vector en 'embedding'.
+        """
+        if not queries:
+            return []
         try:
-            # Generar embedding de la consulta
-            query_embedding = self.embedding_model.encode([query]).tolist()[0]
-            
             # Preparar filtros
-            where_clause = {}
-            if doc_type:
-                where_clause["doc_type"] = doc_type
-            
-            # Realizar busqueda
-            results = self.collection.query(
-                query_embeddings=[query_embedding],
-                n_results=k,
-                where=where_clause if where_clause else None,
-                include=["documents", "metadatas", "distances"]
-            )
+            where_clause = self._build_where(doc_type, filters)
             
-            # Formatear resultados
-            formatted_results = []
-            if results['documents'] and results['documents'][0]:
-                for i in range(len(results['documents'][0])):
-                    formatted_results.append({
-                        'content': results['documents'][0][i],
-                        'metadata': results['metadatas'][0][i],
-                        'distance': results['distances'][0][i]
-                    })
+            # Generar embeddings de las consultas
+            query_embeddings = self.encode_queries(queries)
             
-            return formatted_results
+            with self._lock:
+                # Realizar busqueda
+                results = self.collection.query(
+                    query_embeddings=query_embeddings,
+                    n_results=k,
+                    where=where_clause,
+                    include=["documents", "metadatas", "distances"]
+                    + (["embeddings"] if include_embeddings else [])
+                )
+            
+            # Formatear resultados
+            return [self._format_results(results, i) for i in range(len(queries))]
             
         except Exception as e:
             self.logger.error(f"Error en busqueda: {str(e)}")
-            return []
+            return [[] for _ in queries]
+    
+    @staticmethod
+    def _format_results(results: Dict[str, Any], query_index: int) -> List[Dict[str, Any]]:
+        """Convierte la respuesta de ChromaDB para una consulta en una lista de resultados"""
+        formatted_results = []
+        embeddings = results.get('embeddings')
+        if results['documents'] and len(results['documents']) > query_index:
+            documents = results['documents'][query_index] or []
+            for i in range(len(documents)):
+                formatted_results.append({
+                    'id': results['ids'][query_index][i],
+                    'content': documents[i],
+                    'metadata': results['metadatas'][query_index][i],
+                    'distance': results['distances'][query_index][i]
+                })
+                if embeddings is not None:
+                    formatted_results[-1]['embedding'] = embeddings[query_index][i]
+        return formatted_results
+    
+    def _ensure_lexical_index(self):
+        """Reconstruye el indice BM25 si la coleccion tiene datos previos al indice"""
+        if self._lexical_synced:
+            return
+        with self._lock:
+            if self._lexical_synced:
+                return
+            count = self.collection.count()
+            if count and len(self.lexical_index) != count:
+                self.logger.info(f"Reconstruyendo indice BM25 para {count} chunks")
+                results = self.collection.get(include=["documents", "metadatas"])
+                self.lexical_index.clear()
+                self.lexical_index.add_many(
+                    results['ids'], results['documents'], results['metadatas']
+                )
+                self.lexical_index.save()
+            self._lexical_synced = True
+    
+    def get_documents(self, ids: List[str],
+                      include_embeddings: bool = False) -> Dict[str, Dict[str, Any]]:
+        """Obtiene contenido y metadatos (y opcionalmente vectores) de chunks por id"""
+        if not ids:
+            return {}
+        include = ["documents", "metadatas"] + (["embeddings"] if include_embeddings else [])
+        with self._lock:
+            results = self.collection.get(ids=ids, include=include)
+        documents = {
+            doc_id: {'id': doc_id, 'content': content, 'metadata': metadata}
+            for doc_id, content, metadata in zip(
+                results['ids'], results['documents'], results['metadatas']
+            )
+        }
+        if include_embeddings:
+            for doc_id, embedding in zip(results['ids'], results['embeddings']):
+                documents[doc_id]['embedding'] = embedding
+        return documents
+    
+    def lexical_search(self, query: str, k: int = 5,
+                       doc_type: Optional[str] = None) -> List[Tuple[str, float]]:
+        """Busqueda lexica BM25; devuelve (id, puntuacion)"""
+        self._ensure_lexical_index()
+        return self.lexical_index.search(query, k, doc_type)
+    
+    def hybrid_search_many(self, queries: List[str], k: int = 5,
+                           doc_type: Optional[str] = None,
+                           rrf_k: int = 60,
+                           filters: Optional[Dict[str, Any]] = None,
+                           include_embeddings: bool = False) -> List[List[Dict[str, Any]]]:
+        """Busqueda hibrida: fusiona resultados vectoriales y BM25 con RRF"""
+        candidates = k * 2
+        vector_results = self.similarity_search_many(
+            queries, candidates, doc_type, filters, include_embeddings
+        )
+        lexical_results = [
+            self.lexical_search(query, candidates, doc_type) for query in queries
+        ]
+        
+        fetched: Dict[str, Dict[str, Any]] = {}
+        if filters:
+            # El indice BM25 solo filtra por doc_type: el resto se comprueba aqui
+            fetched = self.get_documents(sorted({
+                doc_id for lexical in lexical_results for doc_id, _ in lexical
+            }), include_embeddings)
+            lexical_results = [
+                [(doc_id, score) for doc_id, score in lexical
+                 if doc_id in fetched and all(
+                     fetched[doc_id]['metadata'].get(key) == value
+                     for key, value in filters.items()
+                 )]
+                for lexical in lexical_results
+            ]
+        
+        fused_per_query = []
+        missing_ids = set()
+        for vector_docs, lexical in zip(vector_results, lexical_results):
+            fused = reciprocal_rank_fusion(
+                [[doc['id'] for doc in vector_docs], [doc_id for doc_id, _ in lexical]], k=rrf_k
+            )[:k]
+            known = {doc['id'] for doc in vector_docs}
+            missing_ids.update(
+                doc_id for doc_id, _ in fused if doc_id not in known and doc_id not in fetched
+            )
+            fused_per_query.append((fused, vector_docs, dict(lexical)))
+        
+        # Una sola lectura para los chunks que solo encontro BM25
+        fetched.update(self.get_documents(sorted(missing_ids), include_embeddings))
+        
+        all_results = []
+        for fused, vector_docs, lexical_scores in fused_per_query:
+            by_id = {doc['id']: doc for doc in vector_docs}
+            results = []
+            for doc_id, score in fused:
+                doc = by_id.get(doc_id) or fetched.get(doc_id)
+                if doc is None:
+                    continue
+                results.append({
+                    'id': doc_id,
+                    'content': doc['content'],
+                    'metadata': doc['metadata'],
+                    'distance': doc.get('distance'),
+                    'lexical_score': lexical_scores.get(doc_id),
+                    'score': score
+                })
+                if include_embeddings:
+                    results[-1]['embedding'] = doc.get('embedding')
+            all_results.append(results)
+        return all_results
+    
+    def resolve_parents(self, results: List[Dict[str, Any]], k: int) -> List[Dict[str, Any]]:
+        """Sustituye chunks hijos por sus ventanas padre, sin repetir padres
+        
+        Los resultados sin 'parent_index' (indices no jerarquicos) se devuelven
+        tal cual. Cada padre conserva la mejor puntuacion de sus hijos y usa
+        como chunk_index el indice del padre, de modo que el ContextPacker une
+        ventanas consecutivas.
+        """
+        keys = [
+            (doc['metadata']['source'], doc['metadata']['parent_index'])
+            for doc in results if 'parent_index' in doc.get('metadata', {})
+        ]
+        parents = self.parent_store.get_many(keys)
+        
+        resolved: List[Dict[str, Any]] = []
+        by_key: Dict[Tuple[str, int], Dict[str, Any]] = {}
+        for doc in results:
+            metadata = doc.get('metadata', {})
+            key = (metadata.get('source'), metadata.get('parent_index'))
+            parent = parents.get(key) if 'parent_index' in metadata else None
+            if parent is None:
+                resolved.append(doc)
+            elif key in by_key:
+                by_key[key]['matched_children'] += 1
+                continue
+            else:
+                entry = {
+                    **doc,
+                    'id': f"{key[0]}#parent{key[1]}",
+                    'content': parent['content'],
+                    'metadata': {**parent['metadata'], 'chunk_index': key[1]},
+                    'matched_children': 1,
+                    'child_content': doc['content']
+                }
+                by_key[key] = entry
+                resolved.append(entry)
+            if len(resolved) >= k:
+                break
+        return resolved
     
     def get_collection_stats(self) -> Dict[str, Any]:
         """Obtiene estadisticas de la coleccion"""
@@ -120,24 +946,59 @@ class VectorStore:
             return {
                 "total_documents": count,
                 "embedding_model": self.embedding_model_name,
-                "collection_name": self.collection_name
+                "collection_name": self.collection_name,
+                "project": self.project,
+                "backend": self.backend_name,
+                "encoder_ready": self.is_encoder_ready(),
+                "manifest_documents": len(self.manifest.sources()),
+                "embedding_cache": (
+                    self.embedding_cache.get_stats() if self.embedding_cache else {"enabled": False}
+                ),
+                "lexical_index": self.lexical_index.get_stats(),
+                "parent_store": self.parent_store.get_stats(),
+                "dedup": self.dedup.get_stats() if self.dedup else {"enabled": False},
+                "backend_stats": (
+                    self.collection.get_stats() if hasattr(self.collection, "get_stats") else {}
+                ),
+                "query_cache": {
+                    "entries": len(self._query_cache),
+                    "max_entries": self.query_cache_size,
+                    "hits": self.query_cache_hits,
+                    "misses": self.query_cache_misses
+                },
+                "version": self.version,
+                "result_cache": self.result_cache.get_stats()
             }
         except Exception as e:
             self.logger.error(f"Error obteniendo estadisticas: {str(e)}")
             return {}
     
-    def delete_documents_by_source(self, source: str) -> bool:
-        """Elimina documentos por fuente"""
-        try:
+    def _delete_source_chunks(self, source: str) -> int:
+        """Elimina los chunks de una fuente y devuelve cuantos habia"""
+        with self._lock:
             # Obtener IDs de documentos de la fuente
             results = self.collection.get(
                 where={"source": source},
-                include=["documents"]
+                include=[]
             )
             
-            if results['ids']:
-                self.collection.delete(ids=results['ids'])
-                self.logger.info(f"Eliminados {len(results['ids'])} documentos de {source}")
+            refresh = self.dedup.remove_source_aliases(source) if self.dedup is not None else []
+            if results['ids'] or refresh:
+                self._delete_rows(results['ids'], refresh)
+        
+        return len(results['ids'])
+    
+    def delete_documents_by_source(self, source: str) -> bool:
+        """Elimina documentos por fuente"""
+        try:
+            deleted = self._delete_source_chunks(source)
+            self.parent_store.delete_source(source)
+            self.flush_auxiliary()
+            self.manifest.remove(source)
+            self._bump_version()
+            
+            if deleted:
+                self.logger.info(f"Eliminados {deleted} documentos de {source}")
                 return True
             else:
                 self.logger.info(f"No se encontraron documentos de {source}")
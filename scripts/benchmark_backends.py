@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Compara los backends vectoriales (ChromaDB vs indice NumPy) con la misma API"""
+
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from pathlib import Path
+
+# Añadir el directorio raiz al path
+project_root = Path(__file__).parent.parent
+sys.path.append(str(project_root))
+
+from rag.rag_manager import RAGManager
+
+logging.basicConfig(level=logging.WARNING)
+
+DEFAULT_QUERIES = [
+    "reglas de magia",
+    "¿Quien es Umiel?",
+    "La Cacería del Panteón",
+    "Lisan al-Gaib",
+    "intriga politica en la iglesia",
+    "Inquisidores",
+    "ciudad del este",
+    "personajes principales"
+]
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def benchmark_backend(backend: str, docs_dir: str, queries, k: int, repeats: int):
+    """Ingiere docs_dir en un directorio temporal y mide consultas"""
+    work_dir = tempfile.mkdtemp(prefix=f"rag_bench_{backend}_")
+    try:
+        start = time.perf_counter()
+        rag = RAGManager(vector_store_path=work_dir, backend=backend)
+        init_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rag.ingest_directory(docs_dir)
+        ingest_time = time.perf_counter() - start
+
+        store = rag.vector_store
+        store.encode_queries(queries)  # calentar el cache de consultas
+
+        latencies = []
+        results = {}
+        for _ in range(repeats):
+            for query in queries:
+                start = time.perf_counter()
+                docs = store.similarity_search(query, k)
+                latencies.append((time.perf_counter() - start) * 1000)
+                results[query] = [doc['id'] for doc in docs]
+
+        start = time.perf_counter()
+        store.similarity_search_many(queries, k)
+        batch_time = (time.perf_counter() - start) * 1000
+
+        return {
+            "backend": backend,
+            "chunks": store.get_collection_stats().get("total_documents", 0),
+            "init_s": init_time,
+            "ingest_s": ingest_time,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "batch_ms": batch_time,
+            "results": results
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de backends vectoriales")
+    parser.add_argument("--docs", default=str(project_root / "data" / "reference_docs"))
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"🧪 Benchmark de backends sobre {args.docs}")
+    reports = [
+        benchmark_backend(backend, args.docs, DEFAULT_QUERIES, args.k, args.repeats)
+        for backend in ("chroma", "numpy")
+    ]
+
+    for report in reports:
+        print(f"\n📊 {report['backend']}: {report['chunks']} chunks")
+        print(f"   Inicializacion: {report['init_s']:.2f}s | Ingesta: {report['ingest_s']:.2f}s")
+        print(f"   Consulta p50: {report['p50_ms']:.2f}ms | p95: {report['p95_ms']:.2f}ms")
+        print(f"   Lote de {len(DEFAULT_QUERIES)} consultas: {report['batch_ms']:.2f}ms")
+
+    chroma, numpy_report = reports
+    overlaps = [
+        len(set(chroma["results"][query]) & set(numpy_report["results"][query])) / args.k
+        for query in DEFAULT_QUERIES
+    ]
+    print(f"\n🔗 Coincidencia top-{args.k} entre backends: {sum(overlaps) / len(overlaps):.2%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Recall@k y memoria del indice NumPy segun el tipo de almacenamiento de los vectores"""
+
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+# Añadir el directorio raiz al path
+project_root = Path(__file__).parent.parent
+sys.path.append(str(project_root))
+
+from rag.rag_manager import RAGManager
+from rag.numpy_index import NumpyBackend
+from benchmark_backends import DEFAULT_QUERIES, percentile
+
+logging.basicConfig(level=logging.WARNING)
+
+CONFIGURATIONS = [
+    ("float32", False),
+    ("float16", False),
+    ("float16", True),
+    ("int8", False),
+    ("int8", True)
+]
+
+def build_queries(store, documents, sample: int, seed: int = 0) -> np.ndarray:
+    """Consultas fijas mas frases tomadas de chunks al azar"""
+    rng = np.random.default_rng(seed)
+    queries = list(DEFAULT_QUERIES)
+    for index in rng.choice(len(documents), size=min(sample, len(documents)), replace=False):
+        words = documents[index].split()
+        queries.append(" ".join(words[:24]))
+    return store.encode_queries(queries)
+
+def benchmark_configuration(ids, documents, metadatas, embeddings, queries,
+                            dtype: str, exact_rerank: bool, k: int, repeats: int):
+    work_dir = tempfile.mkdtemp(prefix=f"rag_quant_{dtype}_")
+    try:
+        backend = NumpyBackend(work_dir, "bench", dtype=dtype, exact_rerank=exact_rerank)
+        backend.upsert(ids, documents, metadatas, embeddings)
+
+        latencies = []
+        for _ in range(repeats):
+            for query in queries:
+                start = time.perf_counter()
+                backend.query(query[None, :], k, include=[])
+                latencies.append((time.perf_counter() - start) * 1000)
+        results = backend.query(queries, k, include=[])["ids"]
+
+        return {
+            "name": f"{dtype}{' + rerank' if backend.exact_rerank else ''}",
+            "stats": backend.get_stats(),
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "results": results
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de cuantizacion del indice NumPy")
+    parser.add_argument("--docs", default=str(project_root / "data" / "reference_docs"))
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200, help="consultas tomadas de chunks")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"🧪 Benchmark de cuantizacion sobre {args.docs}")
+    work_dir = tempfile.mkdtemp(prefix="rag_quant_ingest_")
+    try:
+        rag = RAGManager(vector_store_path=work_dir, backend="numpy")
+        rag.ingest_directory(args.docs)
+        store = rag.vector_store
+        data = store.collection.get(include=["documents", "metadatas", "embeddings"])
+        if not data["ids"]:
+            print("❌ No hay chunks indexados")
+            return
+        embeddings = np.asarray(data["embeddings"], dtype=np.float32)
+        queries = build_queries(store, data["documents"], args.queries)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    reports = [
+        benchmark_configuration(data["ids"], data["documents"], data["metadatas"], embeddings,
+                                queries, dtype, exact_rerank, args.k, args.repeats)
+        for dtype, exact_rerank in CONFIGURATIONS
+    ]
+
+    # La referencia es la busqueda exacta en float32
+    reference = reports[0]["results"]
+    print(f"\n📊 {len(data['ids'])} chunks, {len(queries)} consultas, k={args.k}")
+    for report in reports:
+        recall = np.mean([
+            len(set(expected) & set(found)) / max(1, len(expected))
+            for expected, found in zip(reference, report["results"])
+        ])
+        stats = report["stats"]
+        reduction = stats["float32_bytes"] / max(1, stats["index_bytes"])
+        print(f"   {report['name']:<16} recall@{args.k}: {recall:.4f} | "
+              f"indice: {stats['index_bytes'] / 1024:.0f} KB ({reduction:.1f}x) | "
+              f"p50: {report['p50_ms']:.2f}ms | p95: {report['p95_ms']:.2f}ms")
+
+if __name__ == "__main__":
+    main()
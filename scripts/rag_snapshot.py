@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Exporta o importa snapshots portables del vector store
+
+Ejemplos:
+    python scripts/rag_snapshot.py export rag_library.snap --dtype int8
+    python scripts/rag_snapshot.py import rag_library.snap
+"""
+
+import sys
+import time
+import logging
+import argparse
+from pathlib import Path
+
+# Añadir el directorio raiz al path
+project_root = Path(__file__).parent.parent
+sys.path.append(str(project_root))
+
+from rag.rag_manager import RAGManager
+
+logging.basicConfig(level=logging.INFO)
+
+def main():
+    parser = argparse.ArgumentParser(description="Snapshots del vector store RAG")
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("path", help="Archivo de snapshot")
+    parser.add_argument("--dtype", choices=["float16", "int8"], default="float16",
+                        help="Tipo de los vectores al exportar")
+    parser.add_argument("--project", default=None, help="Proyecto (por defecto el general)")
+    parser.add_argument("--vectorstore", default="./rag/vectorstore")
+    args = parser.parse_args()
+
+    rag = RAGManager(vector_store_path=args.vectorstore, project=args.project)
+    start = time.perf_counter()
+    if args.action == "export":
+        result = rag.export_snapshot(args.path, args.dtype)
+        print(f"💾 Exportados {result['chunks']} chunks ({result['dtype']}, "
+              f"{result['bytes'] / 1024 / 1024:.1f} MB) a {result['path']}")
+    else:
+        result = rag.import_snapshot(args.path)
+        print(f"📥 Importados {result['chunks']} chunks desde {result['path']}")
+    print(f"⏱️ {time.perf_counter() - start:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -94,13 +94,16 @@ def test_llm_integration(model_path: str = ""):
         
         # Prueba con contexto RAG
         rag = RAGManager()
-        rag_result = rag.query("Describe el reino de Aethermoor")
+        question = "Describe las caracteristicas principales de este reino"
+        rag_result = rag.query(
+            "Describe el reino de Aethermoor",
+            token_budget=llm.context_token_budget(question),
+            token_counter=llm.count_tokens
+        )
         
         if rag_result['context']:
-            llm_response = llm.generate_with_context(
-                "Describe las caracteristicas principales de este reino",
-                rag_result['context']
-            )
+            print(f"📦 Contexto empaquetado: {rag_result['tokens']} tokens de {len(rag_result['sources'])} fuentes")
+            llm_response = llm.generate_with_context(question, rag_result['context'])
             print(f"🔗 Respuesta con contexto RAG: {llm_response}")
         
         print("✅ Pruebas LLM completadas")
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pruebas del gestor del LLM local
+
+- Reutilizacion del estado KV del rol de un agente en sus llamadas
+- Streaming token a token y cancelacion al cerrar el generador
+- Worker de inferencia: prioridades, turnos entre sesiones y plazos
+- Cache de respuestas persistente, acotado y ligado al modelo y al muestreo
+- Metricas: tokens del tokenizer, tiempos, etiquetas y percentiles de latencia
+
+No carga modelos: un Llama de prueba tokeniza por palabras y cuenta los
+tokens que evalua, imitando la reutilizacion de contexto de llama.cpp.
+"""
+
+import sys
+import time
+import asyncio
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy as np
+
+# Añadir el directorio raiz al path
+project_root = Path(__file__).parent
+sys.path.append(str(project_root))
+
+from llm_local import llama_manager
+from llm_local.llama_manager import LlamaManager
+from llm_local.inference_worker import InferenceWorker, RequestPriority, DeadlineExceeded
+from llm_local.response_cache import ResponseCache
+from llm_local.metrics import GenerationMetrics, GenerationUsage
+
+class FakeLlamaState:
+    """Estado guardado del contexto del modelo de prueba"""
+
+    def __init__(self, input_ids, n_tokens: int):
+        self.input_ids = input_ids
+        self.n_tokens = n_tokens
+        self.llama_state_size = 16 * n_tokens
+
+class FakeLlama:
+    """Llama determinista: un token por palabra y contexto reutilizable"""
+
+    max_words = 8
+    token_delay = 0.005
+
+    def __init__(self, model_path: str = None, n_ctx: int = 4096, **kwargs):
+        self.input_ids = np.zeros(n_ctx, dtype=np.intc)
+        self.n_tokens = 0
+        self.evaluated = 0
+        self.calls = 0
+        self.streamed = 0
+        self.closed_streams = 0
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False):
+        tokens = [sum(word.encode('utf-8')) % 30000 + 2 for word in text.decode('utf-8').split(" ")]
+        return ([1] if add_bos else []) + tokens
+
+    def detokenize(self, tokens) -> bytes:
+        return b" ".join(b"t" for _ in tokens)
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens):
+        self.input_ids[self.n_tokens:self.n_tokens + len(tokens)] = tokens
+        self.n_tokens += len(tokens)
+        self.evaluated += len(tokens)
+
+    def save_state(self) -> FakeLlamaState:
+        return FakeLlamaState(self.input_ids.copy(), self.n_tokens)
+
+    def load_state(self, state: FakeLlamaState):
+        self.input_ids = state.input_ids.copy()
+        self.n_tokens = state.n_tokens
+
+    def __call__(self, prompt: str, max_tokens: int = 16, stream: bool = False, **kwargs):
+        self.calls += 1
+        # Como llama.cpp: solo evalua lo que sigue al prefijo comun con el contexto
+        tokens = self.tokenize(prompt.encode('utf-8'))
+        common = 0
+        for current, token in zip(self.input_ids[:self.n_tokens], tokens[:-1]):
+            if current != token:
+                break
+            common += 1
+        self.n_tokens = common
+        self.eval(tokens[common:])
+        words = [f" palabra{i}" for i in range(min(max_tokens, self.max_words))]
+        if stream:
+            return self._stream(words)
+        return {"choices": [{"text": "".join(words), "finish_reason": "length"}],
+                "usage": {"prompt_tokens": len(tokens), "completion_tokens": len(words)}}
+
+    def _stream(self, words):
+        try:
+            for word in words:
+                time.sleep(self.token_delay)
+                self.streamed += 1
+                yield {"choices": [{"text": word, "finish_reason": None}]}
+        finally:
+            self.closed_streams += 1
+
+def _create_manager(directory: str, model_name: str = "modelo.gguf", **kwargs) -> LlamaManager:
+    """LlamaManager con el Llama de prueba (por defecto sin cache de respuestas)"""
+    llama_manager.Llama = FakeLlama
+    llama_manager.LLAMA_CPP_AVAILABLE = True
+    model_path = Path(directory) / model_name
+    model_path.write_bytes(model_name.encode('utf-8'))
+    kwargs.setdefault("cache_dir", None)
+    kwargs.setdefault("enable_cache", False)
+    manager = LlamaManager(str(model_path), **kwargs)
+    assert manager.is_available()
+    return manager
+
+def _crewai_messages(role: str, goal: str, backstory: str, task: str):
+    """Mensajes de una llamada de CrewAI: rol, herramientas y formato, y la tarea"""
+    system = (f"You are {role}. {backstory}\nYour personal goal is: {goal}"
+              "\n\nYou ONLY have access to the following tools: busqueda_rag"
+              "\n\nIMPORTANT: Use the following format in your response: Thought: ...")
+    return [{"role": "system", "content": system}, {"role": "user", "content": task}]
+
+def test_agent_prefix_reuse():
+    """Las llamadas de un agente registrado no vuelven a evaluar su rol"""
+    lorekeeper = ("Lorekeeper", "Mantener la coherencia del mundo " * 4,
+                  "Eres un erudito meticuloso que custodia la historia del reino. " * 6)
+    proofreader = ("Proofreader", "Corregir cada capitulo " * 4,
+                   "Revisas cada coma y cada tilde con paciencia infinita. " * 6)
+    with tempfile.TemporaryDirectory() as directory:
+        manager = _create_manager(directory)
+        manager.register_agent(*lorekeeper)
+        manager.register_agent(*proofreader)
+
+        evaluated = []
+        for agent, task in [(lorekeeper, "Revisa el capitulo 1"), (proofreader, "Corrige el capitulo 1"),
+                            (lorekeeper, "Revisa el capitulo 2"), (proofreader, "Corrige el capitulo 2")]:
+            before = manager.model.evaluated
+            assert manager.call(_crewai_messages(*agent, task)).startswith("palabra0")
+            evaluated.append(manager.model.evaluated - before)
+
+        stats = manager.get_stats()['prefix_cache']
+        # Primera llamada de cada agente: evalua y guarda el rol; la segunda lo restaura
+        assert stats['evaluations'] == 2
+        assert stats['memory_hits'] == 2
+        assert stats['tokens_skipped'] > 0
+        assert evaluated[2] < evaluated[0] / 2
+        assert evaluated[3] < evaluated[1] / 2
+
+def test_stream_cancel():
+    """El streaming entrega la misma respuesta por tokens y se detiene al cerrarlo"""
+    prompt = "Describe el puerto de Aldamar al anochecer."
+    with tempfile.TemporaryDirectory() as directory:
+        manager = _create_manager(directory)
+        model = manager.model
+        model.max_words = 40
+
+        async def run():
+            whole = await manager.generate_async(prompt, max_tokens=40)
+            tokens = [token async for token in manager.generate_stream_async(prompt, max_tokens=40)]
+            assert "".join(tokens).strip() == whole.text
+
+            # El consumidor se va tras dos tokens: la generacion no llega al final
+            stream = manager.generate_stream_async(prompt, max_tokens=40)
+            received = [await stream.__anext__(), await stream.__anext__()]
+            await stream.aclose()
+            assert received == ["palabra0", " palabra1"]
+            return model.streamed
+
+        # 40 tokens del primer streaming y menos de 40 del cancelado
+        streamed = asyncio.run(run())
+        assert 42 <= streamed < 80
+        assert model.closed_streams == 2
+        stats = manager.get_stats()
+        assert stats['cancelled_generations'] == 1
+        assert stats['streamed_generations'] == 1
+        # El worker queda libre para la siguiente peticion
+        assert manager.generate("Otra pregunta", max_tokens=4) == "palabra0 palabra1 palabra2 palabra3"
+
+def test_worker_scheduling():
+    """Interactivas antes que lotes, sesiones por turnos y plazos vencidos descartados"""
+    worker = InferenceWorker(name="llm-inference-test")
+    order = []
+    release = threading.Event()
+    try:
+        # Mientras el worker esta ocupado se encola todo lo demas
+        blocker = worker.submit(release.wait, 5)
+        while not blocker.running():
+            time.sleep(0.001)
+        for name in ("a1", "a2", "a3"):
+            worker.submit(order.append, name, priority=RequestPriority.BATCH, session="analisis")
+        worker.submit(order.append, "b1", priority=RequestPriority.BATCH, session="revision")
+        late = worker.submit(order.append, "tarde", priority=RequestPriority.BATCH,
+                             session="resumen", deadline=0.01)
+        last = worker.submit(order.append, "interactiva", priority=RequestPriority.INTERACTIVE,
+                             session="chat")
+        time.sleep(0.05)
+        release.set()
+
+        assert blocker.result(timeout=5)
+        last.result(timeout=5)
+        try:
+            late.result(timeout=5)
+        except DeadlineExceeded:
+            pass
+        else:
+            raise AssertionError("Peticion ejecutada despues de su plazo")
+        worker.submit(order.append, "fin").result(timeout=5)
+
+        assert order == ["interactiva", "a1", "b1", "a2", "a3", "fin"]
+        stats = worker.get_stats()
+        assert stats['expired'] == 1
+        assert stats['completed'] == 7
+        assert stats['max_queue_depth'] == 6
+    finally:
+        release.set()
+        worker.stop()
+
+def test_response_cache():
+    """Las respuestas se reutilizan entre instancias y dependen de modelo y muestreo"""
+    prompt = "Resume el capitulo de la tormenta."
+    with tempfile.TemporaryDirectory() as directory:
+        cache_dir = str(Path(directory) / "cache")
+        manager = _create_manager(directory, cache_dir=cache_dir, enable_cache=True)
+        first = asyncio.run(manager.generate_async(prompt, max_tokens=4))
+        repeated = asyncio.run(manager.generate_async(prompt, max_tokens=4))
+        assert not first.cached and repeated.cached and repeated.text == first.text
+        # Otro muestreo es otra respuesta
+        assert not asyncio.run(manager.generate_async(prompt, max_tokens=4, temperature=0.2)).cached
+        assert manager.model.calls == 2
+        manager.response_cache.close()
+
+        # Tras reiniciar, la respuesta sale del disco sin llamar al modelo
+        restarted = _create_manager(directory, cache_dir=cache_dir, enable_cache=True)
+        again = asyncio.run(restarted.generate_async(prompt, max_tokens=4))
+        assert again.cached and again.text == first.text and restarted.model.calls == 0
+        assert restarted.response_cache.get_stats()['disk_hits'] == 1
+        restarted.response_cache.close()
+
+        # Otro archivo de modelo no comparte respuestas
+        other = _create_manager(directory, "otro-modelo.gguf", cache_dir=cache_dir,
+                                enable_cache=True)
+        assert not asyncio.run(other.generate_async(prompt, max_tokens=4)).cached
+        other.response_cache.close()
+
+    # LRU en memoria acotado en bytes: se desaloja la entrada menos usada
+    cache = ResponseCache(None, max_memory_bytes=3 * (64 + 100))
+    for key in ("a", "b", "c"):
+        cache.put(key * 64, "x" * 100)
+    assert cache.get("a" * 64) is not None
+    cache.put("d" * 64, "x" * 100)
+    assert cache.get("b" * 64) is None
+    assert all(cache.get(key * 64) is not None for key in ("a", "c", "d"))
+    assert cache.get_stats()['memory_evictions'] == 1
+
+def test_generation_metrics():
+    """Tokens y tiempos por etiqueta, con o sin uso informado por llama.cpp"""
+    prompt = "Enumera los barcos de la flota real."
+    with tempfile.TemporaryDirectory() as directory:
+        manager = _create_manager(directory)
+
+        async def run():
+            await manager.generate_async(prompt, max_tokens=4, tag="lorekeeper")
+            # En streaming llama.cpp no informa del uso: se cuenta con el tokenizer
+            async for _ in manager.generate_stream_async(prompt, max_tokens=6, tag="lorekeeper"):
+                pass
+            await manager.generate_async(prompt, max_tokens=3, session="beta_reader")
+
+        asyncio.run(run())
+        prompt_tokens = len(manager.model.tokenize(prompt.encode('utf-8')))
+        usage = manager.get_stats()['usage_by_tag']
+        assert sorted(usage) == ["beta_reader", "lorekeeper"]
+        lorekeeper = usage['lorekeeper']
+        assert lorekeeper['requests'] == 2
+        assert lorekeeper['prompt_tokens'] == 2 * prompt_tokens
+        assert lorekeeper['completion_tokens'] == 4 + 6
+        # Sin contadores de llama.cpp el streaming separa prompt y generacion por el primer token
+        assert lorekeeper['generation_ms'] > 0 and lorekeeper['tokens_per_second'] > 0
+        assert usage['beta_reader']['completion_tokens'] == 3
+        assert manager.get_stats()['usage']['requests'] == 3
+
+    metrics = GenerationMetrics()
+    for latency_ms in range(1, 101):
+        metrics.record("revision", latency_ms / 1000, GenerationUsage(completion_tokens=1))
+    metrics.record("revision", 0.2, GenerationUsage(completion_tokens=5), cached=True)
+    metrics.record("revision", 3.0, success=False)
+    revision = metrics.get_stats()['revision']
+    assert revision['requests'] == 102 and revision['cached'] == 1 and revision['failed'] == 1
+    assert revision['completion_tokens'] == 100 and revision['cached_tokens'] == 5
+    # Percentil por rango mas cercano sobre las 102 latencias
+    assert revision['latency_ms']['p50'] == 51.0
+    assert revision['latency_ms']['p95'] == 97.0
+    assert revision['latency_ms']['p99'] == 200.0
+    assert revision['latency_ms']['histogram']['<=100'] == 100
+    assert revision['latency_ms']['histogram']['<=250'] == 1
+    assert revision['latency_ms']['histogram']['<=5000'] == 1
+
+def main():
+    """Ejecuta las pruebas e imprime un resumen"""
+    print("🧪 LLM local - Pruebas")
+    print("=" * 50)
+
+    tests = [
+        ("Reutilizacion del rol de un agente", test_agent_prefix_reuse),
+        ("Streaming y cancelacion", test_stream_cancel),
+        ("Planificacion del worker de inferencia", test_worker_scheduling),
+        ("Cache de respuestas", test_response_cache),
+        ("Metricas de generacion", test_generation_metrics),
+    ]
+    passed = 0
+    for name, test in tests:
+        try:
+            test()
+            print(f"✅ {name}")
+            passed += 1
+        except Exception as e:
+            print(f"❌ {name}: {e!r}")
+            import traceback
+            traceback.print_exc()
+
+    print(f"\n📊 Resultado: {passed}/{len(tests)} pruebas exitosas")
+    return passed == len(tests)
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
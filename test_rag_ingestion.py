@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pruebas de la ingesta del sistema RAG
+
+- Re-ingesta incremental: archivos sin cambios omitidos y solo chunks nuevos
+- Troceado en streaming: el primer chunk sale antes de leer todo el archivo
+- Chunks estructurados que no cruzan capitulos, escenas ni secciones
+- Chunks de registros tabulares con la cabecera de su hoja y sin partir filas
+- Registros JSON partidos en el primer array de la ruta
+- Carga completa de JSON sin ijson limitada por json_max_load_mb
+
+No descarga modelos: se usa el codificador de prueba de test_rag_storage y
+un contador de tokens por palabras.
+"""
+
+import sys
+import json
+import shutil
+import builtins
+import tempfile
+from pathlib import Path
+
+# Añadir el directorio raiz al path
+project_root = Path(__file__).parent
+sys.path.append(str(project_root))
+
+from rag import registry, tabular
+from rag.document_processor import DocumentProcessor
+from rag.ingestion import IngestionPipeline
+from test_rag_storage import TEST_MODEL, _create_store
+
+def _word_count(text: str) -> int:
+    return len(text.split())
+
+def _create_processor(**kwargs) -> DocumentProcessor:
+    """Procesador estructurado que cuenta tokens por palabras"""
+    kwargs.setdefault("chunk_overlap_tokens", 0)
+    processor = DocumentProcessor(embedding_model=TEST_MODEL, **kwargs)
+    processor._token_counter = _word_count
+    return processor
+
+def _write_json(directory: str, name: str, data) -> Path:
+    """Escribe un JSON de prueba y devuelve su ruta"""
+    path = Path(directory) / name
+    path.write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+    return path
+
+def test_manifest_incremental_reingest():
+    """Sin cambios no se re-embebe nada; al editar solo se embeben los chunks nuevos"""
+    chapter = ["La reina Umiel cruza el puente de obsidiana al amanecer.",
+               "Los guardias del norte encienden hogueras junto a la muralla.",
+               "Un cuervo blanco trae noticias del archipielago perdido."]
+    appendix = ["El mapa del reino muestra siete provincias costeras.",
+                "Las monedas de plata llevan grabado un dragon dormido."]
+    directory = tempfile.mkdtemp()
+    try:
+        chapter_path = Path(directory) / "capitulo.txt"
+        appendix_path = Path(directory) / "apendice.txt"
+        chapter_path.write_text("\n\n".join(chapter), encoding='utf-8')
+        appendix_path.write_text("\n\n".join(appendix), encoding='utf-8')
+        paths = [str(chapter_path), str(appendix_path)]
+
+        store = _create_store(str(Path(directory) / "store"))
+        processor = _create_processor(chunk_tokens=16)
+        first = IngestionPipeline(store, processor, max_workers=1).run(paths)
+        assert first.successful_files == 2 and first.total_chunks == 5
+
+        second = IngestionPipeline(store, processor, max_workers=1).run(paths)
+        assert second.skipped_files == 2 and second.total_chunks == 0
+
+        chapter[1] = "Los guardias del sur apagan las antorchas bajo la lluvia."
+        chapter_path.write_text("\n\n".join(chapter), encoding='utf-8')
+        third = IngestionPipeline(store, processor, max_workers=1).run(paths)
+        assert third.files[str(chapter_path)].status == "done"
+        assert third.files[str(chapter_path)].chunks == 1
+        assert third.files[str(appendix_path)].status == "skipped"
+
+        stored = store.collection.get(where={'source': str(chapter_path)}, include=["documents"])
+        assert sorted(stored['documents']) == sorted(chapter)
+        assert sorted(store.manifest.get(str(chapter_path))["chunks"]) == sorted(stored['ids'])
+        store.close()
+    finally:
+        registry.clear_registry()
+        shutil.rmtree(directory, ignore_errors=True)
+
+def test_streaming_text_chunks():
+    """Los chunks de un TXT se emiten mientras se lee, sin perder lineas"""
+    lines = [f"Linea {i} del diario de viaje de la capitana." for i in range(600)]
+    processor = DocumentProcessor(chunking="recursive", chunk_size=200, chunk_overlap=0)
+    processor.TEXT_BLOCK_SIZE = 256
+    read_blocks = []
+    read_text = processor._iter_txt
+
+    def counting_reader(file_path):
+        for block in read_text(file_path):
+            read_blocks.append(len(block))
+            yield block
+
+    processor._iter_txt = counting_reader
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "diario.txt"
+        path.write_text("\n".join(lines), encoding='utf-8')
+        size = path.stat().st_size
+
+        docs = processor.iter_document(str(path))
+        first = next(docs)
+        # Ventana de troceado: cuatro chunks mas el ultimo bloque leido
+        assert sum(read_blocks) <= processor.chunk_size * 4 + processor.TEXT_BLOCK_SIZE < size
+        docs = [first] + list(docs)
+
+    assert [doc.metadata['chunk_index'] for doc in docs] == list(range(len(docs)))
+    assert all(len(doc.content) <= processor.chunk_size for doc in docs)
+    chunk_lines = [line for doc in docs for line in doc.content.split("\n")]
+    assert chunk_lines == lines
+
+def test_structured_chunks():
+    """Los chunks respetan capitulos, escenas y secciones y los llevan en metadatos"""
+    manuscript = """Capitulo 1
+
+La capitana Irene despierta en la bodega del barco mientras la tormenta golpea el casco.
+
+El contramaestre le trae pan duro y noticias de la tripulacion amotinada.
+
+* * *
+
+Al anochecer la isla aparece entre la niebla como un lomo de ballena.
+
+Capitulo 2
+
+Las campanas del puerto suenan tres veces antes del alba."""
+    notes = """# Mundo
+
+## Geografia
+
+Tres continentes separados por mares helados.
+
+### Clima
+
+Inviernos largos y veranos breves.
+
+## Historia
+
+La guerra de las runas duro cien años."""
+    processor = _create_processor(chunk_tokens=40)
+    with tempfile.TemporaryDirectory() as directory:
+        novel_path = Path(directory) / "novela.txt"
+        notes_path = Path(directory) / "notas.md"
+        novel_path.write_text(manuscript, encoding='utf-8')
+        notes_path.write_text(notes, encoding='utf-8')
+        novel = processor.process_document(str(novel_path))
+        world = processor.process_document(str(notes_path))
+
+    # Los dos parrafos de la primera escena caben juntos; la escena y el capitulo cortan
+    assert [(doc.metadata['chapter'], doc.metadata['scene']) for doc in novel] == [
+        ("Capitulo 1", 1), ("Capitulo 1", 2), ("Capitulo 2", 1)]
+    assert novel[0].content.startswith("Capitulo 1\n\nLa capitana")
+    assert novel[0].content.endswith("tripulacion amotinada.")
+    assert novel[2].content.startswith("Capitulo 2\n\n")
+    assert all(doc.metadata['total_chunks'] == 3 for doc in novel)
+
+    assert [doc.metadata['section'] for doc in world] == [
+        "Geografia", "Geografia > Clima", "Historia"]
+    assert all(doc.metadata['chapter'] == "Mundo" for doc in world)
+    assert world[1].content == "Clima\n\nInviernos largos y veranos breves."
+
+def test_record_chunks():
+    """Las filas se agrupan por hoja sin partirse y cada chunk repite la cabecera"""
+    characters = "### Hoja: Personajes\nnombre | rol"
+    places = "### Hoja: Lugares\nnombre | region"
+    records = [tabular.Record([f"Personaje {row} | guardia real"], row, group="Personajes",
+                              header=characters) for row in range(2, 7)]
+    records.append(tabular.Record(["Puerto Gris | costa norte"], 2, group="Lugares", header=places))
+    # Un registro que no cabe en un chunk se parte repitiendo su titulo
+    records.append(tabular.Record([f"rasgo {i}: valiente y leal" for i in range(6)], "heroe",
+                                  group="json", title="personajes[0]"))
+
+    chunks = list(tabular.RecordChunker(_word_count, max_tokens=16).chunk(records))
+    spans = [(chunk.group, chunk.first_label, chunk.last_label, chunk.records) for chunk in chunks]
+    assert spans[:4] == [("Personajes", 2, 3, 2), ("Personajes", 4, 5, 2),
+                         ("Personajes", 6, 6, 1), ("Lugares", 2, 2, 1)]
+    assert all(chunk.text.startswith(characters + "\n") for chunk in chunks[:3])
+    assert chunks[3].text == places + "\nPuerto Gris | costa norte"
+
+    parts = chunks[4:]
+    assert len(parts) > 1
+    assert all(chunk.text.startswith("personajes[0]\n") for chunk in parts)
+    assert all(_word_count(chunk.text) <= 16 for chunk in parts)
+    assert [line for chunk in parts for line in chunk.text.split("\n")[1:]] == records[-1].lines
+
+def test_json_records_nested_array():
+    """Cada elemento de un array anidado es un registro con su titulo"""
+    data = {"data": {"items": [{"nombre": f"Personaje {i}", "rol": "heroe"} for i in range(3)]},
+            "config": {"version": 2, "idioma": "es"}}
+    with tempfile.TemporaryDirectory() as directory:
+        records = list(tabular.iter_json_records(_write_json(directory, "datos.json", data)))
+
+    assert [record.label for record in records] == [
+        "data.items[0]", "data.items[1]", "data.items[2]", "config"]
+    assert records[1].title == "data.items[1]"
+    assert records[1].lines == ["nombre: Personaje 1", "rol: heroe"]
+    assert records[3].lines == ["version: 2", "idioma: es"]
+
+def test_json_fallback_size_limit():
+    """Sin ijson los JSON pequeños se cargan y los grandes se rechazan"""
+    real_import = builtins.__import__
+
+    def import_without_ijson(name, *args, **kwargs):
+        if name == "ijson":
+            raise ImportError(name)
+        return real_import(name, *args, **kwargs)
+
+    original_setting = tabular.rag_setting
+    builtins.__import__ = import_without_ijson
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            path = _write_json(directory, "lista.json", [{"texto": "x" * 1024} for _ in range(1100)])
+            assert len(list(tabular.iter_json_records(path))) == 1100
+
+            tabular.rag_setting = lambda name, default: 1 if name == "json_max_load_mb" else default
+            try:
+                list(tabular.iter_json_records(path))
+            except ValueError as e:
+                assert "ijson" in str(e)
+            else:
+                raise AssertionError("JSON por encima del limite cargado sin ijson")
+    finally:
+        builtins.__import__ = real_import
+        tabular.rag_setting = original_setting
+
+def main():
+    """Ejecuta las pruebas e imprime un resumen"""
+    print("🧪 Ingesta RAG - Pruebas")
+    print("=" * 50)
+
+    tests = [
+        ("Re-ingesta incremental con manifiesto", test_manifest_incremental_reingest),
+        ("Troceado de texto en streaming", test_streaming_text_chunks),
+        ("Chunks estructurados", test_structured_chunks),
+        ("Chunks de registros tabulares", test_record_chunks),
+        ("Registros JSON en arrays anidados", test_json_records_nested_array),
+        ("Limite de JSON sin ijson", test_json_fallback_size_limit),
+    ]
+    passed = 0
+    for name, test in tests:
+        try:
+            test()
+            print(f"✅ {name}")
+            passed += 1
+        except Exception as e:
+            print(f"❌ {name}: {e!r}")
+            import traceback
+            traceback.print_exc()
+
+    print(f"\n📊 Resultado: {passed}/{len(tests)} pruebas exitosas")
+    return passed == len(tests)
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pruebas de la recuperacion del sistema RAG
+
+- Busqueda hibrida: fusion RRF de los rankings vectorial y BM25
+- Empaquetado del contexto: fusion de chunks, duplicados y presupuesto
+- MMR frente a casi duplicados y reranking dentro del presupuesto de latencia
+- Cache de resultados invalidado al cambiar la version de la coleccion
+
+No descarga modelos: se usa el codificador de prueba de test_rag_storage y
+un cross-encoder de prueba que puntua por palabras compartidas.
+"""
+
+import sys
+import time
+import shutil
+import tempfile
+from pathlib import Path
+
+# Añadir el directorio raiz al path
+project_root = Path(__file__).parent
+sys.path.append(str(project_root))
+
+import numpy as np
+
+from rag import registry
+from rag.registry import EmbeddingModelHandle
+from rag.retrieval import reciprocal_rank_fusion, mmr_select, CrossEncoderReranker
+from rag.context_packer import ContextPacker
+from rag.rag_manager import RAGManager
+from test_rag_storage import TEST_MODEL, _create_store, _ingest, _register_test_model
+
+PASSAGES = [
+    "La reina Umiel cruza el puente de obsidiana al amanecer.",
+    "Los guardias del norte encienden hogueras junto a la muralla.",
+    "Un cuervo blanco trae noticias del archipielago perdido.",
+    "El herrero Zarathel forja la espada de la reina en secreto.",
+    "Las campanas del puerto suenan tres veces antes del alba.",
+    "La reina escucha las campanas desde la torre del puerto.",
+]
+
+def test_reciprocal_rank_fusion():
+    """RRF premia lo que aparece en ambos rankings y conserva el resto"""
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "d"]], k=60)
+    assert [doc_id for doc_id, _ in fused] == ["c", "a", "b", "d"]
+    assert abs(dict(fused)["c"] - (1 / 63 + 1 / 61)) < 1e-12
+
+def test_hybrid_search_rrf():
+    """La busqueda hibrida ordena por RRF sobre los dos rankings"""
+    directory = tempfile.mkdtemp()
+    try:
+        store = _create_store(directory)
+        assert _ingest(store, "cronica.txt", PASSAGES)
+        query = "Zarathel forja la espada"
+
+        hybrid = store.hybrid_search_many([query], k=3)[0]
+        vector = store.similarity_search_many([query], 6)[0]
+        lexical = store.lexical_search(query, 6)
+        expected = reciprocal_rank_fusion(
+            [[doc['id'] for doc in vector], [doc_id for doc_id, _ in lexical]])[:3]
+
+        assert [doc['id'] for doc in hybrid] == [doc_id for doc_id, _ in expected]
+        assert hybrid[0]['content'] == PASSAGES[3]
+        assert hybrid[0]['lexical_score'] > 0
+        assert all(doc['score'] == score for doc, (_, score) in zip(hybrid, expected))
+        store.close()
+    finally:
+        registry.clear_registry()
+        shutil.rmtree(directory, ignore_errors=True)
+
+def _word_count(text: str) -> int:
+    return len(text.split())
+
+def _result(content: str, source: str, chunk_index: int, score: float):
+    doc_type = Path(source).suffix[1:]
+    return {'content': content, 'score': score,
+            'metadata': {'source': source, 'doc_type': doc_type, 'chunk_index': chunk_index}}
+
+def test_context_packer():
+    """Une chunks consecutivos, descarta casi duplicados y recorta en frase"""
+    smith = "El herrero Zarathel forja espadas para la guardia real desde hace cuarenta años en la {}."
+    results = [
+        _result("La reina Umiel cruza el puente de obsidiana. Los guardias la siguen en silencio.",
+                "cronica.txt", 0, 0.9),
+        _result("Los guardias la siguen en silencio. Al otro lado espera el consejo.",
+                "cronica.txt", 1, 0.8),
+        _result(smith.format("capital"), "notas.txt", 7, 0.85),
+        _result(smith.format("ciudad"), "copia.txt", 3, 0.7),
+        _result("El archipielago tiene siete islas. Cada isla guarda una runa. "
+                "Las runas despiertan con la luna llena.", "mundo.md", 2, 0.5),
+    ]
+    packed = ContextPacker(_word_count, min_fill_tokens=5).pack(results, 50)
+
+    # El solapamiento entre los chunks 0 y 1 aparece una sola vez
+    assert packed.context.count("Los guardias la siguen") == 1
+    assert [(source['source'], source['chunk_indices']) for source in packed.sources] == [
+        ("cronica.txt", [0, 1]), ("notas.txt", [7]), ("mundo.md", [2])]
+    assert packed.dropped_duplicates == 1
+    assert "ciudad" not in packed.context
+    # El ultimo pasaje se recorta a las frases completas que caben
+    assert packed.context.endswith("[Fuente: mundo.md]\nEl archipielago tiene siete islas.")
+    assert packed.tokens_used <= 50
+    assert _word_count(packed.context) <= packed.tokens_used
+
+class WordOverlapCrossEncoder:
+    """Cross-encoder de prueba: puntua por palabras compartidas, con retardo por lote"""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.batches = 0
+
+    def predict(self, pairs):
+        self.batches += 1
+        time.sleep(self.delay)
+        return [len(set(query.lower().split()) & set(text.lower().split()))
+                for query, text in pairs]
+
+def _create_reranker(name: str, model: WordOverlapCrossEncoder, budget_ms: float,
+                     ready: bool = True) -> CrossEncoderReranker:
+    """CrossEncoderReranker sobre un cross-encoder de prueba registrado"""
+    with registry._lock:
+        registry._cross_encoders[name] = EmbeddingModelHandle(
+            name, loader=lambda model_name: model, kind="de reranking"
+        )
+    reranker = CrossEncoderReranker(name, budget_ms=budget_ms, batch_size=2)
+    if ready:
+        reranker.handle.get()
+    return reranker
+
+def test_mmr_select():
+    """MMR cambia el casi duplicado del mejor candidato por uno distinto"""
+    query = [1.0, 0.0, 0.0]
+    candidates = np.array([[0.9, 0.1, 0.0],     # el mas relevante
+                           [0.9, 0.11, 0.0],    # casi identico al primero
+                           [0.7, 0.0, 0.7]])    # menos relevante pero distinto
+    assert mmr_select(query, candidates, 2, lambda_mult=0.5) == [0, 2]
+    assert mmr_select(query, candidates, 2, lambda_mult=1.0) == [0, 1]
+    assert mmr_select(query, candidates[:0], 2) == []
+
+def test_rerank_budget():
+    """El reranking reordena si cabe en el presupuesto y, si no, cede el orden de MMR"""
+    docs = [{'id': str(i), 'content': text} for i, text in enumerate(PASSAGES)]
+    query = "la reina escucha las campanas"
+    try:
+        fast = _create_reranker("rerank-rapido", WordOverlapCrossEncoder(), budget_ms=1000)
+        reranked = fast.rerank(query, docs)
+        assert reranked[0]['content'] == PASSAGES[5]
+        assert [doc['rerank_score'] for doc in reranked] == sorted(
+            (doc['rerank_score'] for doc in reranked), reverse=True)
+        assert fast.get_stats()['reranked'] == 1
+
+        # Primer lote de 20 ms con 10 ms de presupuesto: se abandona a mitad
+        model = WordOverlapCrossEncoder(delay=0.02)
+        slow = _create_reranker("rerank-lento", model, budget_ms=10)
+        assert slow.rerank(query, docs) is None
+        assert model.batches == 1
+        # Con el coste por par ya medido ni siquiera se empieza
+        assert slow.rerank(query, docs) is None
+        assert model.batches == 1
+        assert slow.get_stats()['fallbacks'] == 2
+
+        # Modelo aun sin cargar: se precarga en segundo plano y no se espera
+        cold = _create_reranker("rerank-frio", WordOverlapCrossEncoder(), budget_ms=1000,
+                                ready=False)
+        assert cold.rerank(query, docs) is None
+        assert cold.handle.wait(5)
+        assert cold.rerank(query, docs)[0]['content'] == PASSAGES[5]
+    finally:
+        registry.clear_registry()
+
+def test_result_cache_version():
+    """Las consultas repetidas salen del cache hasta la siguiente escritura"""
+    directory = tempfile.mkdtemp()
+    try:
+        _register_test_model()
+        manager = RAGManager(directory, TEST_MODEL, backend="numpy")
+        store = manager.vector_store
+        assert _ingest(store, "cronica.txt", PASSAGES[:4])
+        question = "quien forja la espada de la reina"
+
+        first = manager.query(question, k=2, mode="hybrid", rerank="none")
+        # Misma consulta normalizada (mayusculas y espacios): acierto en cache
+        second = manager.query("Quien  forja la espada de la REINA", k=2, mode="hybrid",
+                               rerank="none")
+        assert second['sources'] == first['sources']
+        assert store.result_cache.get_stats()['hits'] == 1
+
+        version = store.version
+        assert _ingest(store, "taller.txt", ["Zarathel forja la espada de la reina con acero negro."])
+        assert store.version > version
+        third = manager.query(question, k=2, mode="hybrid", rerank="none")
+        assert store.result_cache.get_stats()['hits'] == 1
+        assert "taller.txt" in [source['source'] for source in third['sources']]
+    finally:
+        registry.clear_registry()
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main():
+    """Ejecuta las pruebas e imprime un resumen"""
+    print("🧪 Recuperacion RAG - Pruebas")
+    print("=" * 50)
+
+    tests = [
+        ("Reciprocal Rank Fusion", test_reciprocal_rank_fusion),
+        ("Busqueda hibrida con RRF", test_hybrid_search_rrf),
+        ("Empaquetado del contexto", test_context_packer),
+        ("Diversificacion MMR", test_mmr_select),
+        ("Reranking con presupuesto", test_rerank_budget),
+        ("Cache de resultados por version", test_result_cache_version),
+    ]
+    passed = 0
+    for name, test in tests:
+        try:
+            test()
+            print(f"✅ {name}")
+            passed += 1
+        except Exception as e:
+            print(f"❌ {name}: {e!r}")
+            import traceback
+            traceback.print_exc()
+
+    print(f"\n📊 Resultado: {passed}/{len(tests)} pruebas exitosas")
+    return passed == len(tests)
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
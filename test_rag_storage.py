@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pruebas del almacenamiento del sistema RAG
+
+- Paridad del indice NumPy (busqueda plana e IVF) con ChromaDB
+- Cache de embeddings compartido entre backends del mismo directorio
+- Ida y vuelta de snapshots y rechazo de archivos corruptos
+- Deduplicacion: alias de casi duplicados y promocion del heredero
+- Re-ingesta en streaming de un documento editado
+
+No descarga modelos: los embeddings salen de un codificador determinista
+(bolsa de palabras con hashing) registrado como modelo compartido.
+"""
+
+import sys
+import zlib
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+# Añadir el directorio raiz al path
+project_root = Path(__file__).parent
+sys.path.append(str(project_root))
+
+from rag import registry
+from rag.registry import EmbeddingModelHandle
+from rag.backends import ChromaBackend
+from rag.numpy_index import NumpyBackend
+from rag.vector_store import VectorStore
+from rag.document_processor import ProcessedDocument
+from rag.manifest import hash_text
+from rag.snapshot import SnapshotError
+
+TEST_MODEL = "hashing-test-encoder"
+
+class HashingEncoder:
+    """Bolsa de palabras con hashing: mismo texto, mismo vector"""
+
+    dim = 64
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def encode(self, texts, **kwargs) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                vectors[row, zlib.crc32(word.encode('utf-8')) % self.dim] += 1.0
+        return vectors
+
+def _register_test_model():
+    """Registra el codificador de prueba como modelo compartido TEST_MODEL"""
+    with registry._lock:
+        registry._embedding_models[TEST_MODEL] = EmbeddingModelHandle(
+            TEST_MODEL, loader=lambda name: HashingEncoder()
+        )
+
+def _create_store(directory: str, backend: str = "numpy") -> VectorStore:
+    """VectorStore sobre el codificador de prueba"""
+    _register_test_model()
+    return VectorStore(directory, TEST_MODEL, backend=backend)
+
+def _documents(source: str, paragraphs):
+    return [
+        ProcessedDocument(
+            content=text, metadata={'source': source, 'doc_type': 'txt', 'chunk_index': i},
+            source=source, doc_type='txt'
+        )
+        for i, text in enumerate(paragraphs)
+    ]
+
+def _ingest(store: VectorStore, source: str, paragraphs) -> bool:
+    """Sincroniza un documento ficticio (un chunk por parrafo)"""
+    docs = _documents(source, paragraphs)
+    plan = store.manifest.plan(source, hash_text("".join(paragraphs)), docs, {})
+    return store.apply_sync_plan(plan)
+
+def _ingest_stream(store: VectorStore, source: str, paragraphs) -> bool:
+    """Sincroniza un documento ficticio por lotes, como la ingesta en streaming"""
+    plan = store.manifest.begin_plan(source, hash_text("".join(paragraphs)), {})
+    return store.apply_sync_stream(plan, iter(_documents(source, paragraphs)), batch_size=1)
+
+def _recall(expected, found) -> float:
+    return float(np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(expected, found)]))
+
+def test_numpy_chroma_parity():
+    """Top-k del indice NumPy (plano e IVF) frente a ChromaDB"""
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(20, 32))
+    vectors = centers[rng.integers(0, 20, 2000)] + 0.3 * rng.normal(size=(2000, 32))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = vectors[rng.integers(0, 2000, 20)] + 0.05 * rng.normal(size=(20, 32))
+    # Vectores unitarios: la distancia L2 de ChromaDB coincide con la del indice NumPy
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    ids = [f"chunk-{i}" for i in range(len(vectors))]
+    documents = [f"texto {i}" for i in range(len(vectors))]
+    metadatas = [{'doc_type': 'txt' if i % 2 else 'md'} for i in range(len(vectors))]
+
+    directory = tempfile.mkdtemp()
+    try:
+        chroma = ChromaBackend(directory, "parity")
+        flat = NumpyBackend(directory, "flat", dtype="float32", ivf_threshold=10 ** 9)
+        ivf = NumpyBackend(directory, "ivf", dtype="float32", ivf_threshold=500, ivf_nprobe=8)
+        for backend in (chroma, flat, ivf):
+            backend.upsert(ids, documents, metadatas, vectors)
+
+        for where in (None, {'doc_type': 'txt'}):
+            expected = chroma.query(queries, n_results=10, where=where)
+            found_flat = flat.query(queries, n_results=10, where=where)
+            found_ivf = ivf.query(queries, n_results=10, where=where)
+
+            assert _recall(expected['ids'], found_flat['ids']) >= 0.95
+            assert _recall(expected['ids'], found_ivf['ids']) >= 0.9
+            for expected_ids, expected_distances, ids_found, distances in zip(
+                    expected['ids'], expected['distances'],
+                    found_flat['ids'], found_flat['distances']):
+                by_id = dict(zip(ids_found, distances))
+                for doc_id, distance in zip(expected_ids, expected_distances):
+                    if doc_id in by_id:
+                        assert abs(by_id[doc_id] - distance) < 1e-3
+            if where:
+                assert all(metadata['doc_type'] == 'txt'
+                           for row in found_ivf['metadatas'] for metadata in row)
+        assert ivf.get_stats()['ivf_lists'] > 0
+
+        # Los datos (y el IVF entrenado) sobreviven a cerrar y reabrir
+        before = ivf.query(queries, n_results=10)['ids']
+        flat.close()
+        ivf.close()
+        reopened = NumpyBackend(directory, "ivf", dtype="float32", ivf_threshold=500, ivf_nprobe=8)
+        assert reopened.count() == len(ids)
+        assert reopened.get_stats()['ivf_lists'] > 0
+        assert reopened.query(queries, n_results=10)['ids'] == before
+        reopened.close()
+
+        # Escribir tras close (proyecto desalojado) no pierde datos
+        reopened.upsert(["extra"], ["texto extra"], [{'doc_type': 'txt'}], vectors[:1])
+        reopened.close()
+        reopened = NumpyBackend(directory, "ivf", dtype="float32")
+        assert reopened.count() == len(ids) + 1
+        reopened.close()
+    finally:
+        registry.clear_registry()
+        shutil.rmtree(directory, ignore_errors=True)
+
+def test_embedding_cache_shared():
+    """Los backends de un mismo directorio comparten una sola instancia del cache"""
+    directory = tempfile.mkdtemp()
+    try:
+        numpy_store = _create_store(directory, backend="numpy")
+        chroma_store = _create_store(directory, backend="chroma")
+        assert numpy_store.embedding_cache is chroma_store.embedding_cache
+
+        texts = ["El dragon rojo duerme.", "Lyra estudia las runas."]
+        numpy_store.encode_texts(texts)
+        hits = chroma_store.embedding_cache.hits
+        chroma_store.encode_texts(texts)
+        assert chroma_store.embedding_cache.hits == hits + len(texts)
+        numpy_store.close()
+        chroma_store.close()
+    finally:
+        registry.clear_registry()
+        shutil.rmtree(directory, ignore_errors=True)
+
+def test_snapshot_roundtrip():
+    """Exportar e importar un proyecto conserva chunks y resultados; los corruptos se rechazan"""
+    source_dir, target_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    snapshot_path = str(Path(source_dir) / "proyecto.snap")
+    try:
+        store = _create_store(source_dir)
+        assert _ingest(store, "capitulo1.txt", [
+            "El dragon rojo duerme bajo la montaña de ceniza.",
+            "La maga Lyra estudia las runas del grimorio antiguo.",
+            "Los elfos del bosque custodian el cristal perdido."
+        ])
+        assert _ingest(store, "capitulo2.txt", [
+            "La ciudad de Umiel arde mientras el dragon despierta.",
+            "Thane afila su espada antes del amanecer."
+        ])
+        info = store.export_snapshot(snapshot_path, "float16")
+        assert info['chunks'] == 5
+
+        restored = _create_store(target_dir)
+        result = restored.import_snapshot(snapshot_path)
+        assert result['chunks'] == 5
+        assert restored.collection.count() == 5
+        assert sorted(restored.manifest.sources()) == ["capitulo1.txt", "capitulo2.txt"]
+
+        query = "dragon de la montaña"
+        expected = [doc['content'] for doc in store.similarity_search(query, k=3)]
+        assert [doc['content'] for doc in restored.similarity_search(query, k=3)] == expected
+
+        # Un byte alterado o un archivo truncado no se importan
+        data = bytearray(Path(snapshot_path).read_bytes())
+        corrupted = Path(source_dir) / "corrupto.snap"
+        data[len(data) // 2] ^= 0xFF
+        for payload in (bytes(data), bytes(data[:len(data) // 3])):
+            corrupted.write_bytes(payload)
+            try:
+                restored.import_snapshot(str(corrupted))
+            except SnapshotError:
+                pass
+            else:
+                raise AssertionError("Snapshot corrupto importado sin error")
+        assert restored.collection.count() == 5
+
+        store.close()
+        restored.close()
+    finally:
+        registry.clear_registry()
+        shutil.rmtree(source_dir, ignore_errors=True)
+        shutil.rmtree(target_dir, ignore_errors=True)
+
+def test_dedup_alias_promotion():
+    """Un casi duplicado queda como alias y hereda el chunk al borrar el canonico"""
+    base = " ".join(f"El dragon {i} vuela sobre la ciudad de Umiel al amanecer." for i in range(20))
+    revised = base.replace("dragon 7 vuela", "dragon 7 planea")
+    directory = tempfile.mkdtemp()
+    try:
+        store = _create_store(directory)
+        assert store.dedup is not None
+        assert _ingest(store, "borrador.txt", [base, "Las runas exigen sangre."])
+        assert _ingest(store, "revision.txt", [revised, "Thane parte hacia el norte."])
+
+        # El parrafo revisado no se almacena: es alias del original
+        assert store.collection.count() == 3
+        assert store.dedup.get_stats()['duplicate_chunks'] == 1
+        canonical = store.collection.get(where={'source': 'borrador.txt'},
+                                         include=["documents", "metadatas"])
+        annotated = [metadata for metadata in canonical['metadatas'] if metadata.get('duplicates')]
+        assert len(annotated) == 1
+        assert annotated[0]['sources'] == "borrador.txt | revision.txt"
+
+        # Al borrar la fuente canonica el alias pasa a ser el chunk almacenado
+        assert store.delete_documents_by_source("borrador.txt")
+        remaining = store.collection.get(include=["documents", "metadatas"])
+        assert sorted(metadata['source'] for metadata in remaining['metadatas']) == [
+            "revision.txt", "revision.txt"
+        ]
+        assert store.dedup.get_stats()['duplicate_chunks'] == 0
+        assert not any(metadata.get('duplicates') for metadata in remaining['metadatas'])
+        hits = store.similarity_search("dragon 7 planea sobre Umiel", k=1)
+        assert hits[0]['metadata']['source'] == "revision.txt"
+        store.close()
+    finally:
+        registry.clear_registry()
+        shutil.rmtree(directory, ignore_errors=True)
+
+def test_dedup_edited_reingest():
+    """Un parrafo editado se almacena con su texto nuevo, no como alias de su version previa"""
+    base = " ".join(f"El dragon {i} vuela sobre la ciudad de Umiel al amanecer." for i in range(20))
+    revised = base.replace("dragon 7 vuela", "dragon 7 planea")
+    directory = tempfile.mkdtemp()
+    try:
+        store = _create_store(directory)
+        assert _ingest_stream(store, "capitulo.txt", [base, "Las runas exigen sangre."])
+        assert _ingest_stream(store, "capitulo.txt", [revised, "Las runas exigen sangre."])
+
+        stored = store.collection.get(include=["documents", "metadatas"])
+        assert sorted(stored['documents']) == sorted([revised, "Las runas exigen sangre."])
+        assert store.dedup.get_stats()['duplicate_chunks'] == 0
+        assert not any(metadata.get('duplicates') for metadata in stored['metadatas'])
+        assert sorted(store.manifest.get("capitulo.txt")["chunks"]) == sorted(stored['ids'])
+        store.close()
+    finally:
+        registry.clear_registry()
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main():
+    """Ejecuta las pruebas e imprime un resumen"""
+    print("🧪 Almacenamiento RAG - Pruebas")
+    print("=" * 50)
+
+    tests = [
+        ("Paridad NumPy / ChromaDB", test_numpy_chroma_parity),
+        ("Cache de embeddings compartido", test_embedding_cache_shared),
+        ("Snapshot ida y vuelta", test_snapshot_roundtrip),
+        ("Deduplicacion y promocion", test_dedup_alias_promotion),
+        ("Re-ingesta de un documento editado", test_dedup_edited_reingest),
+    ]
+    passed = 0
+    for name, test in tests:
+        try:
+            test()
+            print(f"✅ {name}")
+            passed += 1
+        except Exception as e:
+            print(f"❌ {name}: {e!r}")
+            import traceback
+            traceback.print_exc()
+
+    print(f"\n📊 Resultado: {passed}/{len(tests)} pruebas exitosas")
+    return passed == len(tests)
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)